@@ -15,11 +15,13 @@
 import os
 import random
 import select
+import sys
 import threading
 import time
 
 from oslo_log import log
 import pkg_resources
+import six
 from stevedore import extension
 from wsgiref import simple_server
 
@@ -30,6 +32,10 @@ from ironic_python_agent.extensions import base
 from ironic_python_agent import hardware
 from ironic_python_agent import ironic_api_client
 
+# Number of seconds the agent waits for the lookup of the node and the
+# sending of the inventory to finish once the API server stopped.
+STARTUP_STOP_TIMEOUT = 10
+
 
 def _time():
     """Wraps time.time() for simpler testing."""
@@ -39,11 +45,12 @@ def _time():
 class IronicPythonAgentStatus(encoding.Serializable):
     """Represents the status of an agent."""
 
-    serializable_fields = ('started_at', 'version')
+    serializable_fields = ('started_at', 'version', 'ready')
 
-    def __init__(self, started_at, version):
+    def __init__(self, started_at, version, ready=True):
         self.started_at = started_at
         self.version = version
+        self.ready = ready
 
 
 class IronicPythonAgentHeartbeater(threading.Thread):
@@ -165,6 +172,13 @@ class IronicPythonAgent(base.ExecuteCommandMixin):
         self.ip_lookup_sleep = ip_lookup_sleep
         self.network_interface = network_interface
         self.standalone = standalone
+        # Set once the node is looked up, see run()
+        self.ready = threading.Event()
+        self._startup_error = None
+        # Guards _stopping, so that heartbeats do not start once the agent
+        # stops.
+        self._startup_lock = threading.Lock()
+        self._stopping = False
 
     def get_status(self):
         """Retrieve a serializable status.
@@ -174,7 +188,8 @@ class IronicPythonAgent(base.ExecuteCommandMixin):
         """
         return IronicPythonAgentStatus(
             started_at=self.started_at,
-            version=self.version
+            version=self.version,
+            ready=self.ready.is_set()
         )
 
     def set_agent_advertise_addr(self):
@@ -266,34 +281,120 @@ class IronicPythonAgent(base.ExecuteCommandMixin):
             raise errors.RequestedObjectNotFoundError('Command Result',
                                                       result_id)
 
+    def execute_command(self, command_name, **kwargs):
+        """Execute an agent command, once the agent is ready.
+
+        :raises: AgentNotReadyError if the node is not looked up yet.
+        """
+        if not self.ready.is_set():
+            raise errors.AgentNotReadyError(
+                'The node is not looked up yet, try again later.')
+        return super(IronicPythonAgent, self).execute_command(command_name,
+                                                              **kwargs)
+
     def force_heartbeat(self):
         if not self.standalone:
             self.heartbeater.force_heartbeat()
 
-    def run(self):
-        """Run the Ironic Python Agent."""
-        # Get the UUID so we can heartbeat to Ironic. Raises LookupNodeError
-        # if there is an issue (uncaught, restart agent)
-        self.started_at = _time()
-        if not self.standalone:
+    def _prefetch_image(self):
+        """Start downloading the image the node is likely to be deployed with.
+
+        See StandbyExtension.prefetch_image(), failures are only logged since
+        the image is downloaded anyway when it is deployed.
+        """
+        try:
+            self.get_extension('standby').prefetch_image(self.node)
+        except Exception:
+            self.log.exception('error starting the image prefetch')
+
+    def _send_inventory(self, inventory):
+        """Send the full inventory to Ironic with another lookup.
+
+        The lookup is the only call of the Ironic API taking the inventory,
+        so every agent which starts looks up its node twice, doubling the
+        lookup requests Ironic gets.
+
+        :param inventory: a dictionary holding the inventory in 'inventory'
+                          once collected.
+        """
+        if 'inventory' not in inventory:
+            return
+        try:
             content = self.api_client.lookup_node(
-                hardware_info=hardware.dispatch_to_managers(
-                                  'list_hardware_info'),
+                hardware_info=inventory['inventory'],
+                timeout=self.lookup_timeout,
+                starting_interval=self.lookup_interval)
+        except Exception:
+            self.log.exception('error sending the hardware inventory')
+        else:
+            self.node = content['node']
+
+    def _start(self, wsgi):
+        """Look up the node, then start heartbeating.
+
+        The node is looked up with the network interfaces only, which are
+        what Ironic matches nodes with, while the rest of the inventory is
+        collected. The full inventory is sent once heartbeats are started.
+        Failures stop the API server, see run().
+
+        :param wsgi: the server of the API.
+        """
+        inventory = {}
+
+        def collect():
+            try:
+                inventory['inventory'] = hardware.dispatch_to_managers(
+                    'list_hardware_info')
+            except Exception:
+                self.log.exception('error collecting the hardware inventory')
+
+        collector = threading.Thread(target=collect, name='inventory')
+        collector.daemon = True
+        collector.start()
+        try:
+            # Get the UUID so we can heartbeat to Ironic. Raises
+            # LookupNodeError if there is an issue (restarts the agent)
+            content = self.api_client.lookup_node(
+                hardware_info={'interfaces': hardware.dispatch_to_managers(
+                    'list_network_interfaces')},
                 timeout=self.lookup_timeout,
                 starting_interval=self.lookup_interval)
 
             self.node = content['node']
             self.heartbeat_timeout = content['heartbeat_timeout']
+            self._prefetch_image()
+            with self._startup_lock:
+                if self._stopping:
+                    return
+                self.heartbeater.start()
+            self.ready.set()
+            self.log.info('agent ready %.2f seconds after starting',
+                          _time() - self.started_at)
+        except BaseException:
+            self._startup_error = sys.exc_info()
+            wsgi.shutdown()
+            return
+        collector.join()
+        self._send_inventory(inventory)
 
+    def run(self):
+        """Run the Ironic Python Agent."""
+        self.started_at = _time()
+        # Listen first, so that the agent is reachable while it looks up the
+        # node. Commands are refused until the agent is ready.
         wsgi = simple_server.make_server(
             self.listen_address[0],
             self.listen_address[1],
             self.api,
             server_class=simple_server.WSGIServer)
 
-        if not self.standalone:
-            # Don't start heartbeating until the server is listening
-            self.heartbeater.start()
+        if self.standalone:
+            self.ready.set()
+        else:
+            startup = threading.Thread(target=self._start, args=(wsgi,),
+                                       name='startup')
+            startup.daemon = True
+            startup.start()
 
         try:
             wsgi.serve_forever()
@@ -301,4 +402,11 @@ class IronicPythonAgent(base.ExecuteCommandMixin):
             self.log.exception('shutting down')
 
         if not self.standalone:
+            # The startup thread is a daemon, it is not waited for longer
+            # than that, but heartbeats are not to start after being stopped
+            startup.join(STARTUP_STOP_TIMEOUT)
+            with self._startup_lock:
+                self._stopping = True
             self.heartbeater.stop()
+            if self._startup_error is not None:
+                six.reraise(*self._startup_error)
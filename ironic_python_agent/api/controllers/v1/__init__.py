@@ -24,6 +24,7 @@ import wsmeext.pecan as wsme_pecan
 
 from ironic_python_agent.api.controllers.v1 import base
 from ironic_python_agent.api.controllers.v1 import command
+from ironic_python_agent.api.controllers.v1 import image
 from ironic_python_agent.api.controllers.v1 import link
 from ironic_python_agent.api.controllers.v1 import status
 
@@ -106,6 +107,7 @@ class Controller(rest.RestController):
     """Version 1 API controller root."""
 
     commands = command.CommandController()
+    images = image.ImageController()
     status = status.StatusController()
 
     @wsme_pecan.wsexpose(V1)
@@ -66,7 +66,7 @@ class MultiType(wtypes.UserType):
                     type=self.types, value=type(value)))
 
 
-json_type = MultiType(list, dict, six.integer_types, wtypes.text)
+json_type = MultiType(list, dict, six.integer_types, float, wtypes.text)
 
 
 class APIBase(wtypes.Base):
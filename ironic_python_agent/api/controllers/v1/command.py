@@ -30,6 +30,7 @@ class CommandResult(base.APIBase):
     command_status = types.text
     command_error = base.exception_type
     command_result = types.DictType(types.text, base.json_type)
+    command_progress = types.DictType(types.text, base.json_type)
 
     @classmethod
     def from_result(cls, result):
@@ -42,7 +43,7 @@ class CommandResult(base.APIBase):
         """
         instance = cls()
         for field in ('id', 'command_name', 'command_params', 'command_status',
-                      'command_error', 'command_result'):
+                      'command_error', 'command_result', 'command_progress'):
             setattr(instance, field, getattr(result, field))
         return instance
 
@@ -0,0 +1,50 @@
+# Copyright 2026 Ironic Python Agent contributors
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import pecan
+from pecan import rest
+
+
+class ImageChunkController(rest.RestController):
+    """Controller serving the chunks of images to other agents."""
+
+    @pecan.expose(content_type='application/octet-stream')
+    def get_one(self, image_id, index):
+        """Get a chunk of an image held by the agent.
+
+        :param image_id: the ID of the image.
+        :param index: the index of the chunk in the image chunk manifest.
+        :returns: the data of the chunk.
+        """
+        try:
+            index = int(index)
+        except ValueError:
+            pecan.abort(404)
+        standby = pecan.request.agent.get_extension('standby')
+        data = standby.get_image_chunk(image_id, index)
+        if data is None:
+            pecan.abort(404)
+        return data
+
+
+class ImageController(rest.RestController):
+    """Controller for the images held by the agent."""
+
+    chunks = ImageChunkController()
+
+    @pecan.expose()
+    def get_one(self, image_id):
+        # Images are only there to look up their chunks
+        pecan.abort(404)
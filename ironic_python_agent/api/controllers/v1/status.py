@@ -26,6 +26,7 @@ class AgentStatus(base.APIBase):
 
     started_at = base.MultiType(float)
     version = types.text
+    ready = bool
 
     @classmethod
     def from_agent_status(cls, status):
@@ -37,7 +38,7 @@ class AgentStatus(base.APIBase):
                   AgentStatus` object.
         """
         instance = cls()
-        for field in ('started_at', 'version'):
+        for field in ('started_at', 'version', 'ready'):
             setattr(instance, field, getattr(status, field))
         return instance
 
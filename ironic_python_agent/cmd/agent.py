@@ -93,6 +93,122 @@ cli_opts = [
                  default=APARAMS.get('lldp-timeout', 30.0),
                  help='The amount of seconds to wait for LLDP packets.'),
 
+    cfg.IntOpt('hardware_info_threads',
+               default=int(APARAMS.get('ipa-hardware-info-threads', 4)),
+               min=1,
+               help='The number of threads collecting the sections of the '
+                    'hardware inventory concurrently.'),
+
+    cfg.FloatOpt('hardware_info_section_timeout',
+                 default=float(APARAMS.get(
+                     'ipa-hardware-info-section-timeout', 60)),
+                 help='The maximum number of seconds collecting a section '
+                      'of the hardware inventory can take. A section taking '
+                      'longer is left out of the inventory.'),
+
+    cfg.IntOpt('image_download_connections',
+               default=int(APARAMS.get('ipa-image-download-connections', 1)),
+               help='The number of HTTP connections used to download an '
+                    'image as parallel byte ranges, when the image server '
+                    'supports range requests. 1 disables ranged downloads. '
+                    'It is also the number of chunks fetched at once from '
+                    'other agents when an image has a chunk manifest.'),
+
+    cfg.IntOpt('image_chunks_max_size',
+               default=int(APARAMS.get('ipa-image-chunks-max-size', 512)),
+               help='The maximum number of MB of chunks of an image kept '
+                    'in /tmp, which is held in memory, to be served to '
+                    'other agents. The chunks served least recently are '
+                    'dropped first.'),
+
+    cfg.IntOpt('image_download_range_size',
+               default=int(APARAMS.get('ipa-image-download-range-size',
+                                       16 * 1024 * 1024)),
+               help='The size in bytes of the byte ranges an image is split '
+                    'into for parallel downloads. Up to '
+                    'image_download_connections ranges are buffered in '
+                    'memory at once.'),
+
+    cfg.IntOpt('image_download_retries',
+               default=int(APARAMS.get('ipa-image-download-retries', 5)),
+               help='The number of times an interrupted image download is '
+                    'resumed from the last received byte, on the same URL '
+                    'or the next mirror, before giving up. The count is '
+                    'reset whenever data is received again.'),
+
+    cfg.FloatOpt('image_download_retry_interval',
+                 default=float(APARAMS.get('ipa-image-download-retry-interval',
+                                           1.0)),
+                 help='The initial interval in seconds before resuming an '
+                      'interrupted image download. The interval is doubled '
+                      'after each consecutive failure.'),
+
+    cfg.FloatOpt('image_download_rate_limit',
+                 default=float(APARAMS.get('ipa-image-download-rate-limit',
+                                           0)),
+                 help='The maximum rate in MB per second at which an image '
+                      'is downloaded, over all its connections, so that '
+                      'deploying many nodes at once does not saturate the '
+                      'image servers. Can be overridden with '
+                      'image_info[\'download_rate_limit\']. 0 disables the '
+                      'limit.'),
+
+    cfg.FloatOpt('image_download_start_delay',
+                 default=float(APARAMS.get('ipa-image-download-start-delay',
+                                           0)),
+                 help='The maximum number of seconds an image download is '
+                      'delayed by before starting. The delay is picked at '
+                      'random, to spread out downloads started at the same '
+                      'time by many nodes.'),
+
+    cfg.BoolOpt('image_verify_after_write',
+                default=APARAMS.get('ipa-image-verify-after-write', False),
+                help='Whether to read an image back from the install device '
+                     'once it is written, to check that the device holds '
+                     'what was written. Can be overridden with '
+                     'image_info[\'verify_after_write\'].'),
+
+    cfg.IntOpt('image_verify_threads',
+               default=int(APARAMS.get('ipa-image-verify-threads', 4)),
+               help='The number of threads reading an image back from the '
+                    'install device in parallel to check it.'),
+
+    cfg.StrOpt('image_cache_manifest',
+               default=APARAMS.get('ipa-image-cache-manifest',
+                                   '/var/lib/ironic-python-agent/'
+                                   'image_cache.json'),
+               help='File recording which image was last written to the '
+                    'install device, so that it is not downloaded and '
+                    'written again after the agent restarts. An empty '
+                    'value disables it.'),
+
+    cfg.BoolOpt('image_prefetch',
+                default=APARAMS.get('ipa-image-prefetch', False),
+                help='Whether to start downloading the image named in the '
+                     'instance information of the node once it is looked '
+                     'up, so that the image is at least partly downloaded '
+                     'when the command deploying it arrives.'),
+
+    cfg.StrOpt('image_prefetch_url',
+               default=APARAMS.get('ipa-image-prefetch-url'),
+               help='URL of an image to start downloading once the node is '
+                    'looked up, like with image_prefetch. Takes precedence '
+                    'over the image of the node.'),
+
+    cfg.FloatOpt('image_prefetch_rate_limit',
+                 default=float(APARAMS.get('ipa-image-prefetch-rate-limit',
+                                           10)),
+                 help='The maximum rate in MB per second at which an image '
+                      'is prefetched, so that the prefetch stays in the '
+                      'background. 0 disables the limit.'),
+
+    cfg.IntOpt('image_prefetch_max_size',
+               default=int(APARAMS.get('ipa-image-prefetch-max-size', 512)),
+               help='The maximum number of MB of an image that are '
+                    'prefetched. The prefetched data is kept in /tmp, '
+                    'which is held in memory, and the rest of the image is '
+                    'downloaded when it is deployed.'),
+
     cfg.BoolOpt('standalone',
                 default=APARAMS.get('ipa-standalone', False),
                 help='Note: for debugging only. Start the Agent but suppress '
@@ -0,0 +1,186 @@
+# Copyright 2026 Ironic Python Agent contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Decompression of images while they are being downloaded.
+
+gzip and bzip2 are supported with the standard library. xz needs the lzma
+module, from backports.lzma on Python 2, and zstd the zstandard package;
+these formats are unavailable when the modules are not installed.
+"""
+
+import bz2
+import itertools
+import zlib
+
+from oslo_log import log
+
+from ironic_python_agent import errors
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = log.getLogger(__name__)
+
+# Largest piece of decompressed data produced at once, for the decompressors
+# that can limit their output. This keeps memory use in check when highly
+# compressed data, like long runs of zeros, is decompressed.
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Value of image_info['compression'] for images which must not be
+# decompressed even if they look compressed.
+NONE = 'none'
+
+_FORMATS = [
+    ('gzip', b'\x1f\x8b',
+     lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    ('bzip2', b'BZh', lambda: bz2.BZ2Decompressor()),
+    ('xz', b'\xfd7zXZ\x00', lambda: lzma.LZMADecompressor()),
+    ('zstd', b'\x28\xb5\x2f\xfd',
+     lambda: zstandard.ZstdDecompressor().decompressobj()),
+]
+FORMATS = tuple(name for name, _magic, _factory in _FORMATS)
+_MAGIC_SIZE = max(len(magic) for _name, magic, _factory in _FORMATS)
+
+_ERRORS = (zlib.error, EnvironmentError, EOFError, ValueError)
+if lzma is not None:
+    _ERRORS += (lzma.LZMAError,)
+if zstandard is not None:
+    _ERRORS += (zstandard.ZstdError,)
+
+
+def is_available(compression):
+    """Tell whether images compressed in a format can be decompressed."""
+    modules = {'xz': lzma, 'zstd': zstandard}
+    return (compression in FORMATS
+            and modules.get(compression, bz2) is not None)
+
+
+def detect(data):
+    """Find out the compression format of data from its first bytes.
+
+    :returns: the name of the format, None if data is not compressed in a
+              supported format.
+    """
+    for name, magic, _factory in _FORMATS:
+        if data.startswith(magic):
+            return name
+    return None
+
+
+def _feed(decompressor, data):
+    if hasattr(decompressor, 'needs_input'):
+        # bz2 and lzma on Python 3
+        while True:
+            output = decompressor.decompress(data, CHUNK_SIZE)
+            data = b''
+            if output:
+                yield output
+            if decompressor.eof or decompressor.needs_input:
+                return
+    elif hasattr(decompressor, 'unconsumed_tail'):
+        # zlib
+        while True:
+            output = decompressor.decompress(data, CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+            if output:
+                yield output
+            if not data and len(output) < CHUNK_SIZE:
+                return
+    else:
+        output = decompressor.decompress(data)
+        if output:
+            yield output
+
+
+def _checked_feed(decompressor, data, compression, image_id):
+    try:
+        for output in _feed(decompressor, data):
+            yield output
+    except _ERRORS as e:
+        msg = 'Unable to decompress {0} image: {1}'.format(compression, e)
+        raise errors.ImageDownloadError(image_id, msg)
+
+
+def _eof(decompressor):
+    # Python 2 decompressors do not tell whether the end of the stream was
+    # reached, only that it was followed by more data.
+    return getattr(decompressor, 'eof', bool(decompressor.unused_data))
+
+
+def _decompress(chunks, compression, image_id):
+    factory = dict((name, f) for name, _magic, f in _FORMATS)[compression]
+    decompressor = factory()
+    for chunk in chunks:
+        while chunk:
+            if decompressor is None:
+                decompressor = factory()
+            for output in _checked_feed(decompressor, chunk, compression,
+                                        image_id):
+                yield output
+            if not _eof(decompressor):
+                break
+            # Several streams may follow each other, as written by pigz or
+            # pbzip2 for instance.
+            chunk = decompressor.unused_data
+            decompressor = None
+    if (decompressor is not None and hasattr(decompressor, 'eof')
+            and not decompressor.eof):
+        msg = 'Compressed {0} image is truncated'.format(compression)
+        raise errors.ImageDownloadError(image_id, msg)
+
+
+def decompress(chunks, image_id, compression=None):
+    """Decompress an image while it is being read.
+
+    :param chunks: Iterable over the image data.
+    :param image_id: ID of the image, for error messages.
+    :param compression: Name of the format the image is compressed with,
+                        NONE if it is not compressed. By default the format
+                        is detected from the first bytes of the image.
+    :returns: A tuple of the compression format, None if the image is not
+              compressed, and an iterator over the decompressed data.
+    :raises: ImageDownloadError while iterating if the data cannot be
+             decompressed.
+    """
+    chunks = iter(chunks)
+    head = []
+    if compression is None:
+        for chunk in chunks:
+            head.append(chunk)
+            if sum(len(c) for c in head) >= _MAGIC_SIZE:
+                break
+        compression = detect(b''.join(head))
+    elif compression == NONE:
+        compression = None
+
+    chunks = itertools.chain(head, chunks)
+    if compression is None:
+        return None, chunks
+    if not is_available(compression):
+        msg = ('Image is compressed with {0}, which is not supported by '
+               'this agent').format(compression)
+        raise errors.ImageDownloadError(image_id, msg)
+    LOG.info('Decompressing {0} image {1} while downloading it'.format(
+        compression, image_id))
+    return compression, _decompress(chunks, compression, image_id)
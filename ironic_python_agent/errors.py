@@ -85,6 +85,16 @@ class InvalidCommandParamsError(InvalidContentError):
         super(InvalidCommandParamsError, self).__init__(details)
 
 
+class AgentNotReadyError(RESTError):
+    """Error raised when a command is issued before the agent is ready."""
+
+    message = 'Agent is not ready'
+    status_code = 503
+
+    def __init__(self, details):
+        super(AgentNotReadyError, self).__init__(details)
+
+
 class RequestedObjectNotFoundError(NotFound):
     def __init__(self, type_descr, obj_id):
         details = '{0} with id {1} not found.'.format(type_descr, obj_id)
@@ -169,6 +179,16 @@ class ImageWriteError(RESTError):
         super(ImageWriteError, self).__init__(details)
 
 
+class ImageFormatError(RESTError):
+    """Error raised when an image cannot be decoded while streaming it."""
+
+    message = 'Error decoding image'
+
+    def __init__(self, image_id, msg):
+        details = 'Image {0} cannot be decoded: {1}'.format(image_id, msg)
+        super(ImageFormatError, self).__init__(details)
+
+
 class ConfigDriveTooLargeError(RESTError):
     """Error raised when a configdrive is larger than the partition."""
 
@@ -180,6 +200,27 @@ class ConfigDriveTooLargeError(RESTError):
         super(ConfigDriveTooLargeError, self).__init__(details)
 
 
+class ConfigDriveDownloadError(RESTError):
+    """Error raised when a configdrive cannot be downloaded."""
+
+    message = 'Error downloading configdrive'
+
+    def __init__(self, url, msg):
+        details = 'Download of configdrive from {0} failed: {1}'.format(url,
+                                                                         msg)
+        super(ConfigDriveDownloadError, self).__init__(details)
+
+
+class ConfigDriveFormatError(RESTError):
+    """Error raised when a configdrive cannot be decoded."""
+
+    message = 'Error decoding configdrive'
+
+    def __init__(self, msg):
+        details = 'Configdrive cannot be decoded: {0}'.format(msg)
+        super(ConfigDriveFormatError, self).__init__(details)
+
+
 class ConfigDriveWriteError(RESTError):
     """Error raised when a configdrive cannot be written to a device."""
 
@@ -26,6 +26,9 @@ from ironic_python_agent import utils
 
 LOG = log.getLogger()
 
+# Holds the AsyncCommandResult of the command run by the current thread
+_current = threading.local()
+
 
 class AgentCommandStatus(object):
     """Mapping of agent command statuses."""
@@ -39,7 +42,8 @@ class BaseCommandResult(encoding.Serializable):
     """Base class for command result."""
 
     serializable_fields = ('id', 'command_name', 'command_params',
-                           'command_status', 'command_error', 'command_result')
+                           'command_status', 'command_error', 'command_result',
+                           'command_progress')
 
     def __init__(self, command_name, command_params):
         """Construct an instance of BaseCommandResult.
@@ -54,6 +58,7 @@ class BaseCommandResult(encoding.Serializable):
         self.command_status = AgentCommandStatus.RUNNING
         self.command_error = None
         self.command_result = None
+        self.command_progress = None
 
     def is_done(self):
         """Checks to see if command is still RUNNING.
@@ -145,8 +150,24 @@ class AsyncCommandResult(BaseCommandResult):
         with self.command_state_lock:
             return super(AsyncCommandResult, self).is_done()
 
+    def update_progress(self, **progress):
+        """Update the progress of the command while it runs.
+
+        The progress is a dictionary whose keys are up to the command, it is
+        returned along with the command status so that long running
+        commands can be followed.
+
+        :param progress: keys of the progress to set.
+        """
+        with self.command_state_lock:
+            # Replace the dictionary rather than updating it, so that
+            # serialized results are not changed afterwards.
+            progress = dict(self.command_progress or {}, **progress)
+            self.command_progress = progress
+
     def run(self):
         """Run a command."""
+        _current.command = self
         try:
             result = self.execute_method(**self.command_params)
 
@@ -174,10 +195,20 @@ class AsyncCommandResult(BaseCommandResult):
                 self.command_error = e
                 self.command_status = AgentCommandStatus.FAILED
         finally:
+            _current.command = None
             if self.agent:
                 self.agent.force_heartbeat()
 
 
+def current_command():
+    """Get the asynchronous command run by the calling thread.
+
+    :returns: the AsyncCommandResult of the command, None if the calling
+              thread does not run an asynchronous command.
+    """
+    return getattr(_current, 'command', None)
+
+
 class BaseAgentExtension(object):
     def __init__(self, agent=None):
         super(BaseAgentExtension, self).__init__()
@@ -26,6 +26,7 @@ from oslo_log import log
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
 from ironic_python_agent import hardware
+from ironic_python_agent import partitions
 from ironic_python_agent import utils
 
 LOG = log.getLogger(__name__)
@@ -39,6 +40,22 @@ def _get_partition(device, uuid):
     LOG.debug("Find the partition %(uuid)s on device %(dev)s",
               {'dev': device, 'uuid': uuid})
 
+    # Reading the partition table directly spares re-reading it in the
+    # kernel and waiting for udev, lsblk is left for what it does not
+    # recognize.
+    try:
+        partition = partitions.find_partition(device, uuid=uuid)
+    except errors.BlockDeviceError as e:
+        LOG.warning("Couldn't read the partitions of device %(dev)s, "
+                    "falling back to lsblk: %(err)s",
+                    {'dev': device, 'err': e})
+        partition = None
+    if partition is not None:
+        LOG.debug("Partition %(uuid)s found on device %(dev)s at "
+                  "%(part)s", {'uuid': uuid, 'dev': device,
+                               'part': partition})
+        return partition
+
     try:
         # Try to tell the kernel to re-read the partition table
         try:
@@ -13,50 +13,163 @@
 # limitations under the License.
 
 import base64
-import gzip
+import binascii
+import collections
+import errno
+import fcntl
 import hashlib
+import io
+import json
+import mmap
 import os
+import random
+import re
 import requests
 import six
+import stat
+import struct
+import threading
 import time
+import zlib
 
 from oslo_concurrency import processutils
+from oslo_config import cfg
 from oslo_log import log
+from six.moves import queue
 
+# NOTE: the agent options are registered by the cmd module, import it so
+# they are available even when this module is loaded on its own.
+from ironic_python_agent.cmd import agent as agent_cmd  # noqa
+from ironic_python_agent import compression
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
 from ironic_python_agent import hardware
+from ironic_python_agent import partitions
+from ironic_python_agent import qcow2
 from ironic_python_agent import utils
 
 LOG = log.getLogger(__name__)
+CONF = cfg.CONF
 
 IMAGE_CHUNK_SIZE = 1024 * 1024  # 1MB
 
+# Number of chunks buffered between the download and each thread consuming
+# it (checksum, device writer), which bounds memory use to this many
+# IMAGE_CHUNK_SIZE chunks per consumer regardless of the image size.
+IMAGE_QUEUE_DEPTH = 16
 
-def _configdrive_location():
-    return '/tmp/configdrive'
+# Hash algorithms which can be used to verify images, see
+# image_info['checksums'].
+IMAGE_CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512')
+
+# Upper bound in seconds of the backoff between attempts to resume an
+# interrupted image download.
+IMAGE_DOWNLOAD_MAX_RETRY_DELAY = 60
+
+# Granularity at which _ImageWriter looks for blocks of zeros it can leave
+# out, and the largest write it gathers consecutive data blocks into.
+IMAGE_ZERO_BLOCK_SIZE = 64 * 1024  # 64KB
+IMAGE_WRITE_BATCH_SIZE = 8 * 1024 * 1024  # 8MB
+
+# ioctl zeroing a byte range of a block device, from linux/fs.h
+BLKZEROOUT = 0x127f
+
+# Size of the blocks the data written to a device is cut into to be
+# checked, see _ImageExtents, and the alignment of the reads checking it
+# without going through the page cache.
+IMAGE_VERIFY_BLOCK_SIZE = 8 * 1024 * 1024  # 8MB
+IMAGE_DIRECT_IO_ALIGNMENT = 4096
+
+# Number of mismatching byte ranges listed in the result of a command
+# which read back an image from the device.
+IMAGE_VERIFY_MAX_MISMATCHES = 10
+
+# Minimum number of seconds between two updates of the progress of a
+# command, see _ImageProgress.
+IMAGE_PROGRESS_INTERVAL = 1.0
+
+# Number of seconds to wait for another agent serving a chunk of an image
+# before moving on to the next one, see _PeerImageDownload.
+IMAGE_PEER_TIMEOUT = 10
+
+# Size of the pieces configdrives are decoded and written in, and the size
+# of the partition they are written to.
+CONFIGDRIVE_CHUNK_SIZE = 64 * 1024  # 64KB
+CONFIGDRIVE_MAX_SIZE = 64 * 1024 * 1024  # 64MB
+
+# File holding the data of the image being prefetched, see _ImagePrefetch
+IMAGE_PREFETCH_LOCATION = '/tmp/image.prefetch'
+
+# Number of seconds a prefetch request waits for the image server, and a
+# command waits for the prefetch to stop before downloading the image anew.
+IMAGE_PREFETCH_TIMEOUT = 10
+
+# Partition table types of partition images, by their name in Ironic
+PARTITION_DISK_LABELS = {'msdos': 'dos', 'gpt': 'gpt'}
+
+# Characters skipped when decoding base64 data
+_NOT_BASE64 = re.compile(b'[^A-Za-z0-9+/=]')
 
 
 def _image_location(image_info):
     return '/tmp/{0}'.format(image_info['id'])
 
 
+def _image_chunks_location(image_info):
+    return '/tmp/{0}.chunks'.format(image_info['id'])
+
+
 def _path_to_script(script):
     cwd = os.path.dirname(os.path.realpath(__file__))
     return os.path.join(cwd, '..', script)
 
 
-def _write_image(image_info, device):
+def _write_raw_image(image, device, extents=None, progress=None):
+    """Copy a staged raw image file to device with an _ImageWriter.
+
+    :param extents: _ImageExtents recording what is written, if any.
+    :param progress: _ImageProgress counting the bytes written, if any.
+    :raises: ImageWriteError if the image could not be written.
+    """
+    LOG.info('Writing raw image {0} to device {1}'.format(image, device))
+    progress = progress or _ImageProgress()
+    writer = _ImageWriter(device, extents, progress)
+    writer.start()
+    read_error = None
+    try:
+        with open(image, 'rb') as f:
+            progress.start_phase('writing', os.fstat(f.fileno()).st_size)
+            for chunk in iter(lambda: f.read(IMAGE_CHUNK_SIZE), b''):
+                if writer.error is not None:
+                    break
+                writer.put(chunk)
+    except EnvironmentError as e:
+        read_error = e
+    finally:
+        writer.close()
+    error = writer.error or read_error
+    if error is not None:
+        raise errors.ImageWriteError(device, None, None, error)
+
+
+def _write_image(image_info, device, extents=None, progress=None):
     starttime = time.time()
     image = _image_location(image_info)
+    progress = progress or _ImageProgress()
 
-    script = _path_to_script('shell/write_image.sh')
-    command = ['/bin/bash', script, image, device]
-    LOG.info('Writing image with command: {0}'.format(' '.join(command)))
-    try:
-        stdout, stderr = utils.execute(*command, check_exit_code=[0])
-    except processutils.ProcessExecutionError as e:
-        raise errors.ImageWriteError(device, e.exit_code, e.stdout, e.stderr)
+    if image_info.get('disk_format') == 'raw':
+        _write_raw_image(image, device, extents, progress)
+    else:
+        # qemu-img does not tell how far it got
+        progress.start_phase('writing')
+        script = _path_to_script('shell/write_image.sh')
+        command = ['/bin/bash', script, image, device]
+        LOG.info('Writing image with command: {0}'.format(' '.join(command)))
+        try:
+            stdout, stderr = utils.execute(*command, check_exit_code=[0])
+        except processutils.ProcessExecutionError as e:
+            raise errors.ImageWriteError(device, e.exit_code, e.stdout,
+                                         e.stderr)
     totaltime = time.time() - starttime
     LOG.info('Image {0} written to device {1} in {2} seconds'.format(
              image, device, totaltime))
@@ -67,56 +180,145 @@ def _configdrive_is_url(configdrive):
             or configdrive.startswith('https://'))
 
 
-def _download_configdrive_to_file(configdrive, filename):
-    content = requests.get(configdrive).content
-    _write_configdrive_to_file(content, filename)
-
-
-def _write_configdrive_to_file(configdrive, filename):
-    LOG.debug('Writing configdrive to {0}'.format(filename))
-    # configdrive data is base64'd, decode it first
-    data = six.StringIO(base64.b64decode(configdrive))
-    gunzipped = gzip.GzipFile('configdrive', 'rb', 9, data)
-    with open(filename, 'wb') as f:
-        f.write(gunzipped.read())
-    gunzipped.close()
+def _iter_configdrive_data(configdrive, progress):
+    """Iterate over the base64 encoded configdrive in pieces.
 
+    A configdrive given by URL is downloaded while it is being iterated on.
 
-def _write_configdrive_to_partition(configdrive, device):
-    filename = _configdrive_location()
+    :raises: ConfigDriveDownloadError if the configdrive cannot be
+             downloaded.
+    """
     if _configdrive_is_url(configdrive):
-        _download_configdrive_to_file(configdrive, filename)
+        try:
+            resp = requests.get(configdrive, stream=True)
+            if resp.status_code != 200:
+                msg = ('Received status code {0}, expected 200. Response '
+                       'body: {1}').format(resp.status_code, resp.text)
+                raise errors.ConfigDriveDownloadError(configdrive, msg)
+            for chunk in resp.iter_content(CONFIGDRIVE_CHUNK_SIZE):
+                progress.downloaded(len(chunk))
+                yield chunk
+        except requests.RequestException as e:
+            raise errors.ConfigDriveDownloadError(configdrive, e)
     else:
-        _write_configdrive_to_file(configdrive, filename)
+        for i in range(0, len(configdrive), CONFIGDRIVE_CHUNK_SIZE):
+            yield configdrive[i:i + CONFIGDRIVE_CHUNK_SIZE]
+
+
+def _b64decode_chunks(chunks):
+    """Decode base64 data in pieces.
 
-    # check configdrive size before writing it
-    filesize = os.stat(filename).st_size
-    if filesize > (64 * 1024 * 1024):
-        raise errors.ConfigDriveTooLargeError(filename, filesize)
+    Characters outside of the base64 alphabet, like line breaks, are
+    skipped as base64.b64decode does, and each piece is decoded up to a
+    multiple of 4 characters, the rest waiting for the next piece.
+    """
+    rest = b''
+    for chunk in chunks:
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('ascii', 'ignore')
+        data = rest + _NOT_BASE64.sub(b'', chunk)
+        end = len(data) - len(data) % 4
+        rest = data[end:]
+        if end:
+            yield _b64decode(data[:end])
+    if rest:
+        yield _b64decode(rest)
 
+
+def _b64decode(data):
+    try:
+        return base64.b64decode(data)
+    except (TypeError, binascii.Error) as e:
+        raise errors.ConfigDriveFormatError(
+            'invalid base64 data: {0}'.format(e))
+
+
+def _gunzip_chunks(chunks):
+    """Decompress gzip data in pieces of at most CONFIGDRIVE_CHUNK_SIZE."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            while True:
+                data = decompressor.decompress(chunk, CONFIGDRIVE_CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+                if data:
+                    yield data
+                if not chunk and len(data) < CONFIGDRIVE_CHUNK_SIZE:
+                    break
+        data = decompressor.flush()
+    except zlib.error as e:
+        raise errors.ConfigDriveFormatError(
+            'invalid gzip data: {0}'.format(e))
+    if data:
+        yield data
+    # Python 2 decompressors do not tell whether the end of the stream was
+    # reached
+    if not getattr(decompressor, 'eof', True):
+        raise errors.ConfigDriveFormatError('gzip data is truncated')
+
+
+def _configdrive_partition(device):
+    """Find the config-2 partition of a device, create it if needed.
+
+    :returns: the path of the partition.
+    :raises: BlockDeviceError if the partition cannot be found or created.
+    """
+    partition = partitions.find_partition(device, label='config-2')
+    if partition is not None:
+        LOG.info('Existing configdrive found on {0} at {1}'.format(
+            device, partition))
+        return partition
+    LOG.info('Adding configdrive partition to {0}'.format(device))
+    return partitions.add_partition(device, CONFIGDRIVE_MAX_SIZE)
+
+
+def _write_configdrive_to_partition(configdrive, device, progress=None):
+    """Write a configdrive to the config-2 partition of a device.
+
+    The configdrive, given inline or by URL, is base64 decoded and gunzipped
+    while it is being written, CONFIGDRIVE_CHUNK_SIZE bytes at a time.
+
+    :raises: ConfigDriveTooLargeError if the configdrive does not fit in the
+             CONFIGDRIVE_MAX_SIZE bytes of the partition.
+    :raises: ConfigDriveDownloadError if the configdrive cannot be
+             downloaded.
+    :raises: ConfigDriveFormatError if the configdrive cannot be decoded.
+    :raises: BlockDeviceError if the config-2 partition cannot be found or
+             created.
+    :raises: ConfigDriveWriteError if the configdrive cannot be written.
+    """
+    progress = progress or _ImageProgress()
+    progress.start_phase('configdrive')
     starttime = time.time()
-    script = _path_to_script('shell/copy_configdrive_to_disk.sh')
-    command = ['/bin/bash', script, filename, device]
-    LOG.info('copying configdrive to disk with command {0}'.format(
-             ' '.join(command)))
+    partition = _configdrive_partition(device)
+    LOG.info('writing configdrive to {0}'.format(partition))
 
+    size = 0
+    chunks = _gunzip_chunks(_b64decode_chunks(
+        _iter_configdrive_data(configdrive, progress)))
     try:
-        stdout, stderr = utils.execute(*command, check_exit_code=[0])
-    except processutils.ProcessExecutionError as e:
-        raise errors.ConfigDriveWriteError(device,
-                                           e.exit_code,
-                                           e.stdout,
-                                           e.stderr)
+        with open(partition, 'wb') as f:
+            for data in chunks:
+                size += len(data)
+                # check configdrive size before writing past the partition
+                if size > CONFIGDRIVE_MAX_SIZE:
+                    raise errors.ConfigDriveTooLargeError(partition, size)
+                f.write(data)
+                progress.written(len(data))
+            f.flush()
+            os.fsync(f.fileno())
+    except EnvironmentError as e:
+        raise errors.ConfigDriveWriteError(partition, e.errno, '',
+                                           e.strerror)
 
     totaltime = time.time() - starttime
-    LOG.info('configdrive copied from {0} to {1} in {2} seconds'.format(
-             filename,
-             device,
-             totaltime))
+    LOG.info('configdrive of {0} bytes written to {1} in {2} '
+             'seconds'.format(size, partition, totaltime))
 
 
-def _request_url(image_info, url):
-    resp = requests.get(url, stream=True)
+def _request_url(image_info, url, timeout=None):
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    resp = requests.get(url, stream=True, **kwargs)
     if resp.status_code != 200:
         msg = ('Received status code {0} from {1}, expected 200. Response '
                'body: {2}').format(resp.status_code, url, resp.text)
@@ -124,29 +326,1467 @@ def _request_url(image_info, url):
     return resp
 
 
-def _download_image(image_info):
-    starttime = time.time()
-    resp = None
+def _request_range(image_info, url, start, end=None, timeout=None):
+    """Request the bytes from start to end of an image.
+
+    :param end: offset of the last byte requested, None for the end of the
+                image.
+    :param timeout: number of seconds to wait for the server, by default
+                    without limit.
+    :raises: ImageDownloadError if the server does not answer with the
+             requested range.
+    """
+    byte_range = 'bytes={0}-{1}'.format(start, '' if end is None else end)
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    resp = requests.get(url, stream=True, headers={'Range': byte_range},
+                        **kwargs)
+    if resp.status_code != 206:
+        msg = ('Received status code {0} from {1} for {2}, expected '
+               '206').format(resp.status_code, url, byte_range)
+        raise errors.ImageDownloadError(image_info['id'], msg)
+    return resp
+
+
+def _is_encoded(resp):
+    """Whether the body of resp is decoded on the fly by requests.
+
+    Offsets in a decoded body do not map to byte ranges of the image, so such
+    a download cannot be resumed.
+    """
+    return resp.headers.get('Content-Encoding', 'identity') != 'identity'
+
+
+def _last_byte(resp, start):
+    """Offset of the last image byte in the body of resp, None if unknown."""
+    try:
+        return start + int(resp.headers['Content-Length']) - 1
+    except (KeyError, ValueError):
+        return None
+
+
+class _TokenBucket(object):
+    """Token bucket limiting the rate at which data is transferred.
+
+    Tokens, one per byte, are added at `rate` per second up to `burst`.
+    Transferring data takes as many tokens, and once the bucket runs out the
+    threads transferring it sleep until their share of the deficit is
+    refilled. Several threads can share a bucket, so the limit applies to
+    their combined rate.
+
+    :param rate: the maximum rate in bytes per second.
+    :param burst: the maximum number of bytes transferred at once, by
+                  default one second worth of data.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(rate, IMAGE_CHUNK_SIZE)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, length, stop=None):
+        """Take length tokens, sleeping if there are not enough of them.
+
+        :param stop: threading.Event interrupting the sleep once set.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= length
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            if stop is None:
+                time.sleep(delay)
+            else:
+                stop.wait(delay)
+
+
+def _download_rate_limiter(image_info):
+    """Get the token bucket limiting the download rate of an image.
+
+    :param image_info: Image information dictionary. Its
+                       'download_rate_limit' overrides
+                       CONF.image_download_rate_limit.
+    :returns: a _TokenBucket, None if the download rate is not limited.
+    """
+    rate = image_info.get('download_rate_limit',
+                          CONF.image_download_rate_limit)
+    if not rate:
+        return None
+    LOG.info('Limiting the download of image {0} to {1} MB per '
+             'second'.format(image_info['id'], rate))
+    return _TokenBucket(rate * 1024 * 1024)
+
+
+def _iter_image_bytes(image_info, urls, start=0, end=None, resp=None,
+                      rate_limiter=None, timeout=None, stop=None):
+    """Yield the chunks of an image, resuming downloads that break off.
+
+    When the connection fails, or is closed before all the expected bytes
+    arrived, the download resumes from the last received byte with a range
+    request to the same URL, then to the next ones in urls. Up to
+    CONF.image_download_retries consecutive attempts are made, with an
+    exponential backoff between them.
+
+    :param image_info: Image information dictionary.
+    :param urls: the URLs serving the image, in order of preference.
+    :param start: offset of the first byte to yield.
+    :param end: offset of the last byte to yield, None for the end of the
+                image.
+    :param resp: an already opened response for the bytes from start.
+    :param rate_limiter: _TokenBucket limiting the download rate, if any.
+    :param timeout: number of seconds range requests wait for the server,
+                    by default without limit.
+    :param stop: threading.Event interrupting the waits between attempts
+                 and of the rate limiter once set, in which case the
+                 iteration ends early.
+    :raises: ImageDownloadError if the download could not be completed.
+    """
+    offset = start
+    last = end
+    resumable = True
+    failures = 0
+    url_index = 0
+    while True:
+        error = None
+        try:
+            if resp is None:
+                resp = _request_range(image_info, urls[url_index], offset,
+                                      end, timeout=timeout)
+            if _is_encoded(resp):
+                resumable = False
+            elif last is None:
+                last = _last_byte(resp, offset)
+            for chunk in resp.iter_content(IMAGE_CHUNK_SIZE):
+                offset += len(chunk)
+                failures = 0
+                if rate_limiter is not None:
+                    # Holding back reads slows down the sender as well
+                    rate_limiter.consume(len(chunk), stop)
+                yield chunk
+        except (requests.RequestException, errors.ImageDownloadError) as e:
+            error = e
+        else:
+            if last is None or offset > last:
+                return
+            error = 'connection closed after byte {0} of {1}'.format(
+                offset, last + 1)
+
+        failures += 1
+        if not resumable and offset > start:
+            msg = ('Download interrupted after {0} bytes and cannot be '
+                   'resumed. Error: {1}').format(offset - start, error)
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        if failures > CONF.image_download_retries:
+            msg = ('Download interrupted at byte {0}, giving up after {1} '
+                   'attempts to resume it. Error: {2}').format(
+                       offset, failures - 1, error)
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        # Retry the same URL once, then move on to the next mirror
+        if failures > 1:
+            url_index = (url_index + 1) % len(urls)
+        delay = min(CONF.image_download_retry_interval * 2 ** (failures - 1),
+                    IMAGE_DOWNLOAD_MAX_RETRY_DELAY)
+        LOG.warning('Image {0} download interrupted at byte {1}, resuming '
+                    'from {2} in {3} seconds. Error: {4}'.format(
+                        image_info['id'], offset, urls[url_index], delay,
+                        error))
+        if stop is None:
+            time.sleep(delay)
+        elif stop.wait(delay):
+            return
+        resp = None
+
+
+class _ImageProgress(object):
+    """Progress of the download and write of an image by a command.
+
+    The byte counters are updated by the threads moving the image data, and
+    the progress of the command is refreshed from them at most every
+    IMAGE_PROGRESS_INTERVAL seconds. Besides the counters, it holds the
+    current phase, the throughput of that phase in MB per second over the
+    last interval and, when the size of what the phase goes through is
+    known, the estimated number of seconds left.
+
+    bytes_written counts the zeros left out by _ImageWriter as well, since
+    they are part of the image handled by the writer.
+
+    :param command: the AsyncCommandResult to report progress to, None to
+                    only keep track of it.
+    """
+
+    # Phases of which the written bytes are the ones to track, the other
+    # ones track the downloaded bytes.
+    _WRITE_PHASES = ('writing', 'configdrive')
+
+    def __init__(self, command=None):
+        self.command = command
+        self._lock = threading.Lock()
+        self.phase = None
+        self.total_bytes = None
+        self.bytes_downloaded = 0
+        self.bytes_written = 0
+        self._phase_start = 0
+        self._phase_starttime = 0.0
+        # Bytes of the phase and time of the last report
+        self._reported_bytes = 0
+        self._reported_time = 0.0
+
+    def _phase_bytes(self):
+        if self.phase in self._WRITE_PHASES:
+            return self.bytes_written
+        return self.bytes_downloaded
+
+    def _report(self, force=False):
+        now = time.time()
+        if not force and now - self._reported_time < IMAGE_PROGRESS_INTERVAL:
+            return
+        done = self._phase_bytes() - self._phase_start
+        throughput = eta = None
+        if now > self._reported_time and done > self._reported_bytes:
+            throughput = round((done - self._reported_bytes)
+                               / (now - self._reported_time) / 1024 / 1024,
+                               1)
+        elapsed = now - self._phase_starttime
+        if self.total_bytes is not None and done and elapsed > 0:
+            eta = int(max(self.total_bytes - done, 0) * elapsed / done)
+        self._reported_bytes = done
+        self._reported_time = now
+        if self.command is not None:
+            self.command.update_progress(
+                phase=self.phase, total_bytes=self.total_bytes,
+                bytes_downloaded=self.bytes_downloaded,
+                bytes_written=self.bytes_written, throughput=throughput,
+                eta=eta)
+
+    def start_phase(self, phase, total_bytes=None):
+        """Move on to a new phase of the command.
+
+        :param phase: name of the phase, like 'downloading' or 'writing'.
+        :param total_bytes: number of bytes the phase goes through, if
+                            known.
+        """
+        LOG.debug('Image command phase: {0}'.format(phase))
+        with self._lock:
+            self.phase = phase
+            self.total_bytes = total_bytes
+            self._phase_start = self._phase_bytes()
+            self._phase_starttime = time.time()
+            self._reported_bytes = 0
+            self._reported_time = self._phase_starttime
+            self._report(force=True)
+
+    def downloaded(self, length):
+        """Count bytes received from the image servers."""
+        with self._lock:
+            self.bytes_downloaded += length
+            self._report()
+
+    def written(self, length):
+        """Count bytes of the image handled by the device writer."""
+        with self._lock:
+            self.bytes_written += length
+            self._report()
+
+
+class _ProgressShare(object):
+    """Part of an _ImageProgress made by one of several concurrent writes.
+
+    The bytes are counted by the shared _ImageProgress, while the phases of
+    each write are left out: the phase is the one of the whole command.
+    """
+
+    def __init__(self, progress):
+        self._progress = progress
+
+    def start_phase(self, phase, total_bytes=None):
+        pass
+
+    def downloaded(self, length):
+        self._progress.downloaded(length)
+
+    def written(self, length):
+        self._progress.written(length)
+
+
+class _ChunkConsumer(threading.Thread):
+    """Thread processing chunks of image data handed over by a producer.
+
+    Chunks go through a bounded queue, so the producer and the consumer run
+    concurrently while at most IMAGE_QUEUE_DEPTH chunks are held in memory.
+    If processing fails the error is stored in `error` and the remaining
+    chunks are discarded, so the producer never blocks on a full queue.
+    Subclasses implement _process(), which gets an iterator over the chunks.
+    """
+
+    def __init__(self, name):
+        super(_ChunkConsumer, self).__init__(name=name)
+        self.daemon = True
+        self.error = None
+        self._closed = False
+        self._finished = False
+        self._queue = queue.Queue(maxsize=IMAGE_QUEUE_DEPTH)
+
+    def put(self, chunk):
+        """Queue a chunk, blocking while the queue is full."""
+        self._queue.put(chunk)
+
+    def close(self):
+        """Signal the end of the data and wait for it to be processed."""
+        if not self._closed and self.ident is not None:
+            self._closed = True
+            self._queue.put(None)
+            self.join()
+
+    def _chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._finished = True
+                return
+            yield chunk
+
+    def _process(self, chunks):
+        raise NotImplementedError()
+
+    def run(self):
+        try:
+            self._process(self._chunks())
+        except Exception as e:
+            self.error = e
+            while not self._finished:
+                self._finished = self._queue.get() is None
+
+
+class _ImageHasher(_ChunkConsumer):
+    """Thread computing the checksum of an image as it is downloaded.
+
+    The time spent hashing is measured, so that the throughput of the hash
+    algorithm can be compared with the download and write speeds.
+    """
+
+    def __init__(self, image_id, algorithm='md5'):
+        super(_ImageHasher, self).__init__(
+            name='image-hasher-{0}-{1}'.format(algorithm, image_id))
+        self.algorithm = algorithm
+        self.bytes_hashed = 0
+        self.seconds = 0.0
+        self._hash = getattr(hashlib, algorithm)()
+
+    def _process(self, chunks):
+        for chunk in chunks:
+            starttime = time.time()
+            self._hash.update(chunk)
+            self.seconds += time.time() - starttime
+            self.bytes_hashed += len(chunk)
+
+    def hexdigest(self):
+        self.close()
+        return self._hash.hexdigest()
+
+    def throughput(self):
+        """Hashing throughput in MB per second, None if unknown."""
+        self.close()
+        if not self.seconds:
+            return None
+        return round(self.bytes_hashed / self.seconds / 1024 / 1024, 1)
+
+
+class _ImageExtents(_ChunkConsumer):
+    """Thread recording the extents of a device written by an _ImageWriter.
+
+    The data written, in the order it was written, is cut into blocks of
+    IMAGE_VERIFY_BLOCK_SIZE bytes whose SHA-256 digests are computed along
+    the way, so that the device can later be checked to still hold that
+    data by reading back the extents, see _verify_extents().
+    """
+
+    def __init__(self, device):
+        super(_ImageExtents, self).__init__(
+            name='image-extents-{0}'.format(os.path.basename(device)))
+        # Lists of offset and length
+        self.extents = []
+        self.block_digests = []
+        # Size of the blocks the digests are computed over
+        self.block_size = IMAGE_VERIFY_BLOCK_SIZE
+
+    def _process(self, chunks):
+        block_hash = hashlib.sha256()
+        filled = 0
+        for chunk in chunks:
+            view = memoryview(chunk)
+            while view:
+                part = view[:IMAGE_VERIFY_BLOCK_SIZE - filled]
+                block_hash.update(part)
+                filled += len(part)
+                view = view[len(part):]
+                if filled == IMAGE_VERIFY_BLOCK_SIZE:
+                    self.block_digests.append(block_hash.hexdigest())
+                    block_hash = hashlib.sha256()
+                    filled = 0
+        if filled:
+            self.block_digests.append(block_hash.hexdigest())
+
+    def add(self, offset, data):
+        """Record data written at offset."""
+        if self.extents and sum(self.extents[-1]) == offset:
+            self.extents[-1][1] += len(data)
+        else:
+            self.extents.append([offset, len(data)])
+        self.put(data)
+
+
+def _sparse_write_mode(device):
+    """Find out how blocks of zeros can be left out when writing to device.
+
+    :returns: 'seek' if device is, or will be created as, a regular file,
+              which reads back as zeros where it was not written to once
+              truncated; 'write_zeroes' if it is a block device which zeroes
+              byte ranges itself, without zeros being transferred to it;
+              'zeroout' for other block devices, which the kernel zeroes by
+              writing zeros, so that only holes are zeroed that way; None
+              if zeros have to be written.
+    """
+    try:
+        mode = os.stat(device).st_mode
+    except OSError:
+        return 'seek'
+    if stat.S_ISREG(mode):
+        return 'seek'
+    if stat.S_ISBLK(mode):
+        name = os.path.basename(os.path.realpath(device))
+        path = '/sys/class/block/{0}/queue/write_zeroes_max_bytes'.format(
+            name)
+        try:
+            with open(path) as f:
+                if int(f.read()) > 0:
+                    return 'write_zeroes'
+        except (IOError, ValueError):
+            pass
+        return 'zeroout'
+    return None
+
+
+class _ImageWriter(_ChunkConsumer):
+    """Thread writing image chunks to a device as they are downloaded.
+
+    The image is handled in blocks of IMAGE_ZERO_BLOCK_SIZE bytes, and
+    consecutive data blocks are gathered into writes of up to
+    IMAGE_WRITE_BATCH_SIZE bytes. When the target reads back as zeros where
+    it is not written to (see _sparse_write_mode()), blocks containing only
+    zeros are skipped over, or zeroed by block devices, instead of being
+    written.
+
+    Chunks are written one after the other unless put() is given the offset
+    to write them at. Parts of the device jumped over that were not written
+    before are holes which read back as zeros once the writer is done.
+
+    The data written is recorded by extents, an _ImageExtents, if given,
+    and the bytes handled are counted by progress, an _ImageProgress.
+    """
+
+    def __init__(self, device, extents=None, progress=None):
+        super(_ImageWriter, self).__init__(
+            name='image-writer-{0}'.format(os.path.basename(device)))
+        self.device = device
+        self.extents = extents
+        self.progress = progress or _ImageProgress()
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self._zeros = b'\0' * IMAGE_ZERO_BLOCK_SIZE
+        self._sparse_mode = None
+        self._file = None
+        # Offset of the next block in the image, and the end of the part of
+        # the image handled so far
+        self._offset = 0
+        self._end = 0
+        # Data blocks not written yet and the offset of the first one
+        self._pending = []
+        self._pending_size = 0
+        self._pending_start = 0
+        # Start of the blocks of zeros not cleared yet, if any
+        self._zeros_start = None
+
+    def put(self, chunk, offset=None):
+        """Queue a chunk, to be written at offset if one is given."""
+        super(_ImageWriter, self).put((offset, chunk))
+
+    def _ioctl(self, request, start, length):
+        try:
+            fcntl.ioctl(self._file.fileno(), request,
+                        struct.pack('QQ', start, length))
+        except IOError as e:
+            LOG.warning('Unable to clear {0} bytes at offset {1} of {2}, '
+                        'writing zeros from now on. Error: {3}'.format(
+                            length, start, self.device, e))
+            return False
+        return True
+
+    def _flush_data(self):
+        if not self._pending:
+            return
+        data = b''.join(self._pending)
+        self._file.seek(self._pending_start)
+        self._file.write(data)
+        if self.extents is not None:
+            self.extents.add(self._pending_start, data)
+        self.bytes_written += self._pending_size
+        self.progress.written(self._pending_size)
+        self._pending = []
+        self._pending_size = 0
+
+    def _flush_zeros(self):
+        if self._zeros_start is None:
+            return
+        start = self._zeros_start
+        length = self._offset - start
+        self._zeros_start = None
+        self.progress.written(length)
+        if self._sparse_mode == 'seek':
+            return
+        if self._sparse_mode in ('write_zeroes', 'zeroout'):
+            if self._ioctl(BLKZEROOUT, start, length):
+                return
+            self._sparse_mode = None
+        self._file.seek(start)
+        for _ in six.moves.range(length // IMAGE_ZERO_BLOCK_SIZE):
+            self._file.write(self._zeros)
+        if length % IMAGE_ZERO_BLOCK_SIZE:
+            self._file.write(self._zeros[:length % IMAGE_ZERO_BLOCK_SIZE])
+        self.bytes_written += length
+        self.bytes_skipped -= length
+
+    def _advance(self, length):
+        self._offset += length
+        self._end = max(self._end, self._offset)
+
+    def _add_data(self, data):
+        self._flush_zeros()
+        if not self._pending:
+            self._pending_start = self._offset
+        self._pending.append(data)
+        self._pending_size += len(data)
+        self._advance(len(data))
+        if self._pending_size >= IMAGE_WRITE_BATCH_SIZE:
+            self._flush_data()
+
+    def _add_zeros(self, length):
+        self._flush_data()
+        if self._zeros_start is None:
+            self._zeros_start = self._offset
+        self._advance(length)
+        self.bytes_skipped += length
+
+    def _add_block(self, block):
+        if self._sparse_mode in (None, 'zeroout') or block != self._zeros:
+            self._add_data(block)
+        else:
+            self._add_zeros(len(block))
+
+    def _seek(self, offset):
+        self._flush_data()
+        self._flush_zeros()
+        if offset > self._end:
+            # Clear the hole between what was written so far and offset
+            self._offset = self._end
+            self._add_zeros(offset - self._end)
+        else:
+            self._offset = offset
+
+    def _process(self, chunks):
+        if self.extents is None:
+            self._write(chunks)
+            return
+        self.extents.start()
+        try:
+            self._write(chunks)
+        finally:
+            self.extents.close()
+
+    def _write(self, chunks):
+        self._sparse_mode = _sparse_write_mode(self.device)
+        with open(self.device, 'wb') as f:
+            self._file = f
+            tail = b''
+            for offset, chunk in chunks:
+                if offset is not None and offset != self._offset + len(tail):
+                    if tail:
+                        self._add_data(tail)
+                        tail = b''
+                    self._seek(offset)
+                if tail:
+                    chunk = tail + chunk
+                end = len(chunk) - len(chunk) % IMAGE_ZERO_BLOCK_SIZE
+                for i in six.moves.range(0, end, IMAGE_ZERO_BLOCK_SIZE):
+                    self._add_block(chunk[i:i + IMAGE_ZERO_BLOCK_SIZE])
+                tail = chunk[end:]
+            if tail:
+                self._add_data(tail)
+            self._flush_data()
+            self._flush_zeros()
+            if self._sparse_mode == 'seek':
+                # Extend the file over blocks of zeros at the end
+                f.truncate(self._end)
+            f.flush()
+            os.fsync(f.fileno())
+        LOG.info('Wrote {0} bytes to {1}, left out {2} bytes of '
+                 'zeros'.format(self.bytes_written, self.device,
+                                self.bytes_skipped))
+
+
+class _ImageMirror(object):
+    """_ImageWriters writing the same image to several devices at once.
+
+    Each chunk is handed to the writer of every device, which writes it on
+    its own thread, so writing the image takes as long as on the slowest
+    device rather than as long as on all of them one after the other. The
+    bytes written are counted once, by the writer of the first device.
+
+    :param devices: the devices to write to.
+    :param extents: list of the _ImageExtents recording what is written to
+                    each device, if any.
+    :param progress: _ImageProgress counting the bytes written, if any.
+    """
+
+    def __init__(self, devices, extents=None, progress=None):
+        extents = extents or [None] * len(devices)
+        self.writers = [_ImageWriter(device, device_extents,
+                                     progress if i == 0 else None)
+                        for i, (device, device_extents)
+                        in enumerate(zip(devices, extents))]
+
+    @property
+    def error(self):
+        for writer in self.writers:
+            if writer.error is not None:
+                return writer.error
+        return None
+
+    def start(self):
+        for writer in self.writers:
+            writer.start()
+
+    def put(self, chunk, offset=None):
+        for writer in self.writers:
+            writer.put(chunk, offset)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def _probe_ranged_urls(image_info):
+    """Find the image URLs which can serve byte ranges of the image.
+
+    :param image_info: Image information dictionary.
+    :returns: a tuple of the image size in bytes and the list of URLs that
+              accept range requests for it. The size is None and the list
+              empty if no URL does.
+    """
+    size = None
+    urls = []
     for url in image_info['urls']:
         try:
-            LOG.info("Attempting to download image from {0}".format(url))
-            resp = _request_url(image_info, url)
-        except errors.ImageDownloadError as e:
-            failtime = time.time() - starttime
-            log_msg = ('Image download failed. URL: {0}; time: {1} seconds. '
-                       'Error: {2}')
-            LOG.warning(log_msg.format(url, failtime, e.details))
+            resp = requests.head(url, allow_redirects=True)
+        except requests.RequestException as e:
+            LOG.warning('Unable to probe {0} for range requests: '
+                        '{1}'.format(url, e))
             continue
-        else:
-            break
-    if resp is None:
+        if (resp.status_code != 200
+                or resp.headers.get('Accept-Ranges') != 'bytes'):
+            continue
+        try:
+            length = int(resp.headers['Content-Length'])
+        except (KeyError, ValueError):
+            continue
+        if size is not None and length != size:
+            LOG.warning('Image at {0} has size {1}, expected {2}, not using '
+                        'it for ranged download'.format(url, length, size))
+            continue
+        size = length
+        urls.append(url)
+    return size, urls
+
+
+class _RangedImageDownload(object):
+    """Iterator over the chunks of an image fetched as parallel byte ranges.
+
+    The image is split into ranges of range_size bytes which are fetched
+    concurrently over `connections` HTTP connections, spread over every URL
+    able to serve ranges. Chunks are still yielded in image order: the
+    range being consumed is passed on as it arrives, while at most
+    `connections` ranges are downloaded or buffered at any time. The
+    connections share rate_limiter, a _TokenBucket, if one is given.
+    """
+
+    def __init__(self, image_info, urls, size, connections, range_size,
+                 rate_limiter=None):
+        self.image_info = image_info
+        self.urls = urls
+        self.rate_limiter = rate_limiter
+        self._ranges = [(start, min(start + range_size, size) - 1)
+                        for start in six.moves.range(0, size, range_size)]
+        self._buffers = [queue.Queue() for _ in self._ranges]
+        self._next_range = iter(enumerate(self._ranges))
+        self._lock = threading.Lock()
+        self._window = threading.Semaphore(connections)
+        self._stopped = False
+        self._workers = [
+            threading.Thread(target=self._fetch_ranges,
+                             name='image-range-{0}-{1}'.format(
+                                 image_info['id'], i))
+            for i in six.moves.range(min(connections, len(self._ranges)))]
+        for worker in self._workers:
+            worker.daemon = True
+
+    def _fetch_range(self, index, start, end, buf):
+        # Spread the ranges over the URLs, the others serve as fallbacks
+        first = index % len(self.urls)
+        urls = self.urls[first:] + self.urls[:first]
+        for chunk in _iter_image_bytes(self.image_info, urls, start, end,
+                                       rate_limiter=self.rate_limiter):
+            if self._stopped:
+                return
+            buf.put(chunk)
+
+    def _fetch_ranges(self):
+        while True:
+            # Wait for the consumer to make room before starting a range
+            self._window.acquire()
+            with self._lock:
+                index, byte_range = next(self._next_range, (None, None))
+            if index is None or self._stopped:
+                return
+            start, end = byte_range
+            buf = self._buffers[index]
+            try:
+                self._fetch_range(index, start, end, buf)
+            except Exception as e:
+                buf.put(e)
+                return
+            buf.put(None)
+
+    def _stop(self):
+        self._stopped = True
+        # Wake up the workers waiting for room so they can exit
+        for worker in self._workers:
+            self._window.release()
+
+    def __iter__(self):
+        for worker in self._workers:
+            worker.start()
+        try:
+            for buf in self._buffers:
+                while True:
+                    item = buf.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                self._window.release()
+        finally:
+            self._stop()
+
+
+class _ImageChunks(object):
+    """Chunks of an image kept to be served to other agents.
+
+    The chunks are the pieces of image_info['chunk_manifest']['chunk_size']
+    bytes the image is split into, as served by its URLs. Once they match
+    their SHA-256 checksum in the manifest, they are stored in a file in /tmp
+    until the agent downloads another image this way.
+
+    As /tmp is held in memory, the file holds at most
+    CONF.image_chunks_max_size MB of chunks, in slots of the chunk size.
+    When it is full, the chunk added or served least recently gives up its
+    slot.
+    """
+
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, image_info):
+        manifest = image_info['chunk_manifest']
+        self.image_id = image_info['id']
+        self.size = manifest['size']
+        self.chunk_size = manifest['chunk_size']
+        self.checksums = [c.lower() for c in manifest['checksums']]
+        self.path = _image_chunks_location(image_info)
+        self.max_chunks = max(1, CONF.image_chunks_max_size * 1024 * 1024 //
+                              self.chunk_size)
+        # Slots of the chunks in the file, least recently used first
+        self._slots = collections.OrderedDict()
+        self._file_lock = threading.Lock()
+        open(self.path, 'wb').close()
+
+    @classmethod
+    def open(cls, image_info):
+        """Start keeping the chunks of an image, dropping the previous one."""
+        chunks = cls(image_info)
+        with cls._lock:
+            previous, cls._current = cls._current, chunks
+        if previous is not None and previous.path != chunks.path:
+            previous.remove()
+        return chunks
+
+    @classmethod
+    def get(cls, image_id):
+        """Get the chunks kept for an image, None if there are none."""
+        with cls._lock:
+            chunks = cls._current
+        if chunks is None or chunks.image_id != image_id:
+            return None
+        return chunks
+
+    def byte_range(self, index):
+        """Offsets of the first and last bytes of a chunk in the image."""
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size) - 1
+
+    def verify(self, index, data):
+        return hashlib.sha256(data).hexdigest() == self.checksums[index]
+
+    def _use(self, index):
+        """Mark a chunk as the most recently used one."""
+        self._slots[index] = self._slots.pop(index)
+
+    def add(self, index, data):
+        """Keep a chunk which was checked against the manifest."""
+        with self._file_lock:
+            if index in self._slots:
+                self._use(index)
+                return
+            if len(self._slots) < self.max_chunks:
+                slot = len(self._slots)
+            else:
+                slot = self._slots.popitem(last=False)[1]
+            with open(self.path, 'r+b') as f:
+                f.seek(slot * self.chunk_size)
+                f.write(data)
+            self._slots[index] = slot
+
+    def read(self, index):
+        """Read a chunk, None if it is not kept."""
+        start, end = self.byte_range(index)
+        with self._file_lock:
+            if index not in self._slots:
+                return None
+            self._use(index)
+            with open(self.path, 'rb') as f:
+                f.seek(self._slots[index] * self.chunk_size)
+                return f.read(end - start + 1)
+
+    def remove(self):
+        with self._file_lock:
+            self._slots.clear()
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    LOG.warning('Unable to remove {0}: {1}'.format(
+                        self.path, e))
+
+
+class _PeerImageDownload(_RangedImageDownload):
+    """Iterator over the chunks of an image fetched from other agents.
+
+    The image is split into the chunks of its manifest, see _ImageChunks,
+    which are fetched in parallel from peers, other agents deploying the
+    same image. Each chunk is asked to the peers in turn, starting with a
+    different one for each chunk to spread the load, and is fetched from
+    the image URLs as a byte range if no peer has it. Every chunk is
+    checked against its checksum in the manifest before being used, and
+    kept so that this agent serves it to its own peers.
+    """
+
+    def __init__(self, image_info, chunks, peers, connections,
+                 rate_limiter=None):
+        super(_PeerImageDownload, self).__init__(
+            image_info, image_info['urls'], chunks.size, connections,
+            chunks.chunk_size, rate_limiter)
+        self.chunks = chunks
+        self.peers = peers
+
+    def _fetch_from_peer(self, peer, index):
+        url = '{0}/v1/images/{1}/chunks/{2}'.format(
+            peer.rstrip('/'), self.image_info['id'], index)
+        try:
+            resp = requests.get(url, timeout=IMAGE_PEER_TIMEOUT)
+        except requests.RequestException as e:
+            LOG.debug('Unable to fetch {0}: {1}'.format(url, e))
+            return None
+        if resp.status_code != 200:
+            return None
+        data = resp.content
+        if not self.chunks.verify(index, data):
+            LOG.warning('Chunk {0} of image {1} served by {2} does not match '
+                        'its checksum'.format(index, self.image_info['id'],
+                                              peer))
+            return None
+        return data
+
+    def _fetch_from_urls(self, index, start, end):
+        first = index % len(self.urls)
+        urls = self.urls[first:] + self.urls[:first]
+        data = b''.join(_iter_image_bytes(self.image_info, urls, start, end,
+                                          rate_limiter=self.rate_limiter))
+        if not self.chunks.verify(index, data):
+            msg = ('Chunk {0} of the image does not match its checksum in '
+                   'the chunk manifest').format(index)
+            raise errors.ImageDownloadError(self.image_info['id'], msg)
+        return data
+
+    def _fetch_range(self, index, start, end, buf):
+        data = None
+        if self.peers:
+            first = index % len(self.peers)
+            for peer in self.peers[first:] + self.peers[:first]:
+                data = self._fetch_from_peer(peer, index)
+                if data is not None:
+                    break
+        if data is None:
+            data = self._fetch_from_urls(index, start, end)
+        elif self.rate_limiter is not None:
+            self.rate_limiter.consume(len(data))
+        self.chunks.add(index, data)
+        if not self._stopped:
+            buf.put(data)
+
+
+class _ImagePrefetch(threading.Thread):
+    """Thread downloading an image before a command asks for it.
+
+    Between the lookup of the node and the command deploying it the agent
+    is idle, so the image the node is likely to be deployed with is
+    downloaded in the meantime, as it is served by its URLs, into a file in
+    /tmp. The download is rate limited by CONF.image_prefetch_rate_limit,
+    so that it stays in the background, and is resumed from the other URLs
+    like other downloads, see _iter_image_bytes(). As /tmp is held in
+    memory, only the first CONF.image_prefetch_max_size MB of the image are
+    prefetched.
+
+    A command downloading the image takes over what was prefetched, see
+    take(): the data is read back from the file and the rest of the image
+    is downloaded from where the prefetch stopped. A prefetch which does not
+    stop within IMAGE_PREFETCH_TIMEOUT seconds is dropped instead, and its
+    file removed once its thread finishes. Only one image is prefetched at a
+    time.
+    """
+
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, image_info):
+        super(_ImagePrefetch, self).__init__(
+            name='image-prefetch-{0}'.format(image_info['id']))
+        self.daemon = True
+        self.image_info = image_info
+        self.path = IMAGE_PREFETCH_LOCATION
+        self.bytes_downloaded = 0
+        # Number of bytes of the image, if known
+        self.size = None
+        self.resumable = True
+        self._stop_event = threading.Event()
+        # Guards _finished and _discarded, so that the file of a discarded
+        # prefetch is removed once, either by discard() or by the thread.
+        self._state_lock = threading.Lock()
+        self._finished = False
+        self._discarded = False
+
+    @classmethod
+    def start_for(cls, image_info):
+        """Start prefetching an image, dropping the previous prefetch."""
+        prefetch = cls(image_info)
+        with cls._lock:
+            previous, cls._current = cls._current, prefetch
+        if previous is not None:
+            previous.discard()
+        prefetch.start()
+        return prefetch
+
+    @classmethod
+    def take(cls, image_info):
+        """Stop the prefetch of an image and take what it downloaded.
+
+        :param image_info: Image information dictionary of the image the
+                           caller downloads.
+        :returns: the stopped _ImagePrefetch, None if no prefetch is for
+                  that image or it did not stop in time.
+        """
+        with cls._lock:
+            prefetch = cls._current
+            if prefetch is None or not prefetch.matches(image_info):
+                return None
+            cls._current = None
+        if not prefetch.stop():
+            LOG.warning('The prefetch of image {0} did not stop within {1} '
+                        'seconds, downloading the image again'.format(
+                            image_info['id'], IMAGE_PREFETCH_TIMEOUT))
+            prefetch.discard()
+            return None
+        return prefetch
+
+    @classmethod
+    def drop_unless(cls, image_infos):
+        """Drop the prefetch unless it is for one of image_infos."""
+        with cls._lock:
+            prefetch = cls._current
+            if prefetch is None or any(prefetch.matches(image_info)
+                                       for image_info in image_infos):
+                return
+            cls._current = None
+        LOG.info('Dropping the prefetched image {0}, it is not '
+                 'deployed'.format(prefetch.image_info['id']))
+        prefetch.discard()
+
+    @property
+    def complete(self):
+        return self.size is not None and self.bytes_downloaded >= self.size
+
+    def matches(self, image_info):
+        """Whether the image prefetched is the one of image_info.
+
+        It is if it has the same ID or is served by one of the same URLs,
+        and its checksums, if known, do not differ.
+        """
+        if (self.image_info['id'] != image_info['id'] and
+                not set(self.image_info['urls']) & set(image_info['urls'])):
+            return False
+        checksums = _image_checksums(image_info)
+        prefetched = _image_checksums(self.image_info)
+        return all(checksums[algorithm] == prefetched[algorithm]
+                   for algorithm in set(checksums) & set(prefetched))
+
+    def stop(self):
+        """Stop downloading and wait for the thread to finish.
+
+        :returns: whether the thread finished within IMAGE_PREFETCH_TIMEOUT
+                  seconds.
+        """
+        self._stop_event.set()
+        if self.ident is not None:
+            self.join(IMAGE_PREFETCH_TIMEOUT)
+        return not self.is_alive()
+
+    def discard(self):
+        """Stop downloading and remove the file, without waiting.
+
+        When the thread is still running, it removes the file as it
+        finishes.
+        """
+        self._stop_event.set()
+        with self._state_lock:
+            self._discarded = True
+            running = self.ident is not None and not self._finished
+        if not running:
+            self.remove()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                LOG.warning('Unable to remove {0}: {1}'.format(self.path, e))
+
+    def read(self):
+        """Iterate over the chunks of the image downloaded so far."""
+        with open(self.path, 'rb') as f:
+            remaining = self.bytes_downloaded
+            while remaining > 0:
+                chunk = f.read(min(IMAGE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError('{0} is missing {1} bytes of image '
+                                  '{2}'.format(self.path, remaining,
+                                               self.image_info['id']))
+                remaining -= len(chunk)
+                yield chunk
+
+    def run(self):
+        try:
+            self._prefetch()
+        finally:
+            with self._state_lock:
+                self._finished = True
+                discarded = self._discarded
+            if discarded:
+                self.remove()
+
+    def _open(self, urls):
+        """Request the image from the first of urls answering with a 200.
+
+        :returns: the response and urls starting with the URL answering.
+        :raises: ImageDownloadError if no URL answers.
+        """
+        for i, url in enumerate(urls):
+            try:
+                resp = _request_url(self.image_info, url,
+                                    timeout=IMAGE_PREFETCH_TIMEOUT)
+            except (requests.RequestException,
+                    errors.ImageDownloadError) as e:
+                LOG.warning('Unable to prefetch image {0} from {1}: '
+                            '{2}'.format(self.image_info['id'], url, e))
+                continue
+            return resp, urls[i:] + urls[:i]
+        raise errors.ImageDownloadError(
+            self.image_info['id'], 'Image download failed for all URLs.')
+
+    def _prefetch(self):
+        starttime = time.time()
+        rate = CONF.image_prefetch_rate_limit
+        rate_limiter = _TokenBucket(rate * 1024 * 1024) if rate else None
+        max_size = CONF.image_prefetch_max_size * 1024 * 1024
+        LOG.info('Prefetching image {0} from {1}'.format(
+            self.image_info['id'], ', '.join(self.image_info['urls'])))
+        try:
+            resp, urls = self._open(self.image_info['urls'])
+            if _is_encoded(resp):
+                self.resumable = False
+            else:
+                last = _last_byte(resp, 0)
+                self.size = None if last is None else last + 1
+            with open(self.path, 'wb') as f:
+                for chunk in _iter_image_bytes(self.image_info, urls,
+                                               resp=resp,
+                                               rate_limiter=rate_limiter,
+                                               timeout=IMAGE_PREFETCH_TIMEOUT,
+                                               stop=self._stop_event):
+                    chunk = chunk[:max_size - self.bytes_downloaded]
+                    f.write(chunk)
+                    self.bytes_downloaded += len(chunk)
+                    if self.bytes_downloaded >= max_size:
+                        LOG.info('Stopped prefetching image {0} at the '
+                                 'limit of {1} MB'.format(
+                                     self.image_info['id'],
+                                     CONF.image_prefetch_max_size))
+                        self._stop_event.set()
+                    if self._stop_event.is_set():
+                        break
+            if self.size is None and not self._stop_event.is_set():
+                self.size = self.bytes_downloaded
+        except Exception as e:
+            LOG.warning('Stopped prefetching image {0} after {1} bytes: '
+                        '{2}'.format(self.image_info['id'],
+                                     self.bytes_downloaded, e))
+            return
+        LOG.info('Prefetched {0} bytes of image {1} in {2} seconds'.format(
+            self.bytes_downloaded, self.image_info['id'],
+            time.time() - starttime))
+
+
+class _ImageDownload(object):
+    """Iterator over the chunks of an image downloaded over HTTP.
+
+    When CONF.image_download_connections is greater than 1 and the image
+    servers support range requests, the image is fetched over that many
+    parallel connections. Otherwise the first URL in image_info['urls']
+    which answers with a 200 is used, the others are tried in order if it
+    does not. Either way a transfer that breaks off is resumed from the
+    last received byte, see _iter_image_bytes(). The checksum of the image
+    is computed on a separate thread while the chunks are being iterated
+    over, so that it is known as soon as the last chunk has arrived without
+    slowing down the network reads.
+
+    Each checksum algorithm of the image gets its own thread, so several
+    digests are computed in parallel over a single pass on the data.
+
+    Compressed images are decompressed on the fly, see
+    compression.decompress(), and the checksums of the decompressed image
+    are computed as well.
+
+    When image_info has a 'chunk_manifest', the image is fetched by chunks
+    from the agents listed in image_info['peers'] and served to them in
+    return, see _PeerImageDownload.
+
+    The download rate is limited as configured by
+    CONF.image_download_rate_limit or image_info['download_rate_limit'],
+    and its start is delayed by up to CONF.image_download_start_delay
+    seconds.
+
+    Otherwise, what was downloaded of the image by an _ImagePrefetch comes
+    first, and the rest of the image is downloaded from where the prefetch
+    stopped, without delay.
+    """
+
+    def __init__(self, image_info, starttime=None, progress=None):
+        self.image_info = image_info
+        self.starttime = starttime or time.time()
+        self.progress = progress or _ImageProgress()
+        # Number of bytes to download, if known
+        self.size = None
+        self._hashers = self._new_hashers()
+        self._decompressed_hashers = None
+        self._rate_limiter = _download_rate_limiter(image_info)
+        prefetch = _ImagePrefetch.take(image_info)
+        if image_info.get('chunk_manifest') and prefetch is not None:
+            # The chunks are kept for the peers as they are downloaded
+            prefetch.remove()
+            prefetch = None
+        self._content = self._open_prefetched(prefetch)
+        if self._content is not None:
+            return
+        self._delay_start()
+        self._content = self._open_peers() or self._open_ranged()
+        if self._content is not None:
+            return
+
+        urls = image_info['urls']
+        for i, url in enumerate(urls):
+            try:
+                LOG.info("Attempting to download image from {0}".format(url))
+                request = _request_url(image_info, url)
+            except errors.ImageDownloadError as e:
+                failtime = time.time() - self.starttime
+                log_msg = ('Image download failed. URL: {0}; time: {1} '
+                           'seconds. Error: {2}')
+                LOG.warning(log_msg.format(url, failtime, e.details))
+                continue
+            else:
+                if not _is_encoded(request):
+                    last = _last_byte(request, 0)
+                    self.size = None if last is None else last + 1
+                # If the transfer breaks off, resume it from this URL first
+                # and then from the other ones.
+                self._content = _iter_image_bytes(
+                    image_info, urls[i:] + urls[:i], resp=request,
+                    rate_limiter=self._rate_limiter)
+                return
         msg = 'Image download failed for all URLs.'
         raise errors.ImageDownloadError(image_info['id'], msg)
 
+    def _delay_start(self):
+        delay = random.uniform(0, CONF.image_download_start_delay)
+        if delay > 0:
+            LOG.info('Delaying the download of image {0} by {1:.1f} '
+                     'seconds'.format(self.image_info['id'], delay))
+            time.sleep(delay)
+
+    def _open_prefetched(self, prefetch):
+        if prefetch is None:
+            return None
+        if prefetch.complete:
+            LOG.info('Using the prefetched image {0}'.format(
+                self.image_info['id']))
+            self.size = prefetch.size
+            return self._prefetched(prefetch)
+
+        urls = self.image_info['urls']
+        resp = None
+        if prefetch.resumable and prefetch.bytes_downloaded:
+            for url in urls:
+                try:
+                    resp = _request_range(self.image_info, url,
+                                          prefetch.bytes_downloaded)
+                except (requests.RequestException,
+                        errors.ImageDownloadError) as e:
+                    LOG.warning('Unable to resume the prefetched image {0} '
+                                'from {1}: {2}'.format(
+                                    self.image_info['id'], url, e))
+                    continue
+                urls = urls[urls.index(url):] + urls[:urls.index(url)]
+                break
+        if resp is None:
+            prefetch.remove()
+            return None
+        LOG.info('Resuming the prefetched image {0} from byte {1}'.format(
+            self.image_info['id'], prefetch.bytes_downloaded))
+        last = _last_byte(resp, prefetch.bytes_downloaded)
+        self.size = None if last is None else last + 1
+        return self._prefetched(prefetch, _iter_image_bytes(
+            self.image_info, urls, start=prefetch.bytes_downloaded,
+            resp=resp, rate_limiter=self._rate_limiter))
+
+    @staticmethod
+    def _prefetched(prefetch, rest=()):
+        try:
+            for chunk in prefetch.read():
+                yield chunk
+        finally:
+            prefetch.remove()
+        for chunk in rest:
+            yield chunk
+
+    def _open_peers(self):
+        if not self.image_info.get('chunk_manifest'):
+            return None
+        chunks = _ImageChunks.open(self.image_info)
+        peers = self.image_info.get('peers') or []
+        LOG.info('Downloading image {0} in {1} chunks from {2} peers and '
+                 'from {3}'.format(self.image_info['id'],
+                                   len(chunks.checksums), len(peers),
+                                   ', '.join(self.image_info['urls'])))
+        self.size = chunks.size
+        return _PeerImageDownload(self.image_info, chunks, peers,
+                                  max(CONF.image_download_connections, 1),
+                                  self._rate_limiter)
+
+    def _open_ranged(self):
+        connections = CONF.image_download_connections
+        range_size = CONF.image_download_range_size
+        if connections <= 1:
+            return None
+        size, urls = _probe_ranged_urls(self.image_info)
+        if not urls or size <= range_size:
+            LOG.info('Not using a ranged download for image {0}, no URL '
+                     'supports it or the image fits in a single '
+                     'range'.format(self.image_info['id']))
+            return None
+        LOG.info('Downloading image {0} of {1} bytes over {2} connections '
+                 'from {3}'.format(self.image_info['id'], size, connections,
+                                   ', '.join(urls)))
+        self.size = size
+        return _RangedImageDownload(self.image_info, urls, size,
+                                    connections, range_size,
+                                    self._rate_limiter)
+
+    def _new_hashers(self):
+        return [_ImageHasher(self.image_info['id'], algorithm)
+                for algorithm in sorted(_image_checksums(self.image_info))]
+
+    @staticmethod
+    def _hashed(chunks, hashers):
+        for hasher in hashers:
+            hasher.start()
+        try:
+            for chunk in chunks:
+                for hasher in hashers:
+                    hasher.put(chunk)
+                yield chunk
+        finally:
+            for hasher in hashers:
+                hasher.close()
+
+    def _counted(self, chunks):
+        for chunk in chunks:
+            self.progress.downloaded(len(chunk))
+            yield chunk
+
+    def __iter__(self):
+        chunks = self._hashed(self._counted(self._content), self._hashers)
+        compressed_with, chunks = compression.decompress(
+            chunks, self.image_info['id'],
+            self.image_info.get('compression'))
+        if compressed_with is not None:
+            self._decompressed_hashers = self._new_hashers()
+            chunks = self._hashed(chunks, self._decompressed_hashers)
+        for chunk in chunks:
+            yield chunk
+
+    def verify_image(self, image_location):
+        """Check the downloaded data against the image checksums.
+
+        Must be called once all chunks have been iterated over. The
+        checksums of a compressed image may be the ones of the image either
+        as it was downloaded or once decompressed.
+
+        :param image_location: where the image was written to, for logging.
+        :returns: True if the checksums match, False otherwise.
+        """
+        digests = [dict((h.algorithm, h.hexdigest()) for h in self._hashers)]
+        if self._decompressed_hashers is not None:
+            digests.append(dict((h.algorithm, h.hexdigest())
+                                for h in self._decompressed_hashers))
+        return _verify_image(self.image_info, image_location, *digests)
+
+    def hash_throughput(self):
+        """Get the throughput of each checksum algorithm.
+
+        :returns: a dictionary of the hashing throughput in MB per second
+                  by algorithm. Algorithms applied to the decompressed image
+                  have a '-decompressed' suffix.
+        """
+        throughput = dict((h.algorithm, h.throughput())
+                          for h in self._hashers)
+        for hasher in self._decompressed_hashers or []:
+            throughput[hasher.algorithm + '-decompressed'] = (
+                hasher.throughput())
+        return throughput
+
+
+def _stream_image_onto_device(image_info, device, extents=None,
+                              progress=None):
+    """Download an image and write it to device without staging it.
+
+    Raw images are written as they are downloaded, qcow2 images are
+    converted to raw on the fly.
+
+    :param image_info: Image information dictionary.
+    :param device: The device to write the image to, or a list of devices
+                   to write it to at the same time, see _ImageMirror.
+    :param extents: _ImageExtents recording what is written, if any, or a
+                    list of them, one for each device.
+    :param progress: _ImageProgress to report progress to, if any.
+    :raises: ImageDownloadError if the image could not be downloaded or
+             written to the device.
+    :raises: ImageFormatError if the qcow2 image cannot be converted while
+             it is downloaded.
+    :raises: ImageChecksumError if the written image does not match the
+             checksum in image_info.
+    :returns: the hashing throughput of each checksum algorithm, see
+              _ImageDownload.hash_throughput().
+    """
+    starttime = time.time()
+    progress = progress or _ImageProgress()
+    image_download = _ImageDownload(image_info, starttime=starttime,
+                                    progress=progress)
+    progress.start_phase('streaming', image_download.size)
+    if image_info.get('disk_format') == 'qcow2':
+        decoder = qcow2.StreamDecoder(image_info['id'])
+        writes = decoder.decode(image_download)
+    else:
+        writes = ((None, chunk) for chunk in image_download)
+    if isinstance(device, list):
+        writer = _ImageMirror(device, extents, progress)
+    else:
+        writer = _ImageWriter(device, extents, progress)
+    writer.start()
+
+    download_error = None
+    try:
+        for offset, chunk in writes:
+            if writer.error is not None:
+                break
+            writer.put(chunk, offset)
+    except errors.ImageFormatError:
+        raise
+    except Exception as e:
+        download_error = e
+    finally:
+        writer.close()
+
+    if writer.error is not None:
+        msg = 'Unable to write image to device {0}. Error: {1}'.format(
+            device, writer.error)
+        raise errors.ImageDownloadError(image_info['id'], msg)
+    if download_error is not None:
+        msg = 'Unable to stream image to device {0}. Error: {1}'.format(
+            device, download_error)
+        raise errors.ImageDownloadError(image_info['id'], msg)
+
+    totaltime = time.time() - starttime
+    LOG.info('Image {0} streamed onto device {1} in {2} seconds'.format(
+             image_info['id'], device, totaltime))
+
+    progress.start_phase('verifying')
+    if not image_download.verify_image(device):
+        raise errors.ImageChecksumError(image_info['id'])
+    return image_download.hash_throughput()
+
+
+def _download_image(image_info, progress=None):
+    starttime = time.time()
+    progress = progress or _ImageProgress()
+    image_download = _ImageDownload(image_info, starttime=starttime,
+                                    progress=progress)
+    progress.start_phase('downloading', image_download.size)
+
     image_location = _image_location(image_info)
     with open(image_location, 'wb') as f:
         try:
-            for chunk in resp.iter_content(IMAGE_CHUNK_SIZE):
+            for chunk in image_download:
                 f.write(chunk)
         except Exception as e:
             msg = 'Unable to write image to {0}. Error: {1}'.format(
@@ -157,95 +1797,1213 @@ def _download_image(image_info):
     LOG.info("Image downloaded from {0} in {1} seconds".format(image_location,
                                                                totaltime))
 
-    if not _verify_image(image_info, image_location):
+    progress.start_phase('verifying')
+    if not image_download.verify_image(image_location):
         raise errors.ImageChecksumError(image_info['id'])
+    return image_download.hash_throughput()
 
 
-def _verify_image(image_info, image_location):
-    checksum = image_info['checksum']
-    log_msg = 'Verifying image at {0} against MD5 checksum {1}'
-    LOG.debug(log_msg.format(image_location, checksum))
-    hash_ = hashlib.md5()
-    with open(image_location) as image:
-        while True:
-            data = image.read(IMAGE_CHUNK_SIZE)
-            if not data:
-                break
-            hash_.update(data)
-    hash_digest = hash_.hexdigest()
-    if hash_digest == checksum:
-        return True
+def _image_checksums(image_info):
+    """Get the checksums of an image.
+
+    :param image_info: Image information dictionary.
+    :returns: a dictionary of the expected hex digests by algorithm, made of
+              image_info['checksums'] and of image_info['checksum'], which
+              is an MD5 checksum.
+    """
+    checksums = dict((algorithm, digest.lower()) for algorithm, digest
+                     in image_info.get('checksums', {}).items())
+    if image_info.get('checksum'):
+        checksums.setdefault('md5', image_info['checksum'].lower())
+    return checksums
+
+
+def _verify_image(image_info, image_location, *hash_digests):
+    """Compare the digests computed for an image against its checksums.
+
+    :param image_info: Image information dictionary.
+    :param image_location: where the image was written to, for logging.
+    :param hash_digests: dictionaries of hex digests by algorithm computed
+                         over the downloaded image, and over the
+                         decompressed image if it was compressed.
+    :returns: True if all the digests computed over one of the images match
+              the image checksums, else False.
+    """
+    checksums = _image_checksums(image_info)
+    log_msg = 'Verifying image at {0} against checksums {1}'
+    LOG.debug(log_msg.format(image_location, checksums))
+    for digests in hash_digests:
+        if all(digests.get(algorithm) == checksum
+               for algorithm, checksum in checksums.items()):
+            return True
     log_msg = ('Image verification failed. Location: {0};'
                'image hash: {1}; verification hash: {2}')
-    LOG.warning(log_msg.format(image_location, checksum, hash_digest))
+    LOG.warning(log_msg.format(image_location, checksums,
+                               ', '.join(str(d) for d in hash_digests)))
     return False
 
 
+def _load_image_cache_manifest():
+    """Load the manifest of the image last written to the install device.
+
+    :returns: the manifest dictionary, None if there is none.
+    """
+    path = CONF.image_cache_manifest
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            LOG.warning('Unable to read image cache manifest {0}: '
+                        '{1}'.format(path, e))
+    except ValueError as e:
+        LOG.warning('Ignoring corrupt image cache manifest {0}: '
+                    '{1}'.format(path, e))
+    return None
+
+
+def _save_image_cache_manifest(image_info, device, extents):
+    """Record that an image was written to device.
+
+    :param image_info: Image information dictionary.
+    :param device: The device the image was written to.
+    :param extents: _ImageExtents which recorded the image being written.
+    """
+    path = CONF.image_cache_manifest
+    if not path:
+        return
+    manifest = {'image_id': image_info['id'],
+                'checksums': _image_checksums(image_info),
+                'device': device,
+                'written_at': time.time(),
+                'extents': extents.extents,
+                'block_digests': extents.block_digests,
+                'block_size': extents.block_size}
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Replace the manifest atomically, a partial one would be useless
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+    except EnvironmentError as e:
+        LOG.warning('Unable to save image cache manifest {0}: {1}'.format(
+            path, e))
+
+
+def _clear_image_cache_manifest():
+    path = CONF.image_cache_manifest
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            LOG.warning('Unable to remove image cache manifest {0}: '
+                        '{1}'.format(path, e))
+
+
+def _extent_blocks(extents, block_size):
+    """Split the data of extents into blocks, as _ImageExtents does.
+
+    :returns: a list of the (offset, length) parts of the device holding
+              each block.
+    """
+    blocks = []
+    block = []
+    filled = 0
+    for offset, length in extents:
+        while length > 0:
+            part = min(length, block_size - filled)
+            block.append((offset, part))
+            offset += part
+            length -= part
+            filled += part
+            if filled == block_size:
+                blocks.append(block)
+                block = []
+                filled = 0
+    if block:
+        blocks.append(block)
+    return blocks
+
+
+def _open_direct(device):
+    """Open device for reading without going through the page cache.
+
+    Falls back to buffered reads when O_DIRECT is not supported, by tmpfs
+    for instance.
+    """
+    try:
+        fd = os.open(device, os.O_RDONLY | getattr(os, 'O_DIRECT', 0))
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        fd = os.open(device, os.O_RDONLY)
+    return io.open(fd, 'rb', buffering=0)
+
+
+def _read_direct(f, buf, offset, length):
+    """Read a part of a device opened by _open_direct().
+
+    The reads are aligned on IMAGE_DIRECT_IO_ALIGNMENT and go to buf, a
+    buffer with the same alignment.
+
+    :returns: a generator of memoryviews over the data read.
+    """
+    start = offset - offset % IMAGE_DIRECT_IO_ALIGNMENT
+    end = offset + length
+    while start < end:
+        size = min(len(buf), -(-(end - start) // IMAGE_DIRECT_IO_ALIGNMENT)
+                   * IMAGE_DIRECT_IO_ALIGNMENT)
+        f.seek(start)
+        read = f.readinto(memoryview(buf)[:size])
+        if not read:
+            return
+        yield memoryview(buf)[max(offset - start, 0):min(read, end - start)]
+        start += read
+
+
+def _verify_extents(device, extents, block_digests, block_size=None):
+    """Read back data written to a device and check it.
+
+    The blocks recorded by an _ImageExtents are read back with direct I/O
+    by CONF.image_verify_threads threads, each checking the SHA-256 digest
+    of the blocks it reads.
+
+    :param device: The device to check.
+    :param extents: the extents the data was written to, as lists of offset
+                    and length.
+    :param block_digests: the hex digests of the blocks of the data.
+    :param block_size: the size of the blocks of the data,
+                       IMAGE_VERIFY_BLOCK_SIZE by default.
+    :raises: EnvironmentError if the device could not be read.
+    :returns: the sorted list of the indexes of the blocks which do not
+              match their digest.
+    """
+    if block_size is None:
+        block_size = IMAGE_VERIFY_BLOCK_SIZE
+    blocks = _extent_blocks(extents, block_size)
+    if len(blocks) != len(block_digests):
+        return list(range(max(len(blocks), len(block_digests))))
+    indexes = iter(range(len(blocks)))
+    lock = threading.Lock()
+    mismatches = []
+    failures = []
+
+    def check_blocks():
+        # Anonymous maps are aligned on pages, as direct I/O requires. The
+        # map is released along with the views over it once unused.
+        buf = mmap.mmap(-1, IMAGE_VERIFY_BLOCK_SIZE)
+        try:
+            with _open_direct(device) as f:
+                while not failures:
+                    with lock:
+                        index = next(indexes, None)
+                    if index is None:
+                        return
+                    block_hash = hashlib.sha256()
+                    for offset, length in blocks[index]:
+                        for data in _read_direct(f, buf, offset, length):
+                            block_hash.update(data)
+                    if block_hash.hexdigest() != block_digests[index]:
+                        with lock:
+                            mismatches.append(index)
+        except EnvironmentError as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=check_blocks,
+                                name='image-verify-{0}-{1}'.format(
+                                    os.path.basename(device), i))
+               for i in range(max(min(CONF.image_verify_threads,
+                                      len(blocks)), 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+    return sorted(mismatches)
+
+
+def _image_on_device(image_info, device):
+    """Check whether device still holds an image written before.
+
+    The image cache manifest has to describe an image with the same
+    checksums written to device, whatever its ID, and the extents it
+    records have to read back with the same digests.
+
+    :param image_info: Image information dictionary.
+    :param device: The device to check.
+    :returns: True if device holds the image, else False.
+    """
+    manifest = _load_image_cache_manifest()
+    if not manifest or manifest.get('device') != device:
+        return False
+    checksums = _image_checksums(image_info)
+    cached_checksums = manifest.get('checksums') or {}
+    common = set(checksums) & set(cached_checksums)
+    if not common or any(checksums[algorithm] != cached_checksums[algorithm]
+                         for algorithm in common):
+        return False
+
+    starttime = time.time()
+    try:
+        mismatches = _verify_extents(
+            device, manifest['extents'], manifest['block_digests'],
+            manifest.get('block_size', IMAGE_VERIFY_BLOCK_SIZE))
+    except (EnvironmentError, KeyError, TypeError, ValueError) as e:
+        LOG.warning('Unable to check whether image {0} is on device {1}: '
+                    '{2}'.format(image_info['id'], device, e))
+        return False
+
+    if mismatches:
+        LOG.info('Device {0} changed since image {1} was written to it'.format(
+            device, manifest.get('image_id')))
+        return False
+    LOG.info('Device {0} still holds image {1}, written as image {2}, '
+             'checked in {3} seconds'.format(device, image_info['id'],
+                                             manifest.get('image_id'),
+                                             time.time() - starttime))
+    return True
+
+
+def _staged_image_extents(image_info, device):
+    """Find out the extents of device a staged qcow2 image is written to.
+
+    qemu-img leaves no record of what it writes, the staged image is
+    decoded to find out instead.
+
+    :returns: an _ImageExtents, None if the image cannot be decoded.
+    """
+    extents = _ImageExtents(device)
+    decoder = qcow2.StreamDecoder(image_info['id'])
+    extents.start()
+    try:
+        with open(_image_location(image_info), 'rb') as f:
+            chunks = iter(lambda: f.read(IMAGE_CHUNK_SIZE), b'')
+            for offset, data in decoder.decode(chunks):
+                if data:
+                    extents.add(offset, data)
+    except (EnvironmentError, errors.ImageFormatError) as e:
+        LOG.warning('Unable to find out where image {0} was written on '
+                    'device {1}: {2}'.format(image_info['id'], device, e))
+        return None
+    finally:
+        extents.close()
+    return extents
+
+
+def _verify_written_image(image_info, device, extents):
+    """Read back an image written to device and check it.
+
+    :param extents: _ImageExtents which recorded the image being written.
+    :returns: a dictionary for the command result, with whether device
+              holds the image, the number of bytes read back and the time
+              it took, and up to IMAGE_VERIFY_MAX_MISMATCHES byte ranges of
+              device which do not hold what was written, as lists of offset
+              and length.
+    """
+    starttime = time.time()
+    size = sum(length for _offset, length in extents.extents)
+    try:
+        mismatches = _verify_extents(device, extents.extents,
+                                     extents.block_digests,
+                                     extents.block_size)
+    except EnvironmentError as e:
+        LOG.error('Unable to read back image {0} from device {1}: '
+                  '{2}'.format(image_info['id'], device, e))
+        return {'verified': False, 'error': str(e)}
+    blocks = _extent_blocks(extents.extents, extents.block_size)
+    ranges = [list(part) for index in mismatches for part in blocks[index]]
+    totaltime = time.time() - starttime
+    if ranges:
+        LOG.error('Image {0} read back from device {1} differs from what '
+                  'was written in {2} places'.format(image_info['id'],
+                                                     device, len(ranges)))
+    else:
+        LOG.info('Image {0} read back from device {1} in {2} '
+                 'seconds'.format(image_info['id'], device, totaltime))
+    return {'verified': not ranges,
+            'bytes': size,
+            'seconds': round(totaltime, 1),
+            'mismatches': ranges[:IMAGE_VERIFY_MAX_MISMATCHES]}
+
+
+def _write_image_differential(image_info, device, progress=None):
+    """Write only the chunks of an image which device does not hold yet.
+
+    The device is read back by chunks of image_info['chunk_manifest'] in
+    parallel, see _verify_extents(), and the chunks whose SHA-256 digest
+    differs from the manifest are downloaded as byte ranges by
+    CONF.image_download_connections threads and written in place. The rest
+    of the device is left untouched, so redeploying a revision of the image
+    written before only moves the blocks which changed.
+
+    The image checksums cannot be checked without the whole image, the
+    chunk checksums are checked instead.
+
+    :param progress: _ImageProgress to report progress to, if any.
+    :returns: an _ImageExtents of the image, with the digests of its chunks.
+    :raises: ImageDownloadError if a chunk cannot be downloaded or does not
+             match its checksum.
+    :raises: ImageWriteError if the device cannot be read or written.
+    """
+    starttime = time.time()
+    progress = progress or _ImageProgress()
+    manifest = image_info['chunk_manifest']
+    size = manifest['size']
+    chunk_size = manifest['chunk_size']
+    checksums = [c.lower() for c in manifest['checksums']]
+    extents = _ImageExtents(device)
+    extents.extents = [[0, size]]
+    extents.block_digests = checksums
+    extents.block_size = chunk_size
+
+    progress.start_phase('comparing', size)
+    try:
+        indexes = _verify_extents(device, extents.extents, checksums,
+                                  chunk_size)
+    except EnvironmentError as e:
+        raise errors.ImageWriteError(device, None, None, e)
+    changed = sum(min(chunk_size, size - index * chunk_size)
+                  for index in indexes)
+    LOG.info('{0} of the {1} chunks of image {2} differ from what device '
+             '{3} holds, {4} bytes to write'.format(
+                 len(indexes), len(checksums), image_info['id'], device,
+                 changed))
+
+    progress.start_phase('writing_changes', changed)
+    rate_limiter = _download_rate_limiter(image_info)
+    urls = image_info['urls']
+    remaining = iter(indexes)
+    lock = threading.Lock()
+    failures = []
+
+    def write_chunks(f):
+        while not failures:
+            with lock:
+                index = next(remaining, None)
+            if index is None:
+                return
+            start = index * chunk_size
+            end = min(start + chunk_size, size) - 1
+            first = index % len(urls)
+            data = b''.join(_iter_image_bytes(
+                image_info, urls[first:] + urls[:first], start, end,
+                rate_limiter=rate_limiter))
+            progress.downloaded(len(data))
+            if hashlib.sha256(data).hexdigest() != checksums[index]:
+                msg = ('Chunk {0} of the image does not match its checksum '
+                       'in the chunk manifest').format(index)
+                raise errors.ImageDownloadError(image_info['id'], msg)
+            with lock:
+                f.seek(start)
+                f.write(data)
+            progress.written(len(data))
+
+    def run(f):
+        try:
+            write_chunks(f)
+        except Exception as e:
+            failures.append(e)
+
+    try:
+        with open(device, 'r+b') as f:
+            threads = [threading.Thread(target=run, args=(f,),
+                                        name='image-diff-{0}-{1}'.format(
+                                            os.path.basename(device), i))
+                       for i in range(max(min(
+                           CONF.image_download_connections,
+                           len(indexes)), 1))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if not failures:
+                f.flush()
+                os.fsync(f.fileno())
+    except EnvironmentError as e:
+        raise errors.ImageWriteError(device, None, None, e)
+    if failures:
+        if isinstance(failures[0], EnvironmentError):
+            raise errors.ImageWriteError(device, None, None, failures[0])
+        raise failures[0]
+
+    LOG.info('Image {0} written to device {1} by changes in {2} '
+             'seconds'.format(image_info['id'], device,
+                              time.time() - starttime))
+    return extents
+
+
+def _write_and_verify_image(image_info, device, stream, progress=None):
+    """Write an image to device, and read it back if asked to.
+
+    Raw and qcow2 images are streamed straight onto the device when stream
+    is set, otherwise the image is staged in /tmp before being written. The
+    image is also staged when a qcow2 image turns out not to be convertible
+    while streaming it.
+
+    When image_info['verify_after_write'] or CONF.image_verify_after_write
+    is set, the image is read back from the device.
+
+    When image_info['differential_write'] is set, only the chunks of the
+    image which differ from what the device holds are written, see
+    _write_image_differential(), and no checksum is hashed.
+
+    :param progress: _ImageProgress to report progress to, if any.
+    :returns: a tuple of the hashing throughput of each checksum algorithm,
+              see _ImageDownload.hash_throughput(), the outcome of the
+              verification, see _verify_written_image(), None if the image
+              was not read back, and the _ImageExtents of the image.
+    """
+    staged = True
+    if image_info.get('differential_write'):
+        extents = _write_image_differential(image_info, device,
+                                            progress=progress)
+        hash_throughput = {}
+        staged = False
+    elif stream and image_info.get('disk_format') in ('raw', 'qcow2'):
+        extents = _ImageExtents(device)
+        try:
+            hash_throughput = _stream_image_onto_device(
+                image_info, device, extents=extents, progress=progress)
+            staged = False
+        except errors.ImageFormatError as e:
+            LOG.warning('Unable to stream image {0}, downloading it '
+                        'before writing it instead: {1}'.format(
+                            image_info['id'], e.details))
+    if staged:
+        hash_throughput = _download_image(image_info, progress=progress)
+        extents = _ImageExtents(device)
+        _write_image(image_info, device, extents=extents, progress=progress)
+    verify = image_info.get('verify_after_write',
+                            CONF.image_verify_after_write)
+    # Images written by qemu-img leave no record of their extents
+    if (verify and not extents.extents
+            and image_info.get('disk_format') == 'qcow2'):
+        extents = _staged_image_extents(image_info, device) or extents
+
+    verification = None
+    if verify and extents.extents:
+        progress = progress or _ImageProgress()
+        progress.start_phase('reading_back')
+        verification = _verify_written_image(image_info, device, extents)
+    elif verify:
+        LOG.warning('Not reading back image {0} from device {1}, the parts '
+                    'of the device it was written to are unknown'.format(
+                        image_info['id'], device))
+    return hash_throughput, verification, extents
+
+
+def _mirror_and_verify_image(image_info, devices, stream, progress=None):
+    """Write an image to several devices at once, and read it back if asked.
+
+    Like _write_and_verify_image(), but the image is downloaded and checked
+    once and each device is written by its own thread: streamed images go
+    through an _ImageMirror, staged ones are written to the devices in
+    parallel. Devices are read back in parallel as well.
+
+    :param progress: _ImageProgress to report progress to, if any.
+    :returns: a tuple of the hashing throughput of each checksum algorithm,
+              see _ImageDownload.hash_throughput(), and the outcome of the
+              verification, None if the image was not read back. It is
+              verified if it is on all devices, and has the outcome for
+              each device by name, see _verify_written_image().
+    """
+    progress = progress or _ImageProgress()
+    staged = True
+    if stream and image_info.get('disk_format') in ('raw', 'qcow2'):
+        extents = [_ImageExtents(device) for device in devices]
+        try:
+            hash_throughput = _stream_image_onto_device(
+                image_info, devices, extents=extents, progress=progress)
+            staged = False
+        except errors.ImageFormatError as e:
+            LOG.warning('Unable to stream image {0}, downloading it '
+                        'before writing it instead: {1}'.format(
+                            image_info['id'], e.details))
+    if staged:
+        hash_throughput = _download_image(image_info, progress=progress)
+        extents = [_ImageExtents(device) for device in devices]
+        progress.start_phase('writing')
+
+        def write(device, device_extents):
+            _write_image(image_info, device, extents=device_extents,
+                         progress=_ProgressShare(progress))
+
+        _run_per_device(write, devices, extents)
+
+    if not image_info.get('verify_after_write',
+                          CONF.image_verify_after_write):
+        return hash_throughput, None
+    if (not extents[0].extents
+            and image_info.get('disk_format') == 'qcow2'):
+        # The image is written the same way to every device
+        extents = [_staged_image_extents(image_info, device) or
+                   device_extents
+                   for device, device_extents in zip(devices, extents)]
+    if not all(device_extents.extents for device_extents in extents):
+        LOG.warning('Not reading back image {0} from devices {1}, the '
+                    'parts of the devices it was written to are '
+                    'unknown'.format(image_info['id'], ', '.join(devices)))
+        return hash_throughput, None
+
+    progress.start_phase('reading_back')
+
+    def verify(device, device_extents):
+        return _verify_written_image(image_info, device, device_extents)
+
+    verifications = _run_per_device(verify, devices, extents)
+    return hash_throughput, {
+        'verified': all(v['verified'] for v in verifications.values()),
+        'devices': verifications}
+
+
+def _run_per_device(function, devices, extents):
+    """Call function(device, extents) for each device on its own thread.
+
+    :returns: a dictionary of what function returned, by device.
+    :raises: the first error raised by function, once all calls are done.
+    """
+    results = {}
+    failures = []
+
+    def run(device, device_extents):
+        try:
+            results[device] = function(device, device_extents)
+        except Exception as e:
+            LOG.error('Unable to handle image on device {0}: {1}'.format(
+                device, e))
+            failures.append(e)
+
+    threads = [threading.Thread(target=run, args=(device, device_extents),
+                                name='image-mirror-{0}'.format(
+                                    os.path.basename(device)))
+               for device, device_extents in zip(devices, extents)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+    return results
+
+
+def _valid_chunk_manifest(manifest):
+    try:
+        size = manifest['size']
+        chunk_size = manifest['chunk_size']
+        checksums = manifest['checksums']
+    except (TypeError, KeyError):
+        return False
+    if (not isinstance(size, six.integer_types) or size < 0
+            or not isinstance(chunk_size, six.integer_types)
+            or chunk_size <= 0 or not isinstance(checksums, list)):
+        return False
+    return (len(checksums) == -(-size // chunk_size)
+            and all(isinstance(c, six.string_types) and len(c) == 64
+                    for c in checksums))
+
+
+def _make_filesystem(partition, filesystem, label=None):
+    """Make a filesystem, or swap space, on a partition.
+
+    :raises: ImageWriteError if the filesystem cannot be made.
+    """
+    if filesystem == 'swap':
+        command = ['mkswap']
+    else:
+        command = ['mkfs', '-t', filesystem]
+        # Do not ask before overwriting what the partition holds
+        if filesystem in ('ext2', 'ext3', 'ext4'):
+            command.append('-F')
+    if label:
+        command.extend(['-n' if filesystem in ('msdos', 'vfat') else '-L',
+                        label])
+    command.append(partition)
+    LOG.info('Making filesystem with command: {0}'.format(' '.join(command)))
+    try:
+        utils.execute(*command, check_exit_code=[0])
+    except processutils.ProcessExecutionError as e:
+        raise errors.ImageWriteError(partition, e.exit_code, e.stdout,
+                                     e.stderr)
+
+
+def _write_partitions(image_info, device, progress=None):
+    """Partition device and write the partitions of a partition image.
+
+    A new partition table is created as image_info describes it, leaving
+    room at the end of the disk for a configdrive partition. Each
+    partition is then written by its own thread: the image of the partition
+    is streamed onto it, see _write_and_verify_image(), or the filesystem it
+    asks for is made on it, so that the small partitions are written
+    alongside the root one rather than after it.
+
+    :param progress: _ImageProgress to report progress to, if any.
+    :returns: a dictionary of the partitions by name, with their 'path',
+              their 'type', the 'uuid' of their filesystem and, for the
+              ones with an
+              image, its 'hash_throughput' and the outcome of its
+              'verification', see _verify_written_image(), if it was read
+              back.
+    :raises: BlockDeviceError if the partitions cannot be created.
+    :raises: ImageWriteError if a filesystem cannot be made.
+    :raises: the errors of _write_and_verify_image() if an image cannot be
+             written.
+    """
+    starttime = time.time()
+    progress = progress or _ImageProgress()
+    progress.start_phase('partitioning')
+    layout = image_info['partitions']
+    paths = partitions.create_partitions(
+        device, PARTITION_DISK_LABELS[image_info.get('disk_label', 'msdos')],
+        [{'size': (partition['size_mb'] * 1024 * 1024
+                   if partition.get('size_mb') else None),
+          'name': partition['name'],
+          'type': partition.get('type', 'linux'),
+          'bootable': partition.get('bootable', False)}
+         for partition in layout],
+        # Rounding of the start of the configdrive partition included
+        reserve=CONFIGDRIVE_MAX_SIZE + partitions.ALIGNMENT)
+
+    progress.start_phase('writing_partitions')
+    results = dict((partition['name'],
+                    {'path': path, 'type': partition.get('type', 'linux')})
+                   for partition, path in zip(layout, paths))
+    failures = []
+
+    def write_partition(partition, path):
+        result = results[partition['name']]
+        try:
+            if 'image' in partition:
+                hash_throughput, verification, _extents = (
+                    _write_and_verify_image(partition['image'], path, True,
+                                            _ProgressShare(progress)))
+                result['hash_throughput'] = hash_throughput
+                if verification is not None:
+                    result['verification'] = verification
+            elif 'filesystem' in partition:
+                _make_filesystem(path, partition['filesystem'],
+                                 partition.get('label'))
+            result['uuid'] = partitions.probe_filesystem(path)[1]
+        except Exception as e:
+            LOG.error('Unable to write partition {0} at {1}: {2}'.format(
+                partition['name'], path, e))
+            failures.append(e)
+
+    threads = [threading.Thread(target=write_partition,
+                                args=(partition, path),
+                                name='partition-{0}'.format(
+                                    partition['name']))
+               for partition, path in zip(layout, paths)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+    LOG.info('Partitions of image {0} written to device {1} in {2} '
+             'seconds'.format(image_info['id'], device,
+                              time.time() - starttime))
+    return results
+
+
+def _validate_partitions(ext, image_info, configdrive=None, **kwargs):
+    """Validate the information of a partition image.
+
+    Partition images have an 'id', the 'disk_label' of the partition table
+    to create, 'msdos' or 'gpt', and a list of 'partitions' laid out in
+    order from the start of the disk. Each partition has a 'name' and a
+    'size_mb', which the last one may leave out to take the rest of the
+    disk, and optionally a 'type', one of partitions.PARTITION_TYPES,
+    whether it is 'bootable' and either the information of the 'image' to
+    write to it or the 'filesystem' to make on it, with its 'label'. The
+    partition named 'root' is the root partition.
+    """
+    if 'id' not in image_info:
+        raise errors.InvalidCommandParamsError(
+            'Image is missing \'id\' field.')
+    for field in ('target_devices', 'mirror_root_device'):
+        if field in image_info:
+            raise errors.InvalidCommandParamsError(
+                'Partition images cannot be written to several devices, '
+                'image \'{0}\' is not supported.'.format(field))
+    if image_info.get('disk_label', 'msdos') not in PARTITION_DISK_LABELS:
+        raise errors.InvalidCommandParamsError(
+            'Image \'disk_label\' must be one of {0}.'.format(
+                ', '.join(sorted(PARTITION_DISK_LABELS))))
+    label = PARTITION_DISK_LABELS[image_info.get('disk_label', 'msdos')]
+
+    layout = image_info['partitions']
+    if (not isinstance(layout, list) or not layout
+            or not all(isinstance(p, dict) for p in layout)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'partitions\' must be a list with at least one '
+            'partition.')
+    # The configdrive partition is added after the ones of the image
+    if label == 'dos' and len(layout) + (configdrive is not None) > 4:
+        raise errors.InvalidCommandParamsError(
+            'An msdos partition table holds at most 4 partitions, including '
+            'the configdrive one.')
+    names = set()
+    for index, partition in enumerate(layout):
+        name = partition.get('name')
+        if not isinstance(name, six.string_types) or not name:
+            raise errors.InvalidCommandParamsError(
+                'Partition {0} must have a non-empty \'name\'.'.format(
+                    index + 1))
+        if name in names:
+            raise errors.InvalidCommandParamsError(
+                'Partition name \'{0}\' is used more than once.'.format(
+                    name))
+        names.add(name)
+
+        size_mb = partition.get('size_mb')
+        if size_mb is None and index < len(layout) - 1:
+            raise errors.InvalidCommandParamsError(
+                'Only the last partition can take the rest of the disk, '
+                'partition \'{0}\' needs a \'size_mb\'.'.format(name))
+        if size_mb is not None and (
+                not isinstance(size_mb, six.integer_types)
+                or isinstance(size_mb, bool) or size_mb <= 0):
+            raise errors.InvalidCommandParamsError(
+                'Partition \'{0}\' \'size_mb\' must be a positive '
+                'integer.'.format(name))
+
+        ptype = partition.get('type', 'linux')
+        if ptype not in partitions.PARTITION_TYPES:
+            raise errors.InvalidCommandParamsError(
+                'Partition \'{0}\' \'type\' must be one of {1}.'.format(
+                    name, ', '.join(partitions.PARTITION_TYPES)))
+        if ptype == 'bios_grub' and label != 'gpt':
+            raise errors.InvalidCommandParamsError(
+                'Partition \'{0}\' of type bios_grub needs a gpt '
+                '\'disk_label\'.'.format(name))
+        if not isinstance(partition.get('bootable', False), bool):
+            raise errors.InvalidCommandParamsError(
+                'Partition \'{0}\' \'bootable\' must be a '
+                'boolean.'.format(name))
+
+        if 'image' in partition and 'filesystem' in partition:
+            raise errors.InvalidCommandParamsError(
+                'Partition \'{0}\' has both an \'image\' and a '
+                '\'filesystem\'.'.format(name))
+        if 'image' in partition:
+            if (not isinstance(partition['image'], dict)
+                    or 'partitions' in partition['image']):
+                raise errors.InvalidCommandParamsError(
+                    'Partition \'{0}\' \'image\' must be the information '
+                    'of an image.'.format(name))
+            _validate_image_info(ext, partition['image'])
+        for field in ('filesystem', 'label'):
+            value = partition.get(field)
+            if value is not None and (
+                    not isinstance(value, six.string_types) or not value):
+                raise errors.InvalidCommandParamsError(
+                    'Partition \'{0}\' \'{1}\' must be a non-empty '
+                    'string.'.format(name, field))
+
+
 def _validate_image_info(ext, image_info=None, **kwargs):
     image_info = image_info or {}
 
-    for field in ['id', 'urls', 'checksum']:
+    if 'partitions' in image_info:
+        _validate_partitions(ext, image_info, **kwargs)
+        return
+
+    for field in ['id', 'urls']:
         if field not in image_info:
             msg = 'Image is missing \'{0}\' field.'.format(field)
             raise errors.InvalidCommandParamsError(msg)
+    if 'checksum' not in image_info and 'checksums' not in image_info:
+        raise errors.InvalidCommandParamsError(
+            'Image is missing \'checksum\' or \'checksums\' field.')
 
     if type(image_info['urls']) != list or not image_info['urls']:
         raise errors.InvalidCommandParamsError(
             'Image \'urls\' must be a list with at least one element.')
 
-    if (not isinstance(image_info['checksum'], six.string_types)
+    if 'checksum' in image_info and (
+            not isinstance(image_info['checksum'], six.string_types)
             or not image_info['checksum']):
         raise errors.InvalidCommandParamsError(
             'Image \'checksum\' must be a non-empty string.')
 
+    if 'checksums' in image_info:
+        checksums = image_info['checksums']
+        if not isinstance(checksums, dict) or not checksums:
+            raise errors.InvalidCommandParamsError(
+                'Image \'checksums\' must be a non-empty dictionary of '
+                'digests by algorithm.')
+        for algorithm, digest in checksums.items():
+            if algorithm not in IMAGE_CHECKSUM_ALGORITHMS:
+                raise errors.InvalidCommandParamsError(
+                    'Image checksum algorithm \'{0}\' is not one of '
+                    '{1}.'.format(algorithm,
+                                  ', '.join(IMAGE_CHECKSUM_ALGORITHMS)))
+            if not isinstance(digest, six.string_types) or not digest:
+                raise errors.InvalidCommandParamsError(
+                    'Image {0} checksum must be a non-empty '
+                    'string.'.format(algorithm))
+        if ('checksum' in image_info and 'md5' in checksums
+                and checksums['md5'].lower() !=
+                image_info['checksum'].lower()):
+            raise errors.InvalidCommandParamsError(
+                'Image \'checksum\' and md5 \'checksums\' differ.')
+
+    manifest = image_info.get('chunk_manifest')
+    if manifest is not None and not _valid_chunk_manifest(manifest):
+        raise errors.InvalidCommandParamsError(
+            'Image \'chunk_manifest\' must be a dictionary of the image '
+            '\'size\', the \'chunk_size\' it is split into and the '
+            'SHA-256 \'checksums\' of its chunks.')
+    peers = image_info.get('peers')
+    if peers is not None and (
+            not isinstance(peers, list) or manifest is None
+            or not all(isinstance(p, six.string_types) for p in peers)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'peers\' must be a list of agent URLs, along with a '
+            '\'chunk_manifest\'.')
+
+    if not isinstance(image_info.get('verify_after_write', False), bool):
+        raise errors.InvalidCommandParamsError(
+            'Image \'verify_after_write\' must be a boolean.')
+
+    devices = image_info.get('target_devices')
+    if devices is not None and (
+            not isinstance(devices, list) or not devices
+            or not all(isinstance(d, six.string_types) and d
+                       for d in devices)
+            or len(set(devices)) != len(devices)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'target_devices\' must be a list of distinct device '
+            'paths.')
+    if not isinstance(image_info.get('mirror_root_device', False), bool):
+        raise errors.InvalidCommandParamsError(
+            'Image \'mirror_root_device\' must be a boolean.')
+    if devices is not None and image_info.get('mirror_root_device'):
+        raise errors.InvalidCommandParamsError(
+            'Image \'target_devices\' and \'mirror_root_device\' cannot be '
+            'used together.')
+
+    differential = image_info.get('differential_write', False)
+    if not isinstance(differential, bool):
+        raise errors.InvalidCommandParamsError(
+            'Image \'differential_write\' must be a boolean.')
+    if differential and (
+            manifest is None or image_info.get('disk_format') != 'raw'
+            or image_info.get('compression') not in (None,
+                                                     compression.NONE)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'differential_write\' needs a \'chunk_manifest\' of an '
+            'uncompressed raw image.')
+    if differential and (len(devices or []) > 1 or
+                         image_info.get('mirror_root_device')):
+        raise errors.InvalidCommandParamsError(
+            'Image \'differential_write\' cannot be used with several '
+            'devices.')
+
+    rate_limit = image_info.get('download_rate_limit')
+    if rate_limit is not None and (
+            not isinstance(rate_limit, six.integer_types + (float,))
+            or isinstance(rate_limit, bool) or rate_limit < 0):
+        raise errors.InvalidCommandParamsError(
+            'Image \'download_rate_limit\' must be a positive number of MB '
+            'per second, or 0 for no limit.')
+
+    image_compression = image_info.get('compression')
+    if (image_compression is not None
+            and image_compression != compression.NONE
+            and not compression.is_available(image_compression)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'compression\' must be \'{0}\' or one of the '
+            'available formats: {1}.'.format(
+                compression.NONE,
+                ', '.join(f for f in compression.FORMATS
+                          if compression.is_available(f))))
+
+
+def _partition_image_result(command_name, msg, results):
+    """Build the result of a command which wrote a partition image.
+
+    :param results: the partitions written, see _write_partitions().
+    :returns: a dictionary with msg prefixed by the command name, the
+              partitions, and the 'root_uuid' and
+              'efi_system_part_uuid' to pass on to
+              ImageExtension.install_bootloader().
+    """
+    result = {'result': '{0}: {1}'.format(command_name, msg),
+              'partitions': results,
+              'root_uuid': None,
+              'efi_system_part_uuid': None}
+    for name, partition in results.items():
+        if name == 'root':
+            result['root_uuid'] = partition.get('uuid')
+        if partition['type'] == 'efi':
+            result['efi_system_part_uuid'] = partition.get('uuid')
+    return result
+
+
+def _image_command_result(command_name, msg, hash_throughput,
+                          verification=None):
+    """Build the result of a command which may have downloaded an image.
+
+    :param command_name: Name of the command.
+    :param msg: Result message.
+    :param hash_throughput: Hashing throughput by checksum algorithm if the
+                            image was downloaded, else None.
+    :param verification: Outcome of reading back the image written, see
+                         _verify_written_image(), if it was.
+    :returns: msg if the image was not downloaded, otherwise a dictionary
+              with msg prefixed by the command name, like the agent does
+              for result messages, the hashing throughput and the outcome
+              of the verification if any.
+    """
+    if hash_throughput is None:
+        return msg
+    result = {'result': '{0}: {1}'.format(command_name, msg),
+              'hash_throughput': hash_throughput}
+    if verification is not None:
+        result['verification'] = verification
+    return result
+
+
+def _prefetch_image_info(node):
+    """Find the image a node is likely to be deployed with.
+
+    This is CONF.image_prefetch_url, or, when CONF.image_prefetch is set,
+    the image URL in the instance information of the node.
+
+    :param node: the node, as returned by the lookup.
+    :returns: an image information dictionary, None if no image is known.
+    """
+    if CONF.image_prefetch_url:
+        return {'id': CONF.image_prefetch_url,
+                'urls': [CONF.image_prefetch_url]}
+    instance_info = (node or {}).get('instance_info') or {}
+    if not CONF.image_prefetch or not instance_info.get('image_url'):
+        return None
+    image_info = {'id': (instance_info.get('image_source') or
+                         instance_info['image_url']),
+                  'urls': [instance_info['image_url']]}
+    if instance_info.get('image_checksum'):
+        image_info['checksum'] = instance_info['image_checksum']
+    return image_info
+
+
+def _install_devices(image_info):
+    """Find the devices to write an image to.
+
+    These are image_info['target_devices'], all the devices matching the
+    root device hints when image_info['mirror_root_device'] is set, or else
+    the OS install device.
+
+    :returns: a list of device names.
+    """
+    if image_info.get('target_devices'):
+        return list(image_info['target_devices'])
+    if image_info.get('mirror_root_device'):
+        return hardware.dispatch_to_managers('get_os_install_devices')
+    return [hardware.dispatch_to_managers('get_os_install_device')]
+
 
 class StandbyExtension(base.BaseAgentExtension):
     def __init__(self, agent=None):
         super(StandbyExtension, self).__init__(agent=agent)
 
         self.cached_image_id = None
+        # Partitions of the partition image cached, see _write_partitions()
+        self.cached_partitions = None
+
+    def _cache_and_write_partitions(self, image_info, device, progress=None):
+        """Write a partition image to device and remember it as cached.
+
+        It is not remembered as cached if one of its partitions was read
+        back and differs from what was written.
+
+        :param progress: _ImageProgress to report progress to, if any.
+        :returns: the partitions written, see _write_partitions().
+        """
+        self.cached_image_id = None
+        self.cached_partitions = None
+        _clear_image_cache_manifest()
+        _ImagePrefetch.drop_unless(
+            [partition['image'] for partition in image_info['partitions']
+             if 'image' in partition])
+        results = _write_partitions(image_info, device, progress=progress)
+        if all(partition.get('verification', {'verified': True})['verified']
+               for partition in results.values()):
+            self.cached_image_id = image_info['id']
+            self.cached_partitions = results
+        return results
+
+    def _cache_and_write_image(self, image_info, devices, progress=None):
+        """Write image_info's image to devices and remember it as cached.
+
+        See _write_and_verify_image(), or _mirror_and_verify_image() when
+        there are several devices, the image is streamed when
+        image_info['stream_raw_images'] is set. It is not remembered as
+        cached if it was read back and differs from what was written.
+
+        :param progress: _ImageProgress to report progress to, if any.
+        :returns: a tuple of the hashing throughput of each checksum
+                  algorithm, see _ImageDownload.hash_throughput(), and the
+                  outcome of the verification, see _verify_written_image(),
+                  None if the image was not read back.
+        """
+        # Whatever was cached is about to be overwritten, even if the write
+        # fails halfway through.
+        self.cached_image_id = None
+        self.cached_partitions = None
+        _clear_image_cache_manifest()
+        _ImagePrefetch.drop_unless([image_info])
+        if len(devices) > 1:
+            hash_throughput, verification = _mirror_and_verify_image(
+                image_info, devices, image_info.get('stream_raw_images'),
+                progress=progress)
+            # The image cache manifest only records images written to a
+            # single device.
+            if verification is None or verification['verified']:
+                self.cached_image_id = image_info['id']
+            return hash_throughput, verification
+
+        device = devices[0]
+        hash_throughput, verification, extents = _write_and_verify_image(
+            image_info, device, image_info.get('stream_raw_images'),
+            progress=progress)
+        if verification is not None and not verification['verified']:
+            return hash_throughput, verification
+
+        self.cached_image_id = image_info['id']
+        if extents.extents:
+            _save_image_cache_manifest(image_info, device, extents)
+        return hash_throughput, verification
+
+    def get_image_chunk(self, image_id, index):
+        """Read a chunk of an image downloaded with a chunk manifest.
+
+        Lets other agents deploying the same image fetch it from this one,
+        see _PeerImageDownload.
+
+        :returns: the data of the chunk, None if the agent does not hold it.
+        """
+        chunks = _ImageChunks.get(image_id)
+        if chunks is None:
+            return None
+        return chunks.read(index)
+
+    def prefetch_image(self, node=None):
+        """Start downloading the image a node is likely to be deployed with.
+
+        Called once the node is looked up, so that the image is downloaded
+        while the agent waits for the command deploying it, see
+        _ImagePrefetch and _prefetch_image_info().
+
+        :param node: the node, as returned by the lookup.
+        :returns: the _ImagePrefetch started, None if there is no image to
+                  prefetch.
+        """
+        image_info = _prefetch_image_info(node)
+        if image_info is None or image_info['id'] == self.cached_image_id:
+            return None
+        return _ImagePrefetch.start_for(image_info)
+
+    def _image_cached_on_device(self, image_info, devices):
+        """Check the image cache manifest for an image written before.
+
+        Lets the agent find out, after a restart, that the image was
+        already written to a single device.
+        """
+        if len(devices) != 1 or not _image_on_device(image_info, devices[0]):
+            return False
+        self.cached_image_id = image_info['id']
+        return True
 
     @base.async_command('cache_image', _validate_image_info)
     def cache_image(self, image_info=None, force=False):
         LOG.debug('Caching image %s', image_info['id'])
-        device = hardware.dispatch_to_managers('get_os_install_device')
+        devices = _install_devices(image_info)
+        device = ', '.join(devices)
 
         result_msg = 'image ({0}) already present on device {1}'
+        hash_throughput = verification = partition_results = None
 
-        if self.cached_image_id != image_info['id'] or force:
+        if 'partitions' in image_info:
+            if force or self.cached_image_id != image_info['id']:
+                LOG.debug('Already had %s cached, overwriting',
+                          self.cached_image_id)
+                partition_results = self._cache_and_write_partitions(
+                    image_info, device,
+                    progress=_ImageProgress(base.current_command()))
+                result_msg = 'image ({0}) cached to device {1}'
+        elif force or (self.cached_image_id != image_info['id'] and
+                       not self._image_cached_on_device(image_info,
+                                                        devices)):
             LOG.debug('Already had %s cached, overwriting',
                       self.cached_image_id)
-            _download_image(image_info)
-            _write_image(image_info, device)
-            self.cached_image_id = image_info['id']
+            hash_throughput, verification = self._cache_and_write_image(
+                image_info, devices,
+                progress=_ImageProgress(base.current_command()))
             result_msg = 'image ({0}) cached to device {1}'
 
         msg = result_msg.format(image_info['id'], device)
         LOG.info(msg)
-        return msg
+        if partition_results is not None:
+            return _partition_image_result('cache_image', msg,
+                                           partition_results)
+        return _image_command_result('cache_image', msg, hash_throughput,
+                                     verification)
 
     @base.async_command('prepare_image', _validate_image_info)
     def prepare_image(self,
                       image_info=None,
                       configdrive=None):
         LOG.debug('Preparing image %s', image_info['id'])
-        device = hardware.dispatch_to_managers('get_os_install_device')
+        devices = _install_devices(image_info)
+        device = ', '.join(devices)
+
+        progress = _ImageProgress(base.current_command())
 
         # don't write image again if already cached
-        if self.cached_image_id != image_info['id']:
+        hash_throughput = verification = partition_results = None
+        if 'partitions' in image_info:
+            partition_results = self.cached_partitions
+            if self.cached_image_id != image_info['id']:
+                LOG.debug('Already had %s cached, overwriting',
+                          self.cached_image_id)
+                partition_results = self._cache_and_write_partitions(
+                    image_info, device, progress=progress)
+        elif (self.cached_image_id != image_info['id'] and
+                not self._image_cached_on_device(image_info, devices)):
             LOG.debug('Already had %s cached, overwriting',
                       self.cached_image_id)
-            _download_image(image_info)
-            _write_image(image_info, device)
-            self.cached_image_id = image_info['id']
+            hash_throughput, verification = self._cache_and_write_image(
+                image_info, devices, progress=progress)
 
         if configdrive is not None:
-            _write_configdrive_to_partition(configdrive, device)
+            # Every copy of the image boots with the configdrive
+            for target in devices:
+                _write_configdrive_to_partition(configdrive, target,
+                                                progress=progress)
 
         msg = ('image ({0}) written to device {1}'.format(
             image_info['id'], device))
         LOG.info(msg)
-        return msg
+        if partition_results is not None:
+            return _partition_image_result('prepare_image', msg,
+                                           partition_results)
+        return _image_command_result('prepare_image', msg, hash_throughput,
+                                     verification)
 
     def _run_shutdown_script(self, parameter):
         script = _path_to_script('shell/shutdown.sh')
@@ -13,12 +13,15 @@
 # limitations under the License.
 
 import abc
-import functools
 import os
 import shlex
+import sys
+import threading
+import time
 
 import netifaces
 from oslo_concurrency import processutils
+from oslo_config import cfg
 from oslo_log import log
 from oslo_utils import units
 import psutil
@@ -31,7 +34,20 @@ from ironic_python_agent import errors
 from ironic_python_agent import utils
 
 _global_managers = None
+# Extensions _global_managers was loaded from, whatever their support
+_global_extensions = None
+# Whether hardware was plugged or unplugged since support was evaluated
+_support_stale = False
+# Managers implementing each method, for the current _global_managers
+_dispatch_candidates = (None, {})
+# Function called with the timing of each call dispatched to a manager,
+# _log_dispatch if None
+_dispatch_tracer = None
+_dispatch_lock = threading.Lock()
 LOG = log.getLogger()
+# NOTE: the agent options are registered by the cmd module, which cannot be
+# imported here as it imports this module through the agent module.
+CONF = cfg.CONF
 
 
 class HardwareSupport(object):
@@ -93,6 +109,202 @@ class Memory(encoding.Serializable):
         self.total = total
 
 
+class _InventoryCache(object):
+    """Cache of the sections of a hardware inventory, kept fresh by udev.
+
+    Each section, like 'disks' or 'interfaces', is computed on first use
+    and kept until a pyudev monitor reports an add, remove or change event
+    in the udev subsystem it is made of, which drops that section only.
+    Nothing is cached when the monitor cannot be started, since changes
+    would then go unnoticed.
+    """
+
+    # Section of the inventory made of the devices of each udev subsystem
+    SUBSYSTEM_SECTIONS = {'block': 'disks', 'net': 'interfaces',
+                          'cpu': 'cpu', 'memory': 'memory'}
+
+    def __init__(self):
+        self._sections = {}
+        # Number of times each section was dropped, so that a section
+        # computed while an event arrived is not kept
+        self._generations = dict((section, 0) for section
+                                 in self.SUBSYSTEM_SECTIONS.values())
+        self._lock = threading.Lock()
+        self._monitoring = None
+
+    def _start_monitor(self):
+        """Start the thread handling udev events.
+
+        :returns: whether the monitor is running.
+        """
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            for subsystem in self.SUBSYSTEM_SECTIONS:
+                monitor.filter_by(subsystem)
+            monitor.start()
+        except Exception as e:
+            LOG.warning('Unable to monitor udev events, the hardware '
+                        'inventory is not cached: %s', e)
+            return False
+        thread = threading.Thread(target=self._watch, args=(monitor,),
+                                  name='inventory-udev-monitor')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _watch(self, monitor):
+        try:
+            for device in iter(monitor.poll, None):
+                self.handle_event(device.action, device.subsystem,
+                                  device.device_type)
+        except Exception as e:
+            LOG.warning('Stopped monitoring udev events, the hardware '
+                        'inventory is no longer cached: %s', e)
+        with self._lock:
+            self._monitoring = False
+            self._sections.clear()
+
+    def handle_event(self, action, subsystem, device_type=None):
+        """Drop the section of the inventory a udev event affects."""
+        section = self.SUBSYSTEM_SECTIONS.get(subsystem)
+        # Partitions are not part of the disks section
+        if (section is None or action not in ('add', 'remove', 'change')
+                or (subsystem == 'block' and device_type != 'disk')):
+            return
+        LOG.debug('udev %(action)s event in %(subsystem)s, dropping the '
+                  'cached %(section)s', {'action': action,
+                                         'subsystem': subsystem,
+                                         'section': section})
+        with self._lock:
+            self._sections.pop(section, None)
+            self._generations[section] += 1
+        # Support of hardware managers may depend on the plugged hardware
+        if action != 'change':
+            _invalidate_hardware_support()
+
+    def get(self, section, compute):
+        """Get a section of the inventory.
+
+        :param section: name of the section.
+        :param compute: function computing the section when it is not
+                        cached.
+        :returns: the section, a copy of it if it is a list.
+        """
+        with self._lock:
+            if self._monitoring is None:
+                self._monitoring = self._start_monitor()
+            if not self._monitoring:
+                cached = False
+            else:
+                cached = section in self._sections
+                value = self._sections.get(section)
+                generation = self._generations[section]
+        if not cached:
+            value = compute()
+            with self._lock:
+                if (self._monitoring
+                        and self._generations[section] == generation):
+                    self._sections[section] = value
+        return list(value) if isinstance(value, list) else value
+
+
+def _read_sysfs_attribute(path, attribute):
+    """Read an attribute of a sysfs device.
+
+    :param path: path of the device in sysfs.
+    :param attribute: path of the attribute relative to the device.
+    :returns: the stripped value of the attribute, or None if the device
+              does not have it.
+    """
+    try:
+        with open(os.path.join(path, attribute)) as f:
+            return f.read().strip()
+    except EnvironmentError:
+        return None
+
+
+def _collect_sections(sections, threads, timeout):
+    """Run the functions collecting sections of an inventory concurrently.
+
+    Each section can take up to timeout seconds from when it starts. The
+    thread of a section taking longer is left running and replaced, so that
+    the other sections still get up to threads threads.
+
+    :param sections: a dictionary of functions by section name.
+    :param threads: the number of threads running the functions, at least
+                    one whatever is given.
+    :param timeout: the number of seconds each function can take.
+    :raises: the exception of the first section in failure.
+    :returns: a tuple of a dictionary of the sections collected in time and
+              a dictionary of the seconds each section took, by name.
+    """
+    condition = threading.Condition()
+    pending = sorted(sections)
+    started = {}
+    finished = {}
+    timings = {}
+
+    def collect():
+        while True:
+            with condition:
+                if not pending:
+                    return
+                name = pending.pop(0)
+                started[name] = time.time()
+                condition.notify()
+            try:
+                outcome = (sections[name](), None)
+            except Exception:
+                outcome = (None, sys.exc_info())
+            with condition:
+                timings[name] = round(time.time() - started[name], 3)
+                finished[name] = outcome
+                condition.notify()
+
+    def start_thread():
+        thread = threading.Thread(target=collect, name='hardware-info')
+        thread.daemon = True
+        thread.start()
+
+    start = time.time()
+    for i in range(min(max(1, threads), len(sections))):
+        start_thread()
+    timed_out = set()
+    with condition:
+        while len(finished) + len(timed_out) < len(sections):
+            now = time.time()
+            deadlines = []
+            expired = False
+            for name, started_at in started.items():
+                if name in finished or name in timed_out:
+                    continue
+                if now - started_at < timeout:
+                    deadlines.append(started_at + timeout)
+                    continue
+                LOG.warning('Collecting %(section)s took more than '
+                            '%(timeout)s seconds, leaving it out of the '
+                            'hardware inventory',
+                            {'section': name, 'timeout': timeout})
+                timed_out.add(name)
+                timings[name] = round(now - started_at, 3)
+                expired = True
+                if pending:
+                    start_thread()
+            if not expired:
+                condition.wait(min(deadlines) - now if deadlines else None)
+        results = dict(finished)
+        timings = dict(timings)
+
+    for name in sorted(results):
+        if results[name][1] is not None:
+            six.reraise(*results[name][1])
+    LOG.info('Collected the hardware inventory in %(seconds).2f seconds, '
+             'seconds by section: %(timings)s',
+             {'seconds': time.time() - start, 'timings': timings})
+    return dict((name, result[0]) for name, result in results.items()
+                if name not in timed_out), timings
+
+
 @six.add_metaclass(abc.ABCMeta)
 class HardwareManager(object):
     @abc.abstractmethod
@@ -114,6 +326,17 @@ class HardwareManager(object):
     def get_os_install_device(self):
         raise errors.IncompatibleHardwareMethodError
 
+    def get_os_install_devices(self):
+        """Get all the devices the OS is to be installed to.
+
+        Used to write the same image to several disks, like the members of
+        a software RAID-1 root. These are all the devices matching the root
+        device hints.
+
+        :returns: a list of device names.
+        """
+        raise errors.IncompatibleHardwareMethodError
+
     def erase_block_device(self, node, block_device):
         """Attempt to erase a block device.
 
@@ -154,12 +377,39 @@ class HardwareManager(object):
         for block_device in block_devices:
             self.erase_block_device(node, block_device)
 
+    def get_hardware_info_sections(self):
+        """Get the functions collecting each section of the inventory.
+
+        Hardware managers can add sections to the inventory by adding them
+        to the dictionary returned by their parent class.
+
+        :returns: a dictionary of functions taking no argument, by name of
+                  the section of the inventory they return.
+        """
+        return {
+            'interfaces': self.list_network_interfaces,
+            'cpu': self.get_cpus,
+            'disks': self.list_block_devices,
+            'memory': self.get_memory,
+        }
+
     def list_hardware_info(self):
-        hardware_info = {}
-        hardware_info['interfaces'] = self.list_network_interfaces()
-        hardware_info['cpu'] = self.get_cpus()
-        hardware_info['disks'] = self.list_block_devices()
-        hardware_info['memory'] = self.get_memory()
+        """Collect the inventory of the hardware.
+
+        The sections are collected concurrently by up to
+        CONF.hardware_info_threads threads. A section taking more than
+        CONF.hardware_info_section_timeout seconds is left out of the
+        inventory.
+
+        :returns: a dictionary of the sections returned by
+                  get_hardware_info_sections, with the number of seconds
+                  each took to collect in 'timings'.
+        """
+        sections = self.get_hardware_info_sections()
+        hardware_info, timings = _collect_sections(
+            sections, CONF.hardware_info_threads,
+            CONF.hardware_info_section_timeout)
+        hardware_info['timings'] = timings
         return hardware_info
 
     def get_clean_steps(self, node, ports):
@@ -230,12 +480,22 @@ class HardwareManager(object):
         }
 
 
+# Methods of HardwareManager only raising IncompatibleHardwareMethodError,
+# managers not overriding them are not dispatched to
+_UNSUPPORTED_METHODS = frozenset(
+    six.get_unbound_function(getattr(HardwareManager, name))
+    for name in ('list_network_interfaces', 'get_cpus', 'list_block_devices',
+                 'get_memory', 'get_os_install_device',
+                 'get_os_install_devices', 'erase_block_device'))
+
+
 class GenericHardwareManager(HardwareManager):
     HARDWARE_MANAGER_NAME = 'generic_hardware_manager'
     HARDWARE_MANAGER_VERSION = '1.0'
 
     def __init__(self):
         self.sys_path = '/sys'
+        self._inventory = _InventoryCache()
 
     def evaluate_hardware_support(self):
         return HardwareSupport.GENERIC
@@ -262,6 +522,10 @@ class GenericHardwareManager(HardwareManager):
         return os.path.exists(device_path)
 
     def list_network_interfaces(self):
+        return self._inventory.get('interfaces',
+                                   self._list_network_interfaces)
+
+    def _list_network_interfaces(self):
         iface_names = os.listdir('{0}/class/net'.format(self.sys_path))
         return [self._get_interface_info(name)
                 for name in iface_names
@@ -276,6 +540,9 @@ class GenericHardwareManager(HardwareManager):
             raise AttributeError("Only psutil versions 1 and 2 supported")
 
     def get_cpus(self):
+        return self._inventory.get('cpu', self._get_cpus)
+
+    def _get_cpus(self):
         model = None
         freq = None
         with open('/proc/cpuinfo') as f:
@@ -291,6 +558,9 @@ class GenericHardwareManager(HardwareManager):
         return CPU(model, freq, self._get_cpu_count())
 
     def get_memory(self):
+        return self._inventory.get('memory', self._get_memory)
+
+    def _get_memory(self):
         # psutil returns a long, so we force it to an int
         if psutil.version_info[0] == 1:
             return Memory(int(psutil.TOTAL_PHYMEM))
@@ -300,6 +570,67 @@ class GenericHardwareManager(HardwareManager):
     def list_block_devices(self):
         """List all physical block devices
 
+        The list is cached until udev reports a change to the disks, see
+        _InventoryCache.
+
+        :return: A list of BlockDevices
+        """
+        return self._inventory.get('disks', self._list_block_devices)
+
+    def _list_block_devices(self):
+        """List all physical block devices from sysfs, or else with lsblk
+
+        :return: A list of BlockDevices
+        """
+        try:
+            return self._list_block_devices_sysfs()
+        except EnvironmentError as e:
+            LOG.warning('Unable to list block devices from sysfs, falling '
+                        'back to lsblk: %s', e)
+            return self._list_block_devices_lsblk()
+
+    def _list_block_devices_sysfs(self):
+        """List all physical block devices by reading sysfs
+
+        The devices are those lsblk lists with the switches below, in the
+        same order of device numbers: the entries of /sys/block except RAM
+        disks (major number 1) and devices whose type is not disk, which
+        are device mapper, loop and md devices and SCSI devices of another
+        type than 0. Other devices also have a device/type attribute, like
+        "MMC" or "SD" for MMC cards, which are disks.
+
+        :raises: EnvironmentError if /sys/block cannot be listed.
+        :return: A list of BlockDevices
+        """
+        block_path = os.path.join(self.sys_path, 'block')
+        devices = []
+        for name in os.listdir(block_path):
+            path = os.path.join(block_path, name)
+            dev = _read_sysfs_attribute(path, 'dev')
+            size = _read_sysfs_attribute(path, 'size')
+            # Devices removed while listing have no attributes
+            if dev is None or size is None:
+                continue
+            number = tuple(int(n) for n in dev.split(':'))
+            if number[0] == 1 or name.startswith(('dm-', 'loop', 'md')):
+                continue
+            # Only SCSI device types are numbers
+            device_type = _read_sysfs_attribute(path, 'device/type') or '0'
+            if device_type.isdigit() and device_type != '0':
+                continue
+            rotational = _read_sysfs_attribute(path, 'queue/rotational')
+            # sysfs sizes are in 512 bytes sectors whatever the block size
+            devices.append((number, BlockDevice(
+                name='/dev/' + name,
+                model=_read_sysfs_attribute(path, 'device/model') or '',
+                size=int(size) * 512,
+                rotational=bool(int(rotational or 0)))))
+        devices.sort(key=lambda device: device[0])
+        return [device for number, device in devices]
+
+    def _list_block_devices_lsblk(self):
+        """List all physical block devices with lsblk
+
         The switches we use for lsblk: P for KEY="value" output,
         b for size output in bytes, d to exclude dependant devices
         (like md or dm devices), i to ensure ascii characters only,
@@ -342,9 +673,13 @@ class GenericHardwareManager(HardwareManager):
         except IOError:
             LOG.warning("Can't find the device vendor for device %s", dev)
 
-    def get_os_install_device(self):
+    def _install_device_candidates(self, root_device_hints):
+        """Iterate over the names of the devices the OS can be installed to.
+
+        These are the devices matching the root device hints, or the first
+        device larger than 4GB if no hints are passed.
+        """
         block_devices = self.list_block_devices()
-        root_device_hints = utils.parse_root_device_hints()
 
         if not root_device_hints:
             # If no hints are passed find the first device larger than
@@ -354,7 +689,8 @@ class GenericHardwareManager(HardwareManager):
             block_devices.sort(key=lambda device: device.size)
             for device in block_devices:
                 if device.size >= (4 * pow(1024, 3)):
-                    return device.name
+                    yield device.name
+                    return
         else:
 
             def match(hint, current_value, device):
@@ -422,11 +758,23 @@ class GenericHardwareManager(HardwareManager):
                     if not match('vendor', vendor, dev.name):
                         continue
 
-                return dev.name
+                yield dev.name
 
-            else:
-                raise errors.DeviceNotFound("No suitable device was found for "
-                    "deployment using these hints %s" % root_device_hints)
+    def get_os_install_device(self):
+        root_device_hints = utils.parse_root_device_hints()
+        for device in self._install_device_candidates(root_device_hints):
+            return device
+        if root_device_hints:
+            raise errors.DeviceNotFound("No suitable device was found for "
+                "deployment using these hints %s" % root_device_hints)
+
+    def get_os_install_devices(self):
+        root_device_hints = utils.parse_root_device_hints()
+        devices = list(self._install_device_candidates(root_device_hints))
+        if not devices:
+            raise errors.DeviceNotFound("No suitable device was found for "
+                "deployment using these hints %s" % root_device_hints)
+        return devices
 
     def erase_block_device(self, node, block_device):
 
@@ -539,10 +887,41 @@ class GenericHardwareManager(HardwareManager):
         return True
 
 
-def _compare_extensions(ext1, ext2):
-    mgr1 = ext1.obj
-    mgr2 = ext2.obj
-    return mgr2.evaluate_hardware_support() - mgr1.evaluate_hardware_support()
+def _sort_managers(extensions):
+    """Sort hardware managers by their support of the hardware.
+
+    :param extensions: the stevedore extensions of the hardware managers.
+    :returns: Priority-sorted list of the hardware managers supporting the
+              hardware.
+    :raises HardwareManagerNotFound: if no manager supports the hardware
+    """
+    # Support is evaluated once for each manager, it can be slow to probe
+    support = [(extension, extension.obj.evaluate_hardware_support())
+               for extension in extensions]
+    # The sort is stable, managers with the same support keep their order
+    support.sort(key=lambda s: s[1], reverse=True)
+
+    preferred_managers = []
+    for extension, level in support:
+        if level > 0:
+            preferred_managers.append(extension.obj)
+            LOG.info('Hardware manager found: {0}'.format(
+                extension.entry_point_target))
+
+    if not preferred_managers:
+        raise errors.HardwareManagerNotFound
+
+    return preferred_managers
+
+
+def _invalidate_hardware_support():
+    """Evaluate the support of hardware managers again on next dispatch.
+
+    Called when hardware is plugged or unplugged.
+    """
+    global _support_stale
+    with _dispatch_lock:
+        _support_stale = True
 
 
 def _get_managers():
@@ -550,40 +929,109 @@ def _get_managers():
 
     Use stevedore to find all eligible hardware managers, sort them based on
     self-reported (via evaluate_hardware_support()) priorities, and return them
-    in a list. The resulting list is cached in _global_managers.
+    in a list. The resulting list is cached in _global_managers, until
+    hardware is plugged or unplugged.
 
     :returns: Priority-sorted list of hardware managers
     :raises HardwareManagerNotFound: if no valid hardware managers found
     """
-    global _global_managers
-
-    if not _global_managers:
+    global _global_managers, _global_extensions, _support_stale
+
+    with _dispatch_lock:
+        if _global_managers and not (_support_stale and
+                                     _global_extensions is not None):
+            return _global_managers
+        extensions = _global_extensions if _global_managers else None
+        # Hardware changing from now on is seen by the next dispatch
+        _support_stale = False
+
+    # Managers can dispatch methods while they are loaded or evaluate their
+    # support, so the lock is not held meanwhile. Those dispatches use the
+    # previous managers, if any.
+    if extensions is None:
         extension_manager = stevedore.ExtensionManager(
             namespace='ironic_python_agent.hardware_managers',
             invoke_on_load=True)
-
         # There will always be at least one extension available (the
         # GenericHardwareManager).
-        if six.PY2:
-            extensions = sorted(extension_manager, _compare_extensions)
-        else:
-            extensions = sorted(extension_manager,
-                            key=functools.cmp_to_key(_compare_extensions))
+        extensions = list(extension_manager)
+    else:
+        LOG.info('Hardware changed, evaluating the support of hardware '
+                 'managers again')
+    managers = _sort_managers(extensions)
 
-        preferred_managers = []
+    with _dispatch_lock:
+        _global_managers = managers
+        _global_extensions = extensions
+    return managers
 
-        for extension in extensions:
-            if extension.obj.evaluate_hardware_support() > 0:
-                preferred_managers.append(extension.obj)
-                LOG.info('Hardware manager found: {0}'.format(
-                    extension.entry_point_target))
 
-        if not preferred_managers:
-            raise errors.HardwareManagerNotFound
+def _implements(manager, method):
+    function = getattr(manager, method, None)
+    if not function:
+        return False
+    return getattr(function, '__func__', None) not in _UNSUPPORTED_METHODS
 
-        _global_managers = preferred_managers
 
-    return _global_managers
+def _get_candidates(method):
+    """Get the hardware managers implementing a method, in priority order.
+
+    The list is kept until the hardware managers change.
+
+    :param method: hardware manager method to dispatch
+    :returns: Priority-sorted list of hardware managers
+    :raises HardwareManagerNotFound: if no valid hardware managers found
+    """
+    global _dispatch_candidates
+
+    managers = _get_managers()
+    with _dispatch_lock:
+        if _dispatch_candidates[0] is not managers:
+            _dispatch_candidates = (managers, {})
+        candidates = _dispatch_candidates[1].get(method)
+        if candidates is None:
+            candidates = []
+            for manager in managers:
+                if _implements(manager, method):
+                    candidates.append(manager)
+                else:
+                    LOG.debug('HardwareManager {0} does not have method {1}'
+                              .format(manager, method))
+            _dispatch_candidates[1][method] = candidates
+        return candidates
+
+
+def _log_dispatch(method, manager, seconds):
+    """Log the time a call dispatched to a hardware manager took."""
+    LOG.debug('Called %(method)s on manager %(manager)s in %(seconds).3f '
+              'seconds', {'method': method, 'manager': manager,
+                          'seconds': seconds})
+
+
+def set_dispatch_tracer(tracer):
+    """Set a function tracing the calls dispatched to hardware managers.
+
+    :param tracer: function called after each call of a method by
+                   dispatch_to_managers and dispatch_to_all_managers, with
+                   the name of the method, the hardware manager and the
+                   number of seconds the call took, or None for the default
+                   one, which logs them at debug level.
+    """
+    global _dispatch_tracer
+    _dispatch_tracer = tracer
+
+
+def _call_manager(manager, method, *args, **kwargs):
+    start = time.time()
+    try:
+        return getattr(manager, method)(*args, **kwargs)
+    finally:
+        tracer = _dispatch_tracer or _log_dispatch
+        try:
+            tracer(method, manager, time.time() - start)
+        except Exception:
+            LOG.exception('Error tracing the call of %(method)s on manager '
+                          '%(manager)s', {'method': method, 'manager': manager})
 
 
 def dispatch_to_all_managers(method, *args, **kwargs):
@@ -606,24 +1054,19 @@ def dispatch_to_all_managers(method, *args, **kwargs):
         manager.
     """
     responses = {}
-    managers = _get_managers()
-    for manager in managers:
-        if getattr(manager, method, None):
-            try:
-                response = getattr(manager, method)(*args, **kwargs)
-            except errors.IncompatibleHardwareMethodError:
-                LOG.debug('HardwareManager {0} does not support {1}'
-                          .format(manager, method))
-                continue
-            except Exception as e:
-                LOG.exception('Unexpected error dispatching %(method)s to '
-                              'manager %(manager)s: %(e)s',
-                              {'method': method, 'manager': manager, 'e': e})
-                raise
-            responses[manager.__class__.__name__] = response
-        else:
-            LOG.debug('HardwareManager {0} does not have method {1}'
+    for manager in _get_candidates(method):
+        try:
+            response = _call_manager(manager, method, *args, **kwargs)
+        except errors.IncompatibleHardwareMethodError:
+            LOG.debug('HardwareManager {0} does not support {1}'
                       .format(manager, method))
+            continue
+        except Exception as e:
+            LOG.exception('Unexpected error dispatching %(method)s to '
+                          'manager %(manager)s: %(e)s',
+                          {'method': method, 'manager': manager, 'e': e})
+            raise
+        responses[manager.__class__.__name__] = response
 
     if responses == {}:
         raise errors.HardwareManagerMethodNotFound(method)
@@ -638,7 +1081,9 @@ def dispatch_to_managers(method, *args, **kwargs):
     `_get_managers`. If the method doesn't exist or raises
     IncompatibleHardwareMethodError, it is attempted again with a more generic
     hardware manager. This continues until a method executes that returns
-    any result without raising an IncompatibleHardwareMethodError.
+    any result without raising an IncompatibleHardwareMethodError. The
+    managers having the method are kept for the next dispatches, see
+    `_get_candidates`, and each call is traced, see `set_dispatch_tracer`.
 
     :param method: hardware manager method to dispatch
     :param *args: arguments to dispatched method
@@ -648,21 +1093,16 @@ def dispatch_to_managers(method, *args, **kwargs):
     :raises HardwareManagerMethodNotFound: if all managers failed the method
     :raises HardwareManagerNotFound: if no valid hardware managers found
     """
-    managers = _get_managers()
-    for manager in managers:
-        if getattr(manager, method, None):
-            try:
-                return getattr(manager, method)(*args, **kwargs)
-            except(errors.IncompatibleHardwareMethodError):
-                LOG.debug('HardwareManager {0} does not support {1}'
-                        .format(manager, method))
-            except Exception as e:
-                LOG.exception('Unexpected error dispatching %(method)s to '
-                              'manager %(manager)s: %(e)s',
-                              {'method': method, 'manager': manager, 'e': e})
-                raise
-        else:
-            LOG.debug('HardwareManager {0} does not have method {1}'
-                      .format(manager, method))
+    for manager in _get_candidates(method):
+        try:
+            return _call_manager(manager, method, *args, **kwargs)
+        except errors.IncompatibleHardwareMethodError:
+            LOG.debug('HardwareManager {0} does not support {1}'
+                    .format(manager, method))
+        except Exception as e:
+            LOG.exception('Unexpected error dispatching %(method)s to '
+                          'manager %(manager)s: %(e)s',
+                          {'method': method, 'manager': manager, 'e': e})
+            raise
 
     raise errors.HardwareManagerMethodNotFound(method)
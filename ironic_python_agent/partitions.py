@@ -0,0 +1,629 @@
+# Copyright 2026 Ironic Python Agent contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reading and writing of MBR and GPT partition tables.
+
+This covers what the agent needs on the disk it deploys onto: finding a
+partition from the label or UUID of its filesystem, adding a partition at
+the end of the disk, like the one holding the configdrive, and writing a
+new table for partition images. The kernel is
+told about a partition with a single BLKPG ioctl rather than by re-reading
+the whole table and waiting for udev. Disk images in regular files are
+handled like block devices, without telling the kernel.
+"""
+
+import collections
+import ctypes
+import errno
+import fcntl
+import os
+import stat
+import struct
+import uuid
+import zlib
+
+from oslo_log import log
+
+from ironic_python_agent import errors
+
+LOG = log.getLogger(__name__)
+
+# ioctls from linux/fs.h and linux/blkpg.h
+BLKRRPART = 0x125f
+BLKSSZGET = 0x1268
+BLKPG = 0x1269
+BLKPG_ADD_PARTITION = 1
+
+# Partitions added are aligned like parted and fdisk align them
+ALIGNMENT = 1024 * 1024  # 1MB
+
+MBR_LINUX = 0x83
+GPT_LINUX = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+
+# MBR type byte and GPT type GUID of the kinds of partitions which can be
+# created. MBR has no BIOS boot partitions, GRUB uses the gap before the
+# first partition instead.
+_PARTITION_TYPES = {
+    'linux': (MBR_LINUX, GPT_LINUX),
+    'swap': (0x82, '0657fd6d-a4ab-43c4-84e5-0933c84b4f4f'),
+    'efi': (0xef, 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b'),
+    'bios_grub': (None, '21686148-6449-6e6f-744e-656564454649'),
+}
+PARTITION_TYPES = tuple(sorted(_PARTITION_TYPES))
+
+_MBR_SIZE = 512
+_MBR_ENTRIES_OFFSET = 446
+_MBR_ENTRY = struct.Struct('<B3sB3sII')
+_MBR_SIGNATURE = b'\x55\xaa'
+_MBR_PROTECTIVE = 0xee
+_MBR_EXTENDED = (0x05, 0x0f, 0x85)
+# CHS address meaning that the LBA fields are to be used
+_MBR_NO_CHS = b'\xfe\xff\xff'
+# Upper bound of the logical partitions followed, in case the chain of
+# extended boot records loops
+_MBR_MAX_LOGICAL = 128
+
+_GPT_SIGNATURE = b'EFI PART'
+_GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+_GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+_GPT_MAX_ENTRIES_SIZE = 1024 * 1024
+# Number of entries of the tables created, the usual minimum
+_GPT_ENTRIES = 128
+
+# Enough of the start of a partition to find the superblock of the
+# filesystems probed by _probe_filesystem
+_PROBE_SIZE = 68 * 1024
+
+# A partition of a disk. start and size are in bytes, type is the partition
+# type byte with MBR and the partition type GUID with GPT. uuid and name are
+# the unique GUID and the name of GPT partitions, None with MBR.
+Partition = collections.namedtuple(
+    'Partition', ['number', 'start', 'size', 'type', 'uuid', 'name'])
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _sector_size(f):
+    if not stat.S_ISBLK(os.fstat(f.fileno()).st_mode):
+        return 512
+    return struct.unpack('i', fcntl.ioctl(f.fileno(), BLKSSZGET,
+                                          b'\0' * 4))[0]
+
+
+class PartitionTable(object):
+    """Partition table of a disk.
+
+    :param f: file object of the disk, open for writing as well to add
+              partitions.
+    :param create: 'dos' or 'gpt' to replace the table of the disk with an
+                   empty one of that kind, None to read the existing one.
+    :raises: BlockDeviceError if the disk has no valid MBR or GPT partition
+             table.
+    """
+
+    def __init__(self, f, create=None):
+        self._f = f
+        self.sector_size = _sector_size(f)
+        f.seek(0, os.SEEK_END)
+        self.sectors = f.tell() // self.sector_size
+        self.partitions = []
+        self._gpt = None
+        if create is not None:
+            self._create(create)
+            return
+
+        mbr = self._read(0, _MBR_SIZE)
+        entries = [_MBR_ENTRY.unpack_from(mbr, _MBR_ENTRIES_OFFSET + i * 16)
+                   for i in range(4)] if len(mbr) == _MBR_SIZE else []
+        # Boot sectors of filesystems end with the same signature, but
+        # their code would not have valid status bytes in place of the
+        # partition entries.
+        if (mbr[-2:] != _MBR_SIGNATURE
+                or any(entry[0] not in (0, 0x80) for entry in entries)):
+            raise errors.BlockDeviceError('No partition table found')
+        self._mbr = bytearray(mbr)
+        if any(entry[2] == _MBR_PROTECTIVE for entry in entries):
+            self.label = 'gpt'
+            self._read_gpt()
+        else:
+            self.label = 'dos'
+            self._read_mbr(entries)
+
+    def _create(self, label):
+        if label not in ('dos', 'gpt'):
+            raise errors.BlockDeviceError(
+                'Unknown partition table type {0}'.format(label))
+        ss = self.sector_size
+        entries_sectors = -(-_GPT_ENTRIES * _GPT_ENTRY.size // ss)
+        if self.sectors < 2 * (entries_sectors + 2):
+            raise errors.BlockDeviceError(
+                'Disk of {0} bytes too small for a partition table'.format(
+                    self.sectors * ss))
+        # Wipe both GPT tables, a stale backup one would still be found by
+        # tools looking for it at the end of the disk.
+        self._write(0, b'\0' * (entries_sectors + 2) * ss)
+        self._write((self.sectors - entries_sectors - 1) * ss,
+                    b'\0' * (entries_sectors + 1) * ss)
+        self.label = label
+        self._mbr = bytearray(_MBR_SIZE)
+        # Disk identifier, part of the PARTUUID of MBR partitions
+        self._mbr[440:444] = os.urandom(4)
+        self._mbr[-2:] = _MBR_SIGNATURE
+        if label == 'gpt':
+            _MBR_ENTRY.pack_into(self._mbr, _MBR_ENTRIES_OFFSET, 0,
+                                 _MBR_NO_CHS, _MBR_PROTECTIVE, _MBR_NO_CHS,
+                                 1, 0)
+            self._gpt_entries = bytearray(_GPT_ENTRIES * _GPT_ENTRY.size)
+            self._gpt = [_GPT_SIGNATURE, 0x10000, _GPT_HEADER.size, 0, 0, 1,
+                         self.sectors - 1, 2 + entries_sectors, 0,
+                         uuid.uuid4().bytes_le, 2, _GPT_ENTRIES,
+                         _GPT_ENTRY.size, 0]
+            self._write_gpt(self.sectors - 2 - entries_sectors)
+        else:
+            self._write(0, bytes(self._mbr))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        LOG.info('Created an empty {0} partition table'.format(label))
+
+    def _read(self, offset, length):
+        self._f.seek(offset)
+        return self._f.read(length)
+
+    def _write(self, offset, data):
+        self._f.seek(offset)
+        self._f.write(data)
+
+    def _read_mbr(self, entries):
+        ss = self.sector_size
+        for i, (_status, _chs, ptype, _chs, start, count) in enumerate(
+                entries):
+            if not ptype or not count:
+                continue
+            self.partitions.append(Partition(i + 1, start * ss, count * ss,
+                                             ptype, None, None))
+            if ptype in _MBR_EXTENDED:
+                self._read_logical(start)
+
+    def _read_logical(self, extended_start):
+        ss = self.sector_size
+        ebr = extended_start
+        for number in range(5, 5 + _MBR_MAX_LOGICAL):
+            data = self._read(ebr * ss, _MBR_SIZE)
+            if data[-2:] != _MBR_SIGNATURE:
+                return
+            logical = _MBR_ENTRY.unpack_from(data, _MBR_ENTRIES_OFFSET)
+            following = _MBR_ENTRY.unpack_from(data, _MBR_ENTRIES_OFFSET + 16)
+            if logical[2] and logical[5]:
+                self.partitions.append(Partition(
+                    number, (ebr + logical[4]) * ss, logical[5] * ss,
+                    logical[2], None, None))
+            if following[2] not in _MBR_EXTENDED or not following[4]:
+                return
+            ebr = extended_start + following[4]
+
+    def _gpt_header(self, lba):
+        data = self._read(lba * self.sector_size, self.sector_size)
+        if (len(data) < _GPT_HEADER.size
+                or not data.startswith(_GPT_SIGNATURE)):
+            return None
+        fields = list(_GPT_HEADER.unpack_from(data))
+        header_size = fields[2]
+        if not _GPT_HEADER.size <= header_size <= len(data):
+            return None
+        if _crc32(data[:16] + b'\0' * 4 + data[20:header_size]) != fields[3]:
+            return None
+        entries_lba, count, entry_size = fields[10:13]
+        if (entry_size < _GPT_ENTRY.size
+                or count * entry_size > _GPT_MAX_ENTRIES_SIZE):
+            return None
+        entries = self._read(entries_lba * self.sector_size,
+                             count * entry_size)
+        if _crc32(entries) != fields[13]:
+            return None
+        return fields, bytearray(entries)
+
+    def _read_gpt(self):
+        # Disk images written to a larger disk leave their backup table in
+        # the middle of it, the primary one is the one to trust.
+        gpt = self._gpt_header(1)
+        if gpt is None:
+            raise errors.BlockDeviceError('Invalid GPT partition table')
+        self._gpt, self._gpt_entries = gpt
+        ss = self.sector_size
+        entry_size = self._gpt[12]
+        for i in range(self._gpt[11]):
+            (ptype, unique, first, last, _attributes,
+             name) = _GPT_ENTRY.unpack_from(self._gpt_entries,
+                                            i * entry_size)
+            if ptype == b'\0' * 16:
+                continue
+            self.partitions.append(Partition(
+                i + 1, first * ss, (last - first + 1) * ss,
+                str(uuid.UUID(bytes_le=ptype)),
+                str(uuid.UUID(bytes_le=unique)),
+                name.decode('utf-16-le').split(u'\0', 1)[0]))
+
+    def _gpt_header_sector(self, current_lba, backup_lba, entries_lba):
+        fields = list(self._gpt)
+        fields[3] = 0
+        fields[5:7] = [current_lba, backup_lba]
+        fields[10] = entries_lba
+        fields[13] = _crc32(bytes(self._gpt_entries))
+        header = _GPT_HEADER.pack(*fields).ljust(fields[2], b'\0')
+        fields[3] = _crc32(header)
+        return _GPT_HEADER.pack(*fields).ljust(self.sector_size, b'\0')
+
+    def _write_gpt(self, last_usable):
+        ss = self.sector_size
+        backup_lba = self.sectors - 1
+        backup_entries_lba = backup_lba - (
+            -(-len(self._gpt_entries) // ss))
+        self._gpt[8] = last_usable
+        entries = bytes(self._gpt_entries)
+        self._write(self._gpt[10] * ss, entries)
+        self._write(backup_entries_lba * ss, entries)
+        self._write(backup_lba * ss,
+                    self._gpt_header_sector(backup_lba, 1,
+                                            backup_entries_lba))
+        self._write(ss, self._gpt_header_sector(1, backup_lba,
+                                                self._gpt[10]))
+        # The protective MBR covers the whole disk
+        for i in range(4):
+            offset = _MBR_ENTRIES_OFFSET + i * 16
+            entry = list(_MBR_ENTRY.unpack_from(self._mbr, offset))
+            if entry[2] == _MBR_PROTECTIVE:
+                entry[5] = min(self.sectors - 1, 0xffffffff)
+                _MBR_ENTRY.pack_into(self._mbr, offset, *entry)
+        self._write(0, bytes(self._mbr))
+
+    def add(self, size, name='', ptype='linux', bootable=False,
+            at_end=True, reserve=0):
+        """Add a partition to the disk.
+
+        At the end of the disk, the partition starts at the last aligned
+        offset leaving at least size bytes to the end of the disk. With GPT,
+        the backup table is moved to the end of the disk first. Otherwise
+        it starts at the first aligned offset after the last partition.
+
+        :param size: minimum size of the partition in bytes. None, when not
+                     adding at the end, for the rest of the disk.
+        :param name: name of the partition, with GPT.
+        :param ptype: kind of partition, one of PARTITION_TYPES.
+        :param bootable: whether to set the boot flag, with MBR.
+        :param at_end: whether to add the partition at the end of the disk
+                       rather than after the last one.
+        :param reserve: number of bytes left free at the end of the disk by
+                        a partition taking the rest of it.
+        :returns: the Partition added.
+        :raises: BlockDeviceError if the table has no free entry, there is
+                 not enough free space where the partition goes or the kind
+                 of partition does not exist with the table.
+        """
+        if ptype not in _PARTITION_TYPES:
+            raise errors.BlockDeviceError(
+                'Unknown partition type {0}'.format(ptype))
+        mbr_type, gpt_type = _PARTITION_TYPES[ptype]
+        if self.label == 'dos' and mbr_type is None:
+            raise errors.BlockDeviceError(
+                '{0} partitions need a GPT partition table'.format(ptype))
+        ss = self.sector_size
+        if self.label == 'gpt':
+            entries_sectors = -(-len(self._gpt_entries) // ss)
+            last = self.sectors - 2 - entries_sectors
+            used = [self._gpt[7]]
+            free = [i for i in range(self._gpt[11])
+                    if _GPT_ENTRY.unpack_from(
+                        self._gpt_entries,
+                        i * self._gpt[12])[0] == b'\0' * 16]
+        else:
+            # Sector numbers of MBR entries are 32 bits
+            last = min(self.sectors, 1 << 32) - 1
+            used = [1]
+            free = []
+            for i in range(4):
+                entry = _MBR_ENTRY.unpack_from(self._mbr,
+                                               _MBR_ENTRIES_OFFSET + i * 16)
+                if not entry[2] and not entry[5]:
+                    free.append(i)
+        if not free:
+            raise errors.BlockDeviceError(
+                'No free entry in the {0} partition table'.format(
+                    self.label))
+
+        alignment = max(ALIGNMENT // ss, 1)
+        used.extend((p.start + p.size) // ss for p in self.partitions)
+        if at_end:
+            start = (last + 1 - -(-size // ss)) // alignment * alignment
+            fits = start >= max(used)
+        else:
+            start = -(-max(used) // alignment) * alignment
+            if self.label == 'gpt':
+                # The backup table is left where it is
+                last = min(last, self._gpt[8])
+            if size is None:
+                last -= -(-reserve // ss)
+                fits = last >= start
+            else:
+                fits = start + -(-size // ss) - 1 <= last
+                last = start + -(-size // ss) - 1
+        if not fits:
+            raise errors.BlockDeviceError(
+                'Not enough free space {0} for a partition of {1} '
+                'bytes'.format('at the end of the disk' if at_end
+                               else 'after the last partition', size))
+
+        number = free[0] + 1
+        if self.label == 'gpt':
+            unique = uuid.uuid4()
+            entry = _GPT_ENTRY.pack(
+                uuid.UUID(gpt_type).bytes_le, unique.bytes_le, start, last,
+                0, name.encode('utf-16-le')[:72])
+            self._gpt_entries[free[0] * self._gpt[12]:
+                              free[0] * self._gpt[12] + len(entry)] = entry
+            self._write_gpt(last if at_end else self._gpt[8])
+            partition = Partition(number, start * ss,
+                                  (last - start + 1) * ss, gpt_type,
+                                  str(unique), name)
+        else:
+            _MBR_ENTRY.pack_into(self._mbr,
+                                 _MBR_ENTRIES_OFFSET + free[0] * 16,
+                                 0x80 if bootable else 0, _MBR_NO_CHS,
+                                 mbr_type, _MBR_NO_CHS, start,
+                                 last - start + 1)
+            self._write(0, bytes(self._mbr))
+            partition = Partition(number, start * ss,
+                                  (last - start + 1) * ss, mbr_type, None,
+                                  None)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.partitions.append(partition)
+        LOG.info('Added partition {0} of {1} bytes at offset {2}'.format(
+            number, partition.size, partition.start))
+        return partition
+
+
+def _text(data):
+    text = data.split(b'\0', 1)[0].rstrip(b' ').decode('utf-8', 'replace')
+    return text or None
+
+
+def _probe_filesystem(f, offset):
+    """Find the label and UUID of the filesystem starting at offset.
+
+    ext2/3/4, XFS, btrfs, ISO 9660 and FAT filesystems are recognized. The
+    UUIDs are formatted like blkid formats them.
+
+    :returns: a (label, UUID) tuple, (None, None) if the filesystem is not
+              recognized.
+    """
+    f.seek(offset)
+    data = f.read(_PROBE_SIZE)
+    if data[1080:1082] == b'\x53\xef':
+        return _text(data[1144:1160]), str(uuid.UUID(bytes=data[1128:1144]))
+    if data[:4] == b'XFSB':
+        return _text(data[108:120]), str(uuid.UUID(bytes=data[32:48]))
+    if data[65600:65608] == b'_BHRfS_M':
+        return (_text(data[65835:66091]),
+                str(uuid.UUID(bytes=data[65568:65584])))
+    if data[32768:32774] == b'\x01CD001':
+        return _text(data[32808:32840]), None
+    if data[510:512] == _MBR_SIGNATURE:
+        if data[82:87] == b'FAT32':
+            serial, label = data[67:71], data[71:82]
+        elif data[54:57] == b'FAT':
+            serial, label = data[39:43], data[43:54]
+        else:
+            return None, None
+        serial = struct.unpack('<I', serial)[0]
+        label = _text(label)
+        return (None if label == 'NO NAME' else label,
+                '{0:04X}-{1:04X}'.format(serial >> 16, serial & 0xffff))
+    return None, None
+
+
+def partition_path(device, number):
+    """Path of a partition of a disk, like /dev/sda1 or /dev/nvme0n1p1."""
+    separator = 'p' if device[-1:].isdigit() else ''
+    return '{0}{1}{2}'.format(device, separator, number)
+
+
+class _BlkpgPartition(ctypes.Structure):
+    _fields_ = [('start', ctypes.c_longlong),
+                ('length', ctypes.c_longlong),
+                ('pno', ctypes.c_int),
+                ('devname', ctypes.c_char * 64),
+                ('volname', ctypes.c_char * 64)]
+
+
+class _BlkpgIoctlArg(ctypes.Structure):
+    _fields_ = [('op', ctypes.c_int),
+                ('flags', ctypes.c_int),
+                ('datalen', ctypes.c_int),
+                ('data', ctypes.c_void_p)]
+
+
+def _known_to_kernel(device, partition):
+    sysfs = os.path.join('/sys/class/block',
+                         os.path.basename(partition_path(device,
+                                                         partition.number)))
+    try:
+        with open(os.path.join(sysfs, 'start')) as f:
+            start = int(f.read()) * 512
+        with open(os.path.join(sysfs, 'size')) as f:
+            size = int(f.read()) * 512
+    except (EnvironmentError, ValueError):
+        return False
+    return (start, size) == (partition.start, partition.size)
+
+
+def _tell_kernel(f, device, partition):
+    """Make sure the kernel knows about a partition of a block device.
+
+    The partition is added with BLKPG. If the kernel has another partition
+    with the same number, it re-reads the whole table with BLKRRPART, which
+    fails if a partition of the disk is in use.
+    """
+    if not stat.S_ISBLK(os.fstat(f.fileno()).st_mode):
+        return
+    blkpg_partition = _BlkpgPartition(start=partition.start,
+                                      length=partition.size,
+                                      pno=partition.number)
+    arg = _BlkpgIoctlArg(op=BLKPG_ADD_PARTITION,
+                         datalen=ctypes.sizeof(blkpg_partition),
+                         data=ctypes.addressof(blkpg_partition))
+    try:
+        fcntl.ioctl(f.fileno(), BLKPG, arg)
+        return
+    except EnvironmentError as e:
+        if e.errno == errno.EBUSY and _known_to_kernel(device, partition):
+            return
+        LOG.debug('Unable to add partition {0} of {1} with BLKPG, '
+                  're-reading the partition table: {2}'.format(
+                      partition.number, device, e))
+    try:
+        fcntl.ioctl(f.fileno(), BLKRRPART)
+    except EnvironmentError as e:
+        raise errors.BlockDeviceError(
+            'Unable to tell the kernel about partition {0} of {1}: '
+            '{2}'.format(partition.number, device, e))
+
+
+def find_partition(device, label=None, uuid=None):
+    """Find a partition of a disk from its filesystem.
+
+    The kernel is told about the partition found, so that its device can be
+    used right away.
+
+    :param device: path of the disk.
+    :param label: label of the filesystem of the partition.
+    :param uuid: UUID of the filesystem of the partition, or unique GUID of
+                 the GPT partition.
+    :returns: the path of the partition, None if none matches.
+    :raises: BlockDeviceError if the partition table cannot be read or the
+             kernel cannot be told about the partition.
+    """
+    device = os.path.realpath(device)
+    uuid = uuid and uuid.lower()
+    try:
+        with open(device, 'rb') as f:
+            for partition in PartitionTable(f).partitions:
+                fs_label, fs_uuid = _probe_filesystem(f, partition.start)
+                if ((label is not None and fs_label == label)
+                        or (uuid and uuid in (partition.uuid,
+                                              fs_uuid and fs_uuid.lower()))):
+                    _tell_kernel(f, device, partition)
+                    return partition_path(device, partition.number)
+    except EnvironmentError as e:
+        raise errors.BlockDeviceError(
+            'Unable to read the partitions of {0}: {1}'.format(device, e))
+    return None
+
+
+def add_partition(device, size, name=''):
+    """Add a Linux partition at the end of a disk.
+
+    :param device: path of the disk.
+    :param size: minimum size of the partition in bytes.
+    :param name: name of the partition, with GPT.
+    :returns: the path of the partition.
+    :raises: BlockDeviceError if the partition cannot be added.
+    """
+    device = os.path.realpath(device)
+    try:
+        with open(device, 'r+b') as f:
+            partition = PartitionTable(f).add(size, name)
+            _tell_kernel(f, device, partition)
+    except EnvironmentError as e:
+        raise errors.BlockDeviceError(
+            'Unable to add a partition to {0}: {1}'.format(device, e))
+    return partition_path(device, partition.number)
+
+
+def _reread_table(f, device, partitions):
+    """Make sure the kernel knows about the new table of a block device.
+
+    The whole table is re-read, and if a partition of the disk is in use the
+    new partitions are added one by one instead.
+    """
+    if not stat.S_ISBLK(os.fstat(f.fileno()).st_mode):
+        return
+    try:
+        fcntl.ioctl(f.fileno(), BLKRRPART)
+        return
+    except EnvironmentError as e:
+        LOG.warning('Unable to re-read the partition table of {0}, adding '
+                    'its partitions one by one: {1}'.format(device, e))
+    for partition in partitions:
+        _tell_kernel(f, device, partition)
+
+
+def create_partitions(device, label, layout, reserve=0):
+    """Replace the partition table of a disk with new partitions.
+
+    The partitions are laid out one after the other from the start of the
+    disk, in layout order, and the start of each of them is wiped.
+
+    :param device: path of the disk.
+    :param label: kind of partition table, 'dos' or 'gpt'.
+    :param layout: list of dictionaries describing the partitions, with
+                   their 'size' in bytes, None for the rest of the disk, and
+                   optionally their 'name', their 'type', one of
+                   PARTITION_TYPES, and whether they are 'bootable'. See
+                   PartitionTable.add().
+    :param reserve: number of bytes to leave free at the end of the disk,
+                    for a partition added later.
+    :returns: the paths of the partitions, in layout order.
+    :raises: BlockDeviceError if the partitions cannot be created.
+    """
+    device = os.path.realpath(device)
+    try:
+        with open(device, 'r+b') as f:
+            table = PartitionTable(f, create=label)
+            created = [table.add(partition['size'],
+                                 name=partition.get('name', ''),
+                                 ptype=partition.get('type', 'linux'),
+                                 bootable=partition.get('bootable', False),
+                                 at_end=False, reserve=reserve)
+                       for partition in layout]
+            # Filesystems found where the new partitions start would still
+            # show through the ones left empty
+            for partition in created:
+                f.seek(partition.start)
+                f.write(b'\0' * min(partition.size, ALIGNMENT))
+            f.flush()
+            os.fsync(f.fileno())
+            _reread_table(f, device, created)
+    except EnvironmentError as e:
+        raise errors.BlockDeviceError(
+            'Unable to create partitions on {0}: {1}'.format(device, e))
+    return [partition_path(device, partition.number)
+            for partition in created]
+
+
+def probe_filesystem(path):
+    """Find the label and UUID of the filesystem of a partition.
+
+    :param path: path of the partition.
+    :returns: a (label, UUID) tuple, (None, None) if the filesystem is not
+              recognized. See _probe_filesystem().
+    :raises: BlockDeviceError if the partition cannot be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return _probe_filesystem(f, 0)
+    except EnvironmentError as e:
+        raise errors.BlockDeviceError(
+            'Unable to read the filesystem of {0}: {1}'.format(path, e))
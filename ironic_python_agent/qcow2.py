@@ -0,0 +1,276 @@
+# Copyright 2026 Ironic Python Agent contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Conversion of qcow2 images to raw while they are being read.
+
+A qcow2 image is made of clusters: a header, the L1 and L2 tables mapping
+the virtual disk onto the image clusters, refcount tables and the data
+clusters. qemu-img writes tables before the data they map, so reading the
+image once from start to end is enough to know where each data cluster
+belongs on the virtual disk when it arrives. Clusters showing up before the
+tables describing them are kept aside, up to MAX_PENDING_BYTES.
+
+Images relying on features which need random access or other files,
+namely backing files, encryption, compressed clusters and internal
+snapshots, are rejected.
+"""
+
+import struct
+
+from oslo_log import log
+
+from ironic_python_agent import errors
+
+LOG = log.getLogger(__name__)
+
+MAGIC = b'QFI\xfb'
+
+# Upper bound of the memory used for clusters read before the tables
+# telling what they are.
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+# Version 2 header, followed by the feature fields of version 3
+_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+_V3_HEADER = struct.Struct('>QQQII')
+
+# Bits of L1, L2 and refcount table entries holding a cluster offset
+_OFFSET_MASK = 0x00fffffffffffe00
+_L2_COMPRESSED = 1 << 62
+_L2_ZERO = 1
+
+# The dirty bit is the only incompatible feature supported: it means that
+# refcounts may be out of date, which does not matter for reading.
+_INCOMPAT_DIRTY = 1
+
+_MIN_CLUSTER_BITS = 9
+_MAX_CLUSTER_BITS = 21
+
+
+class _Table(object):
+    """Table of 64 bits entries stored in consecutive clusters."""
+
+    def __init__(self, offset, entries, cluster_size):
+        self.offset = offset
+        self.size = entries * 8
+        self._entries = entries
+        self._clusters = -(-self.size // cluster_size)
+        self._parts = {}
+        self.complete = not entries
+
+    def covers(self, offset):
+        return self.offset <= offset < self.offset + self.size
+
+    def add(self, offset, data):
+        """Add a cluster of the table.
+
+        :returns: the table entries once all the clusters were added, None
+                  until then.
+        """
+        self._parts[offset] = data
+        if len(self._parts) < self._clusters:
+            return None
+        data = b''.join(self._parts[o] for o in sorted(self._parts))
+        self._parts = {}
+        self.complete = True
+        return struct.unpack_from('>{0}Q'.format(self._entries), data)
+
+
+class StreamDecoder(object):
+    """Convert a qcow2 image to raw in a single pass.
+
+    Only the header, the L1 table and the L2 tables are decoded, the data
+    clusters are handed over as they arrive along with their offset in the
+    raw image.
+
+    :param image_id: ID of the image, for error messages.
+    """
+
+    def __init__(self, image_id):
+        self.image_id = image_id
+        self.virtual_size = None
+        self._cluster_size = None
+        # Host offset of the next cluster of the image
+        self._offset = 0
+        self._l1_table = None
+        self._refcount_table = None
+        # Guest offset of the first cluster mapped by L2 tables not read yet,
+        # by host offset
+        self._l2_tables = {}
+        # Guest offset of data clusters not read yet, by host offset
+        self._data_clusters = {}
+        # Host offsets of refcount blocks, which are of no use here
+        self._refcount_blocks = set()
+        # Clusters read before the tables describing them, by host offset
+        self._pending = {}
+
+    def _error(self, msg):
+        return errors.ImageFormatError(self.image_id, msg)
+
+    def _read_header(self, data):
+        (magic, version, backing_file_offset, _backing_file_size,
+         cluster_bits, size, crypt_method, l1_size, l1_table_offset,
+         refcount_table_offset, refcount_table_clusters, nb_snapshots,
+         _snapshots_offset) = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise self._error('not a qcow2 image')
+        if version not in (2, 3):
+            raise self._error('unsupported qcow2 version {0}'.format(version))
+        if version == 3:
+            incompatible_features = _V3_HEADER.unpack_from(data,
+                                                           _HEADER.size)[0]
+            if incompatible_features & ~_INCOMPAT_DIRTY:
+                raise self._error('unsupported incompatible features '
+                                  '{0:#x}'.format(incompatible_features))
+        if backing_file_offset:
+            raise self._error('backing files are not supported')
+        if crypt_method:
+            raise self._error('encrypted images are not supported')
+        if nb_snapshots:
+            raise self._error('internal snapshots are not supported')
+        if not _MIN_CLUSTER_BITS <= cluster_bits <= _MAX_CLUSTER_BITS:
+            raise self._error('invalid cluster size 2^{0}'.format(
+                cluster_bits))
+
+        cluster_size = 1 << cluster_bits
+        if l1_table_offset % cluster_size or refcount_table_offset % (
+                cluster_size):
+            raise self._error('tables not aligned on clusters')
+        self._cluster_size = cluster_size
+        self.virtual_size = size
+        self._l1_table = _Table(l1_table_offset, l1_size, cluster_size)
+        self._refcount_table = _Table(
+            refcount_table_offset,
+            refcount_table_clusters * cluster_size // 8,
+            cluster_size)
+        LOG.debug('Decoding qcow2 version {0} image {1} of {2} bytes with '
+                  '{3} bytes clusters'.format(version, self.image_id, size,
+                                              cluster_size))
+
+    def _data(self, guest_offset, data):
+        # The last cluster may go past the end of the virtual disk
+        return guest_offset, data[:self.virtual_size - guest_offset]
+
+    def _read_l2_table(self, guest_offset, entries):
+        writes = []
+        for entry in entries:
+            host_offset = entry & _OFFSET_MASK
+            if entry & _L2_COMPRESSED:
+                raise self._error('compressed clusters are not supported')
+            # Zero and unallocated clusters are holes in the raw image
+            if host_offset and not entry & _L2_ZERO:
+                data = self._pending.pop(host_offset, None)
+                if data is None:
+                    self._data_clusters[host_offset] = guest_offset
+                else:
+                    writes.append(self._data(guest_offset, data))
+            guest_offset += self._cluster_size
+        return writes
+
+    def _read_l1_table(self, entries):
+        writes = []
+        # Size of the virtual disk mapped by each L2 table
+        l2_span = self._cluster_size // 8 * self._cluster_size
+        for i, entry in enumerate(entries):
+            host_offset = entry & _OFFSET_MASK
+            if not host_offset:
+                continue
+            data = self._pending.pop(host_offset, None)
+            if data is None:
+                self._l2_tables[host_offset] = i * l2_span
+            else:
+                writes.extend(self._read_l2_table(i * l2_span,
+                                                  self._l2_entries(data)))
+        return writes
+
+    def _read_refcount_table(self, entries):
+        for entry in entries:
+            host_offset = entry & _OFFSET_MASK
+            if host_offset and self._pending.pop(host_offset, None) is None:
+                self._refcount_blocks.add(host_offset)
+
+    def _l2_entries(self, data):
+        return struct.unpack('>{0}Q'.format(self._cluster_size // 8), data)
+
+    def _read_cluster(self, offset, data):
+        if offset in self._data_clusters:
+            return [self._data(self._data_clusters.pop(offset), data)]
+        if offset in self._l2_tables:
+            return self._read_l2_table(self._l2_tables.pop(offset),
+                                       self._l2_entries(data))
+        if self._l1_table.covers(offset):
+            entries = self._l1_table.add(offset, data)
+            return [] if entries is None else self._read_l1_table(entries)
+        if self._refcount_table.covers(offset):
+            entries = self._refcount_table.add(offset, data)
+            if entries is not None:
+                self._read_refcount_table(entries)
+            return []
+        if offset in self._refcount_blocks:
+            self._refcount_blocks.discard(offset)
+            return []
+
+        self._pending[offset] = data
+        if len(self._pending) * self._cluster_size > MAX_PENDING_BYTES:
+            raise self._error('more than {0} bytes of clusters precede the '
+                              'tables mapping them'.format(MAX_PENDING_BYTES))
+        return []
+
+    def decode(self, chunks):
+        """Decode a qcow2 image.
+
+        :param chunks: Iterable over the image data, from start to end.
+        :returns: A generator of (offset, data) tuples, data being part of
+                  the raw image to write at offset. Parts of the raw image
+                  which are not produced are zeros. The last tuple is
+                  (virtual disk size, b'').
+        :raises: ImageFormatError if the image is not a valid qcow2 image
+                 or uses features which prevent decoding it in one pass.
+        """
+        buf = b''
+        for chunk in chunks:
+            buf += chunk
+            if self._cluster_size is None:
+                if len(buf) < _HEADER.size + _V3_HEADER.size:
+                    continue
+                self._read_header(buf)
+
+            end = len(buf) - len(buf) % self._cluster_size
+            for i in range(0, end, self._cluster_size):
+                offset = self._offset
+                self._offset += self._cluster_size
+                # The first cluster holds the header
+                if offset == 0:
+                    continue
+                for write in self._read_cluster(
+                        offset, buf[i:i + self._cluster_size]):
+                    yield write
+            buf = buf[end:]
+
+        if self._cluster_size is None:
+            raise self._error('image too short')
+        if buf:
+            # Past its end, the image reads as zeros
+            buf += b'\0' * (self._cluster_size - len(buf))
+            for write in self._read_cluster(self._offset, buf):
+                yield write
+        if not self._l1_table.complete:
+            raise self._error('image truncated, the L1 table is missing')
+        missing = len(self._l2_tables) + len(self._data_clusters)
+        if missing:
+            raise self._error('image truncated, {0} clusters are '
+                              'missing'.format(missing))
+        if self._pending:
+            LOG.debug('Ignored {0} unused clusters of image {1}'.format(
+                len(self._pending), self.image_id))
+        yield self.virtual_size, b''
@@ -47,6 +47,12 @@ class FakeExtension(base.BaseAgentExtension):
     def second_async_command(self):
         pass
 
+    @base.async_command('fake_progress_command')
+    def fake_progress_command(self):
+        command = base.current_command()
+        command.update_progress(done=1)
+        command.update_progress(total=2)
+
     @base.sync_command('other_sync_name')
     def second_sync_command(self):
         pass
@@ -150,6 +156,16 @@ class TestExtensionDecorators(test_base.BaseTestCase):
         self.assertEqual({'result': 'fake_async_command: v1'},
                           result.command_result)
 
+    def test_async_command_progress(self):
+        result = self.extension.execute('fake_progress_command')
+        result.join()
+        self.assertEqual(base.AgentCommandStatus.SUCCEEDED,
+                         result.command_status)
+        self.assertEqual({'done': 1, 'total': 2}, result.command_progress)
+        self.assertEqual({'done': 1, 'total': 2},
+                         result.serialize()['command_progress'])
+        self.assertIsNone(base.current_command())
+
     def test_async_command_validation_failure(self):
         self.assertRaises(errors.InvalidCommandParamsError,
                           self.extension.execute,
@@ -214,5 +230,6 @@ class TestExtensionDecorators(test_base.BaseTestCase):
             'fake_sync_command': self.extension.fake_sync_command,
             'other_async_name': self.extension.second_async_command,
             'other_sync_name': self.extension.second_sync_command,
+            'fake_progress_command': self.extension.fake_progress_command,
         }
         self.assertEqual(expected_map, self.extension.command_map)
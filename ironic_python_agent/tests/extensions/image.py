@@ -26,6 +26,7 @@ from oslotest import base as test_base
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import image
 from ironic_python_agent import hardware
+from ironic_python_agent import partitions
 from ironic_python_agent import utils
 
 
@@ -211,7 +212,22 @@ class TestImageExtension(test_base.BaseTestCase):
                                                    uuid=self.fake_root_uuid)
         self.assertFalse(mock_dispatch.called)
 
-    def test__get_partition(self, mock_execute, mock_dispatch):
+    @mock.patch.object(partitions, 'find_partition', autospec=True)
+    def test__get_partition_native(self, mock_find, mock_execute,
+                                   mock_dispatch):
+        mock_find.return_value = self.fake_root_part
+
+        root_part = image._get_partition(self.fake_dev,
+                                              self.fake_root_uuid)
+        self.assertEqual(self.fake_root_part, root_part)
+        mock_find.assert_called_once_with(self.fake_dev,
+                                          uuid=self.fake_root_uuid)
+        self.assertFalse(mock_execute.called)
+        self.assertFalse(mock_dispatch.called)
+
+    @mock.patch.object(partitions, 'find_partition', autospec=True)
+    def test__get_partition(self, mock_find, mock_execute, mock_dispatch):
+        mock_find.return_value = None
         lsblk_output = ('''KNAME="test" UUID="" TYPE="disk"
         KNAME="test1" UUID="256a39e3-ca3c-4fb8-9cc2-b32eec441f47" TYPE="part"
         KNAME="test2" UUID="%s" TYPE="part"''' % self.fake_root_uuid)
@@ -227,8 +243,10 @@ class TestImageExtension(test_base.BaseTestCase):
         mock_execute.assert_has_calls(expected)
         self.assertFalse(mock_dispatch.called)
 
-    def test__get_partition_no_device_found(self, mock_execute,
+    @mock.patch.object(partitions, 'find_partition', autospec=True)
+    def test__get_partition_no_device_found(self, mock_find, mock_execute,
                                                  mock_dispatch):
+        mock_find.side_effect = errors.BlockDeviceError('boom')
         lsblk_output = ('''KNAME="test" UUID="" TYPE="disk"
         KNAME="test1" UUID="256a39e3-ca3c-4fb8-9cc2-b32eec441f47" TYPE="part"
         KNAME="test2" UUID="" TYPE="part"''')
@@ -244,8 +262,10 @@ class TestImageExtension(test_base.BaseTestCase):
         mock_execute.assert_has_calls(expected)
         self.assertFalse(mock_dispatch.called)
 
-    def test__get_partition_command_fail(self, mock_execute,
+    @mock.patch.object(partitions, 'find_partition', autospec=True)
+    def test__get_partition_command_fail(self, mock_find, mock_execute,
                                               mock_dispatch):
+        mock_find.return_value = None
         mock_execute.side_effect = (None, None,
                                     processutils.ProcessExecutionError('boom'))
         self.assertRaises(errors.CommandExecutionError,
@@ -12,13 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import threading
+import zlib
+
 import mock
 from oslo_concurrency import processutils
+from oslo_config import fixture as config_fixture
 from oslotest import base as test_base
+import requests
 import six
 
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import standby
+from ironic_python_agent import partitions
 
 if six.PY2:
     OPEN_FUNCTION_NAME = '__builtin__.open'
@@ -30,6 +45,10 @@ class TestStandbyExtension(test_base.BaseTestCase):
     def setUp(self):
         super(TestStandbyExtension, self).setUp()
         self.agent_extension = standby.StandbyExtension()
+        self.config = self.useFixture(config_fixture.Config()).config
+        self.manifest = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.manifest))
+        self.config(image_cache_manifest=self.manifest)
 
     def _build_fake_image_info(self):
         return {
@@ -84,6 +103,193 @@ class TestStandbyExtension(test_base.BaseTestCase):
                           standby._validate_image_info,
                           invalid_info)
 
+    def test_validate_image_info_compression(self):
+        image_info = self._build_fake_image_info()
+        for value in ('gzip', 'none'):
+            image_info['compression'] = value
+            standby._validate_image_info(None, image_info)
+
+        image_info['compression'] = 'lz4'
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, image_info)
+
+    @mock.patch('ironic_python_agent.compression.zstandard', None)
+    def test_validate_image_info_compression_unavailable(self):
+        image_info = self._build_fake_image_info()
+        image_info['compression'] = 'zstd'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'gzip, bzip2',
+                                standby._validate_image_info,
+                                None, image_info)
+
+    def test_validate_image_info_checksums(self):
+        image_info = self._build_fake_image_info()
+        image_info['checksums'] = {'sha256': 'abc', 'md5': 'ABC123'}
+        standby._validate_image_info(None, image_info)
+        del image_info['checksum']
+        standby._validate_image_info(None, image_info)
+
+        for checksums in ({}, 'abc', {'crc32': 'abc'}, {'sha256': ''},
+                          {'sha512': 42}):
+            image_info['checksums'] = checksums
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, image_info)
+
+    def test_validate_image_info_conflicting_checksums(self):
+        image_info = self._build_fake_image_info()
+        image_info['checksums'] = {'md5': 'def456'}
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError, 'differ',
+                                standby._validate_image_info,
+                                None, image_info)
+
+    def test_validate_image_info_verify_after_write(self):
+        image_info = self._build_fake_image_info()
+        image_info['verify_after_write'] = 'yes'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'verify_after_write',
+                                standby._validate_image_info,
+                                None, image_info)
+
+    def test_validate_image_info_rate_limit(self):
+        image_info = self._build_fake_image_info()
+        image_info['download_rate_limit'] = 12.5
+        standby._validate_image_info(None, image_info)
+        for rate_limit in (-1, '10', True):
+            image_info['download_rate_limit'] = rate_limit
+            self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                    'download_rate_limit',
+                                    standby._validate_image_info,
+                                    None, image_info)
+
+    def test_validate_image_info_target_devices(self):
+        image_info = self._build_fake_image_info()
+        image_info['target_devices'] = ['/dev/sda', '/dev/sdb']
+        standby._validate_image_info(None, image_info)
+        for devices in ([], '/dev/sda', ['/dev/sda', '/dev/sda'], ['']):
+            image_info['target_devices'] = devices
+            self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                    'target_devices',
+                                    standby._validate_image_info,
+                                    None, image_info)
+        del image_info['target_devices']
+        image_info['mirror_root_device'] = 'yes'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                'mirror_root_device',
+                                standby._validate_image_info,
+                                None, image_info)
+        image_info['mirror_root_device'] = True
+        image_info['target_devices'] = ['/dev/sda', '/dev/sdb']
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError, 'together',
+                                standby._validate_image_info,
+                                None, image_info)
+
+    def _chunk_manifest(self, data, chunk_size):
+        return {'size': len(data), 'chunk_size': chunk_size,
+                'checksums': [
+                    hashlib.sha256(data[i:i + chunk_size]).hexdigest()
+                    for i in range(0, len(data), chunk_size)]}
+
+    def test_validate_image_info_differential_write(self):
+        image_info = self._build_fake_image_info()
+        image_info['differential_write'] = True
+        image_info['disk_format'] = 'raw'
+        image_info['chunk_manifest'] = self._chunk_manifest(b'0123456789', 4)
+        standby._validate_image_info(None, image_info)
+        for field, value in (('chunk_manifest', None),
+                             ('disk_format', 'qcow2'),
+                             ('compression', 'gzip'),
+                             ('mirror_root_device', True),
+                             ('differential_write', 'yes')):
+            invalid_info = dict(image_info)
+            invalid_info[field] = value
+            self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                    'differential_write',
+                                    standby._validate_image_info,
+                                    None, invalid_info)
+
+    def test_validate_image_info_peers(self):
+        image_info = self._build_fake_image_info()
+        image_info['chunk_manifest'] = self._chunk_manifest(b'0123456789', 4)
+        image_info['peers'] = ['http://10.0.0.2:9999']
+        standby._validate_image_info(None, image_info)
+
+        image_info['peers'] = 'http://10.0.0.2:9999'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError, 'peers',
+                                standby._validate_image_info,
+                                None, image_info)
+        image_info['peers'] = ['http://10.0.0.2:9999']
+        # The last one misses the checksum of a chunk
+        for manifest in ({'size': 10, 'chunk_size': 4},
+                         {'size': 10, 'chunk_size': 0, 'checksums': []},
+                         'manifest',
+                         dict(self._chunk_manifest(b'0123456789', 5),
+                              size=11)):
+            image_info['chunk_manifest'] = manifest
+            self.assertRaisesRegexp(errors.InvalidCommandParamsError,
+                                    'chunk_manifest',
+                                    standby._validate_image_info,
+                                    None, image_info)
+        del image_info['chunk_manifest']
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError, 'peers',
+                                standby._validate_image_info,
+                                None, image_info)
+
+    def _build_fake_partition_image_info(self):
+        return {
+            'id': 'fake_id',
+            'disk_label': 'gpt',
+            'partitions': [
+                {'name': 'efi', 'size_mb': 512, 'type': 'efi',
+                 'filesystem': 'vfat', 'label': 'EFI'},
+                {'name': 'swap', 'size_mb': 1024, 'type': 'swap',
+                 'filesystem': 'swap'},
+                {'name': 'root', 'image': self._build_fake_image_info()},
+            ]
+        }
+
+    def test_validate_image_info_partitions(self):
+        image_info = self._build_fake_partition_image_info()
+        standby._validate_image_info(None, image_info)
+        # The configdrive partition does not fit in an msdos table
+        image_info['disk_label'] = 'msdos'
+        image_info['partitions'].insert(0, {'name': 'data', 'size_mb': 1})
+        standby._validate_image_info(None, image_info)
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError, 'at most 4',
+                                standby._validate_image_info, None,
+                                image_info, configdrive='configdrive_data')
+
+    def test_validate_image_info_invalid_partitions(self):
+        for field, value, regexp in (
+                ('disk_label', 'sun', 'disk_label'),
+                ('partitions', [], 'partitions'),
+                ('partitions', [{'size_mb': 1}], 'name'),
+                ('partitions', [{'name': 'a', 'size_mb': 1},
+                                {'name': 'a'}], 'more than once'),
+                ('partitions', [{'name': 'a'}, {'name': 'b'}], 'size_mb'),
+                ('partitions', [{'name': 'a', 'size_mb': 0}], 'size_mb'),
+                ('partitions', [{'name': 'a', 'type': 'ntfs'}], 'type'),
+                ('partitions', [{'name': 'a', 'bootable': 'yes'}],
+                 'bootable'),
+                ('partitions', [{'name': 'a', 'filesystem': 'ext4',
+                                 'image': {}}], 'both'),
+                ('partitions', [{'name': 'a', 'filesystem': ''}],
+                 'filesystem'),
+                ('partitions', [{'name': 'a', 'image': {'id': 'b'}}],
+                 'urls')):
+            image_info = self._build_fake_partition_image_info()
+            image_info[field] = value
+            self.assertRaisesRegexp(errors.InvalidCommandParamsError, regexp,
+                                    standby._validate_image_info,
+                                    None, image_info)
+        image_info = self._build_fake_partition_image_info()
+        image_info['disk_label'] = 'msdos'
+        image_info['partitions'][0]['type'] = 'bios_grub'
+        self.assertRaisesRegexp(errors.InvalidCommandParamsError, 'gpt',
+                                standby._validate_image_info,
+                                None, image_info)
+
     def test_cache_image_invalid_image_list(self):
         self.assertRaises(errors.InvalidCommandParamsError,
                           self.agent_extension.cache_image,
@@ -118,83 +324,528 @@ class TestStandbyExtension(test_base.BaseTestCase):
 
         execute_mock.assert_called_once_with(*command, check_exit_code=[0])
 
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch.object(standby, '_write_raw_image', autospec=True)
+    def test_write_image_raw(self, write_raw_mock, execute_mock):
+        image_info = self._build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+
+        standby._write_image(image_info, '/dev/sda')
+        write_raw_mock.assert_called_once_with('/tmp/fake_id', '/dev/sda',
+                                               None, mock.ANY)
+        self.assertFalse(execute_mock.called)
+
+    def _write_with_image_writer(self, device, chunks):
+        writer = standby._ImageWriter(device)
+        writer.start()
+        for chunk in chunks:
+            writer.put(chunk)
+        writer.close()
+        self.assertIsNone(writer.error)
+        return writer
+
+    def test_image_writer_sparse_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+        zeros = b'\0' * block
+        image = (b'a' * block + zeros * 3 + b'b' * (block - 1) + b'\0' +
+                 zeros * 2)
+        # Chunks not aligned on blocks
+        chunks = [image[i:i + 1000] for i in range(0, len(image), 1000)]
+
+        writer = self._write_with_image_writer(path, chunks)
+        with open(path, 'rb') as f:
+            self.assertEqual(image, f.read())
+        self.assertEqual(5 * block, writer.bytes_skipped)
+        self.assertEqual(2 * block, writer.bytes_written)
+
+    def test_image_writer_offsets(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+
+        writer = standby._ImageWriter(path)
+        writer.start()
+        writer.put(b'b' * block, 3 * block)
+        writer.put(b'a' * 10, 0)
+        writer.put(b'c' * 10)
+        writer.put(b'd' * block, 5 * block)
+        writer.put(b'', 7 * block)
+        writer.close()
+        self.assertIsNone(writer.error)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'a' * 10 + b'c' * 10 + b'\0' * (3 * block - 20) +
+                             b'b' * block + b'\0' * block + b'd' * block +
+                             b'\0' * block, f.read())
+
+    def _temp_device(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_image_writer_extents(self):
+        path = self._temp_device()
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+        extents = standby._ImageExtents(path)
+
+        writer = standby._ImageWriter(path, extents)
+        writer.start()
+        writer.put(b'a' * block + b'\0' * block + b'b' * block)
+        writer.put(b'c' * 10, 5 * block)
+        writer.close()
+        self.assertIsNone(writer.error)
+        self.assertFalse(extents.is_alive())
+        self.assertEqual([[0, block], [2 * block, block], [5 * block, 10]],
+                         extents.extents)
+        self.assertEqual(
+            [hashlib.sha256(b'a' * block + b'b' * block +
+                            b'c' * 10).hexdigest()],
+            extents.block_digests)
+
+    def test_image_mirror(self):
+        paths = [self._temp_device(), self._temp_device()]
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+        extents = [standby._ImageExtents(path) for path in paths]
+        progress = standby._ImageProgress()
+
+        mirror = standby._ImageMirror(paths, extents, progress)
+        mirror.start()
+        mirror.put(b'a' * block + b'\0' * block)
+        mirror.put(b'b' * 10, 3 * block)
+        mirror.close()
+        self.assertIsNone(mirror.error)
+        for path, path_extents in zip(paths, extents):
+            with open(path, 'rb') as f:
+                self.assertEqual(b'a' * block + b'\0' * 2 * block +
+                                 b'b' * 10, f.read())
+            self.assertEqual([[0, block], [3 * block, 10]],
+                             path_extents.extents)
+        # The bytes of the image are counted once
+        self.assertEqual(3 * block + 10, progress.bytes_written)
+
+    def test_image_mirror_error(self):
+        paths = [self._temp_device(), '/nonexistent/device']
+        mirror = standby._ImageMirror(paths)
+        mirror.start()
+        mirror.put(b'somecontent')
+        mirror.close()
+        self.assertIsInstance(mirror.error, IOError)
+
+    def test_image_writer_progress(self):
+        path = self._temp_device()
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+        progress = standby._ImageProgress()
+
+        writer = standby._ImageWriter(path, progress=progress)
+        writer.start()
+        writer.put(b'a' * block + b'\0' * 2 * block)
+        writer.put(b'b' * 10, 5 * block)
+        writer.close()
+        self.assertIsNone(writer.error)
+        # Zeros and holes are part of the image handled by the writer
+        self.assertEqual(5 * block + 10, progress.bytes_written)
+        self.assertEqual(0, progress.bytes_downloaded)
+
+    @mock.patch('time.time', autospec=True)
+    def test_image_progress(self, time_mock):
+        command = mock.Mock()
+        mb = 1024 * 1024
+        progress = standby._ImageProgress(command)
+        time_mock.return_value = 100.0
+        progress.start_phase('downloading', 4 * mb)
+        command.update_progress.assert_called_once_with(
+            phase='downloading', total_bytes=4 * mb, bytes_downloaded=0,
+            bytes_written=0, throughput=None, eta=None)
+
+        # Updates are limited to one per IMAGE_PROGRESS_INTERVAL
+        time_mock.return_value = 100.5
+        progress.downloaded(mb)
+        progress.written(mb)
+        self.assertEqual(1, command.update_progress.call_count)
+
+        time_mock.return_value = 102.0
+        progress.downloaded(mb)
+        command.update_progress.assert_called_with(
+            phase='downloading', total_bytes=4 * mb, bytes_downloaded=2 * mb,
+            bytes_written=mb, throughput=1.0, eta=2)
+
+        # Written bytes are tracked while writing a staged image
+        time_mock.return_value = 110.0
+        progress.start_phase('writing', 2 * mb)
+        time_mock.return_value = 111.0
+        progress.written(mb)
+        command.update_progress.assert_called_with(
+            phase='writing', total_bytes=2 * mb, bytes_downloaded=2 * mb,
+            bytes_written=2 * mb, throughput=1.0, eta=1)
+
+    def _write_cached_image(self, image_info, device, data):
+        extents = standby._ImageExtents(device)
+        writer = standby._ImageWriter(device, extents)
+        writer.start()
+        writer.put(data)
+        writer.close()
+        standby._save_image_cache_manifest(image_info, device, extents)
+
+    def test_image_on_device(self):
+        device = self._temp_device()
+        image_info = self._build_fake_image_info()
+        self._write_cached_image(image_info, device, b'somecontent')
+        with open(self.manifest) as f:
+            manifest = json.load(f)
+        self.assertEqual('fake_id', manifest['image_id'])
+        self.assertEqual({'md5': 'abc123'}, manifest['checksums'])
+        self.assertEqual(device, manifest['device'])
+        self.assertEqual([[0, 11]], manifest['extents'])
+
+        self.assertTrue(standby._image_on_device(image_info, device))
+        # The same content under another ID
+        image_info['id'] = 'other_id'
+        self.assertTrue(standby._image_on_device(image_info, device))
+        self.assertFalse(standby._image_on_device(image_info, '/dev/sdb'))
+        image_info['checksum'] = 'def456'
+        self.assertFalse(standby._image_on_device(image_info, device))
+
+    def test_image_on_device_changed(self):
+        device = self._temp_device()
+        image_info = self._build_fake_image_info()
+        self._write_cached_image(image_info, device, b'somecontent')
+        with open(device, 'r+b') as f:
+            f.write(b'new')
+        self.assertFalse(standby._image_on_device(image_info, device))
+        with open(device, 'wb') as f:
+            f.write(b'some')
+        self.assertFalse(standby._image_on_device(image_info, device))
+
+    def test_image_on_device_no_manifest(self):
+        image_info = self._build_fake_image_info()
+        self.assertFalse(standby._image_on_device(image_info, '/dev/sda'))
+        with open(self.manifest, 'w') as f:
+            f.write('{not json')
+        self.assertFalse(standby._image_on_device(image_info, '/dev/sda'))
+        self.config(image_cache_manifest='')
+        self.assertFalse(standby._image_on_device(image_info, '/dev/sda'))
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_cache_image_after_restart(self, get_mock, dispatch_mock):
+        device = self._temp_device()
+        image_info = self._build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(b'somecontent').hexdigest()
+        image_info['stream_raw_images'] = True
+        image_info['disk_format'] = 'raw'
+        dispatch_mock.return_value = device
+        get_mock.return_value = self._fake_response(200,
+                                                    [b'some', b'content'])
+        self.agent_extension.cache_image(image_info=image_info).join()
+        self.assertTrue(os.path.exists(self.manifest))
+
+        # A new extension, as after the agent restarted
+        extension = standby.StandbyExtension()
+        async_result = extension.cache_image(image_info=image_info).join()
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        self.assertEqual('cache_image: image (fake_id) already present on '
+                         'device {0}'.format(device),
+                         async_result.command_result['result'])
+        self.assertEqual('fake_id', extension.cached_image_id)
+        self.assertEqual(1, get_mock.call_count)
+
+        # Forcing the write clears the manifest first
+        get_mock.return_value = self._fake_response(200, [b'other'])
+        async_result = extension.cache_image(image_info=image_info,
+                                             force=True).join()
+        self.assertEqual('FAILED', async_result.command_status)
+        self.assertFalse(os.path.exists(self.manifest))
+
+    @mock.patch.object(standby, '_image_on_device', autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_prepare_image_on_device(self, download_mock, write_mock,
+                                     dispatch_mock, on_device_mock):
+        image_info = self._build_fake_image_info()
+        dispatch_mock.return_value = 'manager'
+        on_device_mock.return_value = True
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info).join()
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        on_device_mock.assert_called_once_with(image_info, 'manager')
+        self.assertFalse(download_mock.called)
+        self.assertFalse(write_mock.called)
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('os.fsync', autospec=True)
+    @mock.patch(OPEN_FUNCTION_NAME)
+    @mock.patch.object(standby, '_sparse_write_mode', autospec=True)
+    def test_image_writer_zeroout(self, mode_mock, open_mock, fsync_mock,
+                                  ioctl_mock):
+        mode_mock.return_value = 'zeroout'
+        file_mock = open_mock.return_value.__enter__.return_value
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+        zeros = b'\0' * block
+
+        writer = standby._ImageWriter('/dev/sda')
+        writer.start()
+        writer.put(zeros)
+        writer.put(b'b' * block, 3 * block)
+        writer.close()
+        self.assertIsNone(writer.error)
+        # Zeros in the image are written, holes are cleared by the kernel
+        ioctl_mock.assert_called_once_with(
+            file_mock.fileno.return_value, standby.BLKZEROOUT,
+            struct.pack('QQ', block, 2 * block))
+        file_mock.write.assert_has_calls([mock.call(zeros),
+                                          mock.call(b'b' * block)])
+        self.assertEqual(2 * block, writer.bytes_skipped)
+        self.assertEqual(2 * block, writer.bytes_written)
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('os.fsync', autospec=True)
+    @mock.patch(OPEN_FUNCTION_NAME)
+    @mock.patch.object(standby, '_sparse_write_mode', autospec=True)
+    def test_image_writer_write_zeroes(self, mode_mock, open_mock,
+                                       fsync_mock, ioctl_mock):
+        mode_mock.return_value = 'write_zeroes'
+        file_mock = open_mock.return_value.__enter__.return_value
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+        zeros = b'\0' * block
+
+        writer = self._write_with_image_writer(
+            '/dev/sda', [b'a' * block, zeros * 2, b'b' * block])
+        ioctl_mock.assert_called_once_with(
+            file_mock.fileno.return_value, standby.BLKZEROOUT,
+            struct.pack('QQ', block, 2 * block))
+        file_mock.seek.assert_has_calls([mock.call(0),
+                                         mock.call(3 * block)])
+        file_mock.write.assert_has_calls([mock.call(b'a' * block),
+                                          mock.call(b'b' * block)])
+        self.assertFalse(file_mock.truncate.called)
+        self.assertEqual(2 * block, writer.bytes_skipped)
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('os.fsync', autospec=True)
+    @mock.patch(OPEN_FUNCTION_NAME)
+    @mock.patch.object(standby, '_sparse_write_mode', autospec=True)
+    def test_image_writer_write_zeroes_fails(self, mode_mock, open_mock,
+                                             fsync_mock, ioctl_mock):
+        mode_mock.return_value = 'write_zeroes'
+        ioctl_mock.side_effect = IOError('Operation not supported')
+        file_mock = open_mock.return_value.__enter__.return_value
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+        zeros = b'\0' * block
+
+        writer = self._write_with_image_writer(
+            '/dev/sda', [zeros, b'b' * block, zeros])
+        self.assertEqual(1, ioctl_mock.call_count)
+        file_mock.write.assert_has_calls([mock.call(zeros),
+                                          mock.call(b'b' * block + zeros)])
+        self.assertEqual(0, writer.bytes_skipped)
+        self.assertEqual(3 * block, writer.bytes_written)
+
+    @mock.patch('os.stat', autospec=True)
+    def test_sparse_write_mode(self, stat_mock):
+        stat_mock.return_value.st_mode = stat.S_IFREG
+        self.assertEqual('seek', standby._sparse_write_mode('/tmp/foo'))
+
+        stat_mock.side_effect = OSError('No such file or directory')
+        self.assertEqual('seek', standby._sparse_write_mode('/tmp/foo'))
+
+    @mock.patch(OPEN_FUNCTION_NAME)
+    @mock.patch('os.stat', autospec=True)
+    def test_sparse_write_mode_block_device(self, stat_mock, open_mock):
+        stat_mock.return_value.st_mode = stat.S_IFBLK
+        read_mock = open_mock.return_value.__enter__.return_value.read
+        read_mock.return_value = '33550336\n'
+        self.assertEqual('write_zeroes',
+                         standby._sparse_write_mode('/dev/sda'))
+        open_mock.assert_called_once_with(
+            '/sys/class/block/sda/queue/write_zeroes_max_bytes')
+
+        read_mock.return_value = '0\n'
+        self.assertEqual('zeroout', standby._sparse_write_mode('/dev/sda'))
+
+        open_mock.side_effect = IOError('No such file or directory')
+        self.assertEqual('zeroout', standby._sparse_write_mode('/dev/sda'))
+
+        stat_mock.return_value.st_mode = stat.S_IFCHR
+        self.assertIsNone(standby._sparse_write_mode('/dev/sda'))
+
     def test_configdrive_is_url(self):
         self.assertTrue(standby._configdrive_is_url('http://some/url'))
         self.assertTrue(standby._configdrive_is_url('https://some/url'))
         self.assertFalse(standby._configdrive_is_url('ftp://some/url'))
         self.assertFalse(standby._configdrive_is_url('binary-blob'))
 
-    @mock.patch.object(standby, '_write_configdrive_to_file')
+    def _configdrive(self, data):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress(data) + compressor.flush()
+        return base64.b64encode(gzipped).decode('ascii')
+
+    def _configdrive_partition(self, partition_mock):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        partition_mock.return_value = path
+        return path
+
+    def test_b64decode_chunks(self):
+        data = os.urandom(1000)
+        encoded = base64.b64encode(data)
+        # Line breaks every 76 characters
+        encoded = b'\n'.join(encoded[i:i + 76]
+                              for i in range(0, len(encoded), 76))
+        for size in (1, 7, 100, len(encoded)):
+            chunks = [encoded[i:i + size]
+                      for i in range(0, len(encoded), size)]
+            self.assertEqual(
+                data, b''.join(standby._b64decode_chunks(chunks)))
+
+    def test_b64decode_chunks_invalid(self):
+        self.assertRaises(errors.ConfigDriveFormatError, list,
+                          standby._b64decode_chunks([b'abc']))
+
+    @mock.patch.object(standby, 'CONFIGDRIVE_CHUNK_SIZE', 100)
+    def test_gunzip_chunks(self):
+        data = b'a' * 10000 + os.urandom(1000)
+        gzipped = base64.b64decode(self._configdrive(data))
+        chunks = [gzipped[i:i + 50] for i in range(0, len(gzipped), 50)]
+
+        output = list(standby._gunzip_chunks(chunks))
+        self.assertEqual(data, b''.join(output))
+        self.assertEqual(100, max(len(o) for o in output))
+
+    def test_gunzip_chunks_invalid(self):
+        self.assertRaises(errors.ConfigDriveFormatError, list,
+                          standby._gunzip_chunks([b'not gzip data']))
+        gzipped = base64.b64decode(self._configdrive(os.urandom(1000)))
+        if six.PY3:
+            self.assertRaises(errors.ConfigDriveFormatError, list,
+                              standby._gunzip_chunks([gzipped[:500]]))
+
+    @mock.patch.object(partitions, 'add_partition', autospec=True)
+    @mock.patch.object(partitions, 'find_partition', autospec=True)
+    def test_configdrive_partition(self, find_mock, add_mock):
+        find_mock.return_value = '/dev/sda2'
+
+        self.assertEqual('/dev/sda2',
+                         standby._configdrive_partition('/dev/sda'))
+        find_mock.assert_called_once_with('/dev/sda', label='config-2')
+        self.assertFalse(add_mock.called)
+
+        find_mock.return_value = None
+        add_mock.return_value = '/dev/sda3'
+        self.assertEqual('/dev/sda3',
+                         standby._configdrive_partition('/dev/sda'))
+        add_mock.assert_called_once_with('/dev/sda',
+                                         standby.CONFIGDRIVE_MAX_SIZE)
+
+    @mock.patch.object(standby, 'CONFIGDRIVE_CHUNK_SIZE', 1000)
+    @mock.patch.object(standby, '_configdrive_partition', autospec=True)
+    def test_write_configdrive_to_partition(self, partition_mock):
+        path = self._configdrive_partition(partition_mock)
+        data = os.urandom(10000)
+        progress = standby._ImageProgress()
+
+        standby._write_configdrive_to_partition(self._configdrive(data),
+                                                '/dev/sda',
+                                                progress=progress)
+        with open(path, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual('configdrive', progress.phase)
+        self.assertEqual(len(data), progress.bytes_written)
+
     @mock.patch('requests.get', autospec=True)
-    def test_download_configdrive_to_file(self, get_mock, write_mock):
+    @mock.patch.object(standby, '_configdrive_partition', autospec=True)
+    def test_write_configdrive_to_partition_url(self, partition_mock,
+                                                get_mock):
+        path = self._configdrive_partition(partition_mock)
         url = 'http://swift/configdrive'
-        get_mock.return_value.content = 'data'
-        standby._download_configdrive_to_file(url, 'filename')
-        get_mock.assert_called_once_with(url)
-        write_mock.assert_called_once_with('data', 'filename')
-
-    @mock.patch('gzip.GzipFile', autospec=True)
-    @mock.patch(OPEN_FUNCTION_NAME, autospec=True)
-    @mock.patch('base64.b64decode', autospec=True)
-    def test_write_configdrive_to_file(self, b64_mock, open_mock, gzip_mock):
-        open_mock.return_value.__enter__ = lambda s: s
-        open_mock.return_value.__exit__ = mock.Mock()
-        write_mock = open_mock.return_value.write
-        gzip_read_mock = gzip_mock.return_value.read
-        gzip_read_mock.return_value = 'ungzipped'
-        b64_mock.return_value = 'configdrive_data'
-        filename = standby._configdrive_location()
-
-        standby._write_configdrive_to_file('b64data', filename)
-        open_mock.assert_called_once_with(filename, 'wb')
-        gzip_read_mock.assert_called_once_with()
-        write_mock.assert_called_once_with('ungzipped')
+        data = os.urandom(10000)
+        encoded = self._configdrive(data).encode('ascii')
+        get_mock.return_value.status_code = 200
+        get_mock.return_value.iter_content.return_value = [
+            encoded[i:i + 1000] for i in range(0, len(encoded), 1000)]
+        progress = standby._ImageProgress()
+
+        standby._write_configdrive_to_partition(url, '/dev/sda',
+                                                progress=progress)
+        get_mock.assert_called_once_with(url, stream=True)
+        get_mock.return_value.iter_content.assert_called_once_with(
+            standby.CONFIGDRIVE_CHUNK_SIZE)
+        with open(path, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual(len(encoded), progress.bytes_downloaded)
 
-    @mock.patch('os.stat', autospec=True)
-    @mock.patch(('ironic_python_agent.extensions.standby.'
-                 '_write_configdrive_to_file'),
-                autospec=True)
-    @mock.patch(OPEN_FUNCTION_NAME, autospec=True)
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_write_configdrive_to_partition(self, execute_mock, open_mock,
-                                            configdrive_mock, stat_mock):
-        device = '/dev/sda'
-        configdrive = standby._configdrive_location()
-        script = standby._path_to_script('shell/copy_configdrive_to_disk.sh')
-        command = ['/bin/bash', script, configdrive, device]
-        execute_mock.return_value = ('', '')
-        stat_mock.return_value.st_size = 5
-
-        standby._write_configdrive_to_partition(configdrive, device)
-        execute_mock.assert_called_once_with(*command, check_exit_code=[0])
+    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(standby, '_configdrive_partition', autospec=True)
+    def test_write_configdrive_to_partition_url_not_found(self,
+                                                          partition_mock,
+                                                          get_mock):
+        path = self._configdrive_partition(partition_mock)
+        get_mock.return_value.status_code = 404
+        get_mock.return_value.text = 'Not Found'
+
+        self.assertRaisesRegexp(errors.ConfigDriveDownloadError,
+                                'status code 404',
+                                standby._write_configdrive_to_partition,
+                                'http://swift/configdrive', '/dev/sda')
+        self.assertFalse(get_mock.return_value.iter_content.called)
+        self.assertEqual(0, os.stat(path).st_size)
 
-        execute_mock.reset_mock()
-        execute_mock.return_value = ('', '')
-        execute_mock.side_effect = processutils.ProcessExecutionError
+    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(standby, '_configdrive_partition', autospec=True)
+    def test_write_configdrive_to_partition_url_error(self, partition_mock,
+                                                      get_mock):
+        path = self._configdrive_partition(partition_mock)
+        get_mock.side_effect = requests.ConnectionError('refused')
+
+        self.assertRaisesRegexp(errors.ConfigDriveDownloadError, 'refused',
+                                standby._write_configdrive_to_partition,
+                                'http://swift/configdrive', '/dev/sda')
+        self.assertEqual(0, os.stat(path).st_size)
+
+    @mock.patch.object(standby, 'CONFIGDRIVE_MAX_SIZE', 5000)
+    @mock.patch.object(standby, '_configdrive_partition', autospec=True)
+    def test_write_configdrive_too_large(self, partition_mock):
+        path = self._configdrive_partition(partition_mock)
+        configdrive = self._configdrive(b'a' * 5001)
 
-        self.assertRaises(errors.ConfigDriveWriteError,
+        self.assertRaises(errors.ConfigDriveTooLargeError,
                           standby._write_configdrive_to_partition,
                           configdrive,
-                          device)
+                          '/dev/sda')
+        self.assertEqual(0, os.stat(path).st_size)
 
-        execute_mock.assert_called_once_with(*command, check_exit_code=[0])
+    @mock.patch.object(standby, '_configdrive_partition', autospec=True)
+    def test_write_configdrive_invalid(self, partition_mock):
+        self._configdrive_partition(partition_mock)
+
+        self.assertRaises(errors.ConfigDriveFormatError,
+                          standby._write_configdrive_to_partition,
+                          'not a configdrive',
+                          '/dev/sda')
 
-    @mock.patch('os.stat', autospec=True)
-    @mock.patch(('ironic_python_agent.extensions.standby.'
-                 '_write_configdrive_to_file'),
-                autospec=True)
     @mock.patch(OPEN_FUNCTION_NAME, autospec=True)
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_write_configdrive_too_large(self, execute_mock, open_mock,
-                                         configdrive_mock, stat_mock):
-        device = '/dev/sda'
-        configdrive = standby._configdrive_location()
-        stat_mock.return_value.st_size = 65 * 1024 * 1024
+    @mock.patch.object(standby, '_configdrive_partition', autospec=True)
+    def test_write_configdrive_write_error(self, partition_mock, open_mock):
+        partition_mock.return_value = '/dev/sda2'
+        open_mock.side_effect = IOError(5, 'Input/output error')
 
-        self.assertRaises(errors.ConfigDriveTooLargeError,
+        self.assertRaises(errors.ConfigDriveWriteError,
                           standby._write_configdrive_to_partition,
-                          configdrive,
-                          device)
+                          self._configdrive(b'data'),
+                          '/dev/sda')
+        open_mock.assert_called_once_with('/dev/sda2', 'wb')
 
     @mock.patch('hashlib.md5')
     @mock.patch(OPEN_FUNCTION_NAME)
@@ -203,7 +854,7 @@ class TestStandbyExtension(test_base.BaseTestCase):
         image_info = self._build_fake_image_info()
         response = requests_mock.return_value
         response.status_code = 200
-        response.iter_content.return_value = ['some', 'content']
+        response.iter_content.return_value = [b'some', b'content']
         file_mock = mock.Mock()
         open_mock.return_value.__enter__.return_value = file_mock
         file_mock.read.return_value = None
@@ -214,9 +865,15 @@ class TestStandbyExtension(test_base.BaseTestCase):
         requests_mock.assert_called_once_with(image_info['urls'][0],
                                               stream=True)
         write = file_mock.write
-        write.assert_any_call('some')
-        write.assert_any_call('content')
+        write.assert_any_call(b'some')
+        write.assert_any_call(b'content')
         self.assertEqual(write.call_count, 2)
+        # The checksum is computed while downloading, the image is not
+        # read back from disk
+        open_mock.assert_called_once_with('/tmp/fake_id', 'wb')
+        self.assertFalse(file_mock.read.called)
+        md5_mock.return_value.update.assert_has_calls(
+            [mock.call(b'some'), mock.call(b'content')])
 
     @mock.patch('requests.get', autospec=True)
     def test_download_image_bad_status(self, requests_mock):
@@ -241,34 +898,844 @@ class TestStandbyExtension(test_base.BaseTestCase):
                           standby._download_image,
                           image_info)
 
+    @mock.patch('os.fsync', autospec=True)
     @mock.patch(OPEN_FUNCTION_NAME)
-    @mock.patch('hashlib.md5')
-    def test_verify_image_success(self, md5_mock, open_mock):
+    @mock.patch('requests.get')
+    def test_stream_image_onto_device(self, requests_mock, open_mock,
+                                      fsync_mock):
         image_info = self._build_fake_image_info()
-        hexdigest_mock = md5_mock.return_value.hexdigest
-        hexdigest_mock.return_value = image_info['checksum']
+        image_info['checksum'] = hashlib.md5(b'somecontent').hexdigest()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
         file_mock = mock.Mock()
-        file_mock.read.return_value = None
         open_mock.return_value.__enter__.return_value = file_mock
-        image_location = '/foo/bar'
 
-        verified = standby._verify_image(image_info, image_location)
-        self.assertTrue(verified)
-        self.assertEqual(1, md5_mock.call_count)
+        standby._stream_image_onto_device(image_info, '/dev/foo')
+        requests_mock.assert_called_once_with(image_info['urls'][0],
+                                              stream=True)
+        open_mock.assert_called_once_with('/dev/foo', 'wb')
+        file_mock.write.assert_called_once_with(b'somecontent')
+        fsync_mock.assert_called_once_with(file_mock.fileno.return_value)
 
+    @mock.patch('os.fsync', autospec=True)
     @mock.patch(OPEN_FUNCTION_NAME)
-    @mock.patch('hashlib.md5')
-    def test_verify_image_failure(self, md5_mock, open_mock):
+    @mock.patch('requests.get')
+    def test_stream_image_onto_device_write_error(self, requests_mock,
+                                                  open_mock, fsync_mock):
         image_info = self._build_fake_image_info()
-        md5_mock.return_value.hexdigest.return_value = 'wrong hash'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
+        file_mock = mock.Mock()
+        file_mock.write.side_effect = IOError('No space left on device')
+        open_mock.return_value.__enter__.return_value = file_mock
+
+        self.assertRaisesRegexp(errors.ImageDownloadError,
+                                'No space left on device',
+                                standby._stream_image_onto_device,
+                                image_info, '/dev/foo')
+        self.assertFalse(fsync_mock.called)
+
+    @mock.patch('os.fsync', autospec=True)
+    @mock.patch(OPEN_FUNCTION_NAME)
+    @mock.patch('requests.get')
+    def test_stream_image_onto_device_verify_fails(self, requests_mock,
+                                                   open_mock, fsync_mock):
+        image_info = self._build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
+        open_mock.return_value.__enter__.return_value = mock.Mock()
+
+        self.assertRaises(errors.ImageChecksumError,
+                          standby._stream_image_onto_device,
+                          image_info, '/dev/foo')
+
+    @mock.patch('os.fsync', autospec=True)
+    @mock.patch(OPEN_FUNCTION_NAME)
+    @mock.patch('requests.get')
+    @mock.patch('ironic_python_agent.qcow2.StreamDecoder', autospec=True)
+    def test_stream_image_onto_device_qcow2(self, decoder_mock,
+                                            requests_mock, open_mock,
+                                            fsync_mock):
+        image_info = self._build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['checksum'] = hashlib.md5(b'somecontent').hexdigest()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
         file_mock = mock.Mock()
-        file_mock.read.return_value = None
         open_mock.return_value.__enter__.return_value = file_mock
-        image_location = '/foo/bar'
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+
+        def fake_decode(chunks):
+            self.assertEqual([b'some', b'content'], list(chunks))
+            return iter([(2 * block, b'b' * block), (0, b'a' * block),
+                         (4 * block, b'')])
+
+        decoder_mock.return_value.decode.side_effect = fake_decode
+        with mock.patch.object(standby, '_sparse_write_mode',
+                               return_value='seek', autospec=True):
+            standby._stream_image_onto_device(image_info, '/dev/foo')
+        decoder_mock.assert_called_once_with(image_info['id'])
+        file_mock.seek.assert_has_calls([mock.call(2 * block),
+                                         mock.call(0)])
+        file_mock.write.assert_has_calls([mock.call(b'b' * block),
+                                          mock.call(b'a' * block)])
+        file_mock.truncate.assert_called_once_with(4 * block)
+
+    @mock.patch('requests.get')
+    @mock.patch('ironic_python_agent.qcow2.StreamDecoder', autospec=True)
+    def test_stream_image_onto_device_qcow2_unsupported(self, decoder_mock,
+                                                        requests_mock):
+        image_info = self._build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
+
+        def fake_decode(chunks):
+            for chunk in chunks:
+                raise errors.ImageFormatError(image_info['id'],
+                                              'not a qcow2 image')
+                yield
+
+        decoder_mock.return_value.decode.side_effect = fake_decode
+
+        with mock.patch.object(standby, '_ImageWriter',
+                               autospec=True) as writer_mock:
+            writer_mock.return_value.error = None
+            self.assertRaises(errors.ImageFormatError,
+                              standby._stream_image_onto_device,
+                              image_info, '/dev/foo')
+            writer_mock.return_value.close.assert_called_once_with()
+
+    def _fake_ranged_server(self, data, accept_ranges='bytes'):
+        """Mock requests.head and requests.get to serve data by ranges."""
+        def fake_head(url, **kwargs):
+            return mock.Mock(status_code=200,
+                             headers={'Accept-Ranges': accept_ranges,
+                                      'Content-Length': str(len(data))})
+
+        def fake_get(url, stream=False, headers=None):
+            resp = mock.Mock()
+            if headers and 'Range' in headers:
+                start, end = headers['Range'][len('bytes='):].split('-')
+                body = data[int(start):int(end) + 1]
+                resp.status_code = 206
+            else:
+                body = data
+                resp.status_code = 200
+            resp.iter_content.return_value = [body[i:i + 3]
+                                              for i in range(0, len(body), 3)]
+            return resp
+
+        head_patch = mock.patch('requests.head', side_effect=fake_head)
+        get_patch = mock.patch('requests.get', side_effect=fake_get)
+        self.addCleanup(head_patch.stop)
+        self.addCleanup(get_patch.stop)
+        return head_patch.start(), get_patch.start()
+
+    def _differential_image(self, old, new, chunk_size=4):
+        device = self._temp_device()
+        with open(device, 'wb') as f:
+            f.write(old)
+        image_info = self._build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['differential_write'] = True
+        image_info['chunk_manifest'] = self._chunk_manifest(new, chunk_size)
+        return image_info, device
+
+    def test_write_image_differential(self):
+        self.config(image_download_connections=2)
+        new = b'0123XXXX89abcd'
+        image_info, device = self._differential_image(b'0123456789ab', new)
+        head_mock, get_mock = self._fake_ranged_server(new)
+        progress = standby._ImageProgress()
+
+        extents = standby._write_image_differential(image_info, device,
+                                                    progress=progress)
+        with open(device, 'rb') as f:
+            self.assertEqual(new, f.read())
+        # Only the chunks which changed are downloaded
+        self.assertEqual(2, get_mock.call_count)
+        get_mock.assert_has_calls(
+            [mock.call('http://example.org', stream=True,
+                       headers={'Range': 'bytes=4-7'}),
+             mock.call('http://example.org', stream=True,
+                       headers={'Range': 'bytes=12-13'})], any_order=True)
+        self.assertEqual(6, progress.bytes_written)
+        self.assertEqual([[0, 14]], extents.extents)
+        self.assertEqual(4, extents.block_size)
+        self.assertEqual(image_info['chunk_manifest']['checksums'],
+                         extents.block_digests)
+
+    def test_write_image_differential_checksum_mismatch(self):
+        old = b'0123456789ab'
+        image_info, device = self._differential_image(old, b'0123XXXX89ab')
+        self._fake_ranged_server(b'0123YYYY89ab')
+
+        self.assertRaisesRegexp(errors.ImageDownloadError, 'chunk manifest',
+                                standby._write_image_differential,
+                                image_info, device)
+        with open(device, 'rb') as f:
+            self.assertEqual(old, f.read())
 
-        verified = standby._verify_image(image_info, image_location)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_cache_image_differential(self, dispatch_mock):
+        new = b'0123XXXX89ab'
+        image_info, device = self._differential_image(b'0123456789ab', new)
+        image_info['verify_after_write'] = True
+        dispatch_mock.return_value = device
+        self._fake_ranged_server(new)
+
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        self.assertTrue(
+            async_result.command_result['verification']['verified'])
+        # The chunks written are recorded to check the device after a
+        # restart
+        self.assertTrue(standby._image_on_device(image_info, device))
+        with open(self.manifest) as f:
+            self.assertEqual(4, json.load(f)['block_size'])
+
+    def test_probe_ranged_urls(self):
+        image_info = self._build_fake_image_info()
+        image_info['urls'].append('http://example.com')
+        head_mock, get_mock = self._fake_ranged_server(b'0123456789')
+        self.assertEqual((10, image_info['urls']),
+                         standby._probe_ranged_urls(image_info))
+
+    def test_probe_ranged_urls_unsupported(self):
+        image_info = self._build_fake_image_info()
+        self._fake_ranged_server(b'0123456789', accept_ranges='none')
+        self.assertEqual((None, []), standby._probe_ranged_urls(image_info))
+
+    def test_ranged_image_download(self):
+        self.config(image_download_connections=3,
+                    image_download_range_size=4)
+        data = b'0123456789abcdefghij'
+        image_info = self._build_fake_image_info()
+        image_info['urls'].append('http://example.com')
+        image_info['checksum'] = hashlib.md5(data).hexdigest()
+        head_mock, get_mock = self._fake_ranged_server(data)
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(data, b''.join(image_download))
+        self.assertTrue(image_download.verify_image('/dev/foo'))
+        # 5 ranges of 4 bytes, spread over both URLs
+        self.assertEqual(5, get_mock.call_count)
+        get_mock.assert_any_call('http://example.org', stream=True,
+                                 headers={'Range': 'bytes=0-3'})
+        get_mock.assert_any_call('http://example.com', stream=True,
+                                 headers={'Range': 'bytes=4-7'})
+        get_mock.assert_any_call('http://example.org', stream=True,
+                                 headers={'Range': 'bytes=16-19'})
+
+    @mock.patch('time.sleep', autospec=True)
+    def test_ranged_image_download_range_fails(self, sleep_mock):
+        self.config(image_download_connections=2,
+                    image_download_range_size=4,
+                    image_download_retries=2)
+        image_info = self._build_fake_image_info()
+        head_mock, get_mock = self._fake_ranged_server(b'0123456789ab')
+        get_mock.side_effect = None
+        get_mock.return_value.status_code = 200
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertRaises(errors.ImageDownloadError, b''.join,
+                          image_download)
+        self.assertTrue(sleep_mock.called)
+
+    def test_ranged_image_download_fallback(self):
+        self.config(image_download_connections=3,
+                    image_download_range_size=4)
+        data = b'0123456789'
+        image_info = self._build_fake_image_info()
+        head_mock, get_mock = self._fake_ranged_server(data,
+                                                       accept_ranges='none')
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(data, b''.join(image_download))
+        get_mock.assert_called_once_with(image_info['urls'][0], stream=True)
+
+    @mock.patch.object(standby._TokenBucket, 'consume', autospec=True)
+    def test_ranged_image_download_rate_limited(self, consume_mock):
+        self.config(image_download_connections=3,
+                    image_download_range_size=4,
+                    image_download_rate_limit=2)
+        data = b'0123456789abcdefghij'
+        image_info = self._build_fake_image_info()
+        self._fake_ranged_server(data)
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(data, b''.join(image_download))
+        # All the connections share the same bucket
+        self.assertEqual(2 * 1024 * 1024, image_download._rate_limiter.rate)
+        self.assertEqual(len(data), sum(c[0][1]
+                                        for c in consume_mock.call_args_list))
+        self.assertEqual(set([image_download._rate_limiter]),
+                         set(c[0][0] for c in consume_mock.call_args_list))
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('time.time', autospec=True)
+    def test_token_bucket(self, time_mock, sleep_mock):
+        mb = 1024 * 1024
+        time_mock.return_value = 100.0
+        bucket = standby._TokenBucket(mb)
+        self.assertEqual(mb, bucket.burst)
+
+        bucket.consume(mb)
+        self.assertFalse(sleep_mock.called)
+        bucket.consume(mb // 2)
+        sleep_mock.assert_called_once_with(0.5)
+
+        # Tokens are refilled up to the burst size only
+        sleep_mock.reset_mock()
+        time_mock.return_value = 110.0
+        bucket.consume(mb)
+        self.assertFalse(sleep_mock.called)
+        bucket.consume(mb)
+        sleep_mock.assert_called_once_with(1.0)
+
+    def test_download_rate_limiter(self):
+        image_info = self._build_fake_image_info()
+        self.assertIsNone(standby._download_rate_limiter(image_info))
+
+        self.config(image_download_rate_limit=10)
+        rate_limiter = standby._download_rate_limiter(image_info)
+        self.assertEqual(10 * 1024 * 1024, rate_limiter.rate)
+
+        image_info['download_rate_limit'] = 0.5
+        rate_limiter = standby._download_rate_limiter(image_info)
+        self.assertEqual(512 * 1024, rate_limiter.rate)
+
+        image_info['download_rate_limit'] = 0
+        self.assertIsNone(standby._download_rate_limiter(image_info))
+
+    @mock.patch('random.uniform', autospec=True)
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_start_delay(self, get_mock, sleep_mock, uniform_mock):
+        self.config(image_download_start_delay=30)
+        uniform_mock.return_value = 12.5
+        get_mock.return_value = self._fake_response(200, [b'some'])
+
+        image_download = standby._ImageDownload(
+            self._build_fake_image_info())
+        self.assertEqual([b'some'], list(image_download))
+        uniform_mock.assert_called_once_with(0, 30)
+        sleep_mock.assert_called_once_with(12.5)
+
+    def _fake_peers(self, data, served, origin_data=None):
+        """Mock requests.get to serve chunks from peers and data by ranges.
+
+        :param served: dictionary of the data of the chunks each peer serves
+                       by chunk index, by peer URL.
+        """
+        origin_data = data if origin_data is None else origin_data
+
+        def fake_get(url, stream=False, headers=None, timeout=None):
+            for peer, chunks in served.items():
+                prefix = peer + '/v1/images/fake_id/chunks/'
+                if url.startswith(prefix):
+                    index = int(url[len(prefix):])
+                    if index not in chunks:
+                        return mock.Mock(status_code=404)
+                    return mock.Mock(status_code=200, content=chunks[index])
+            start, end = headers['Range'][len('bytes='):].split('-')
+            resp = mock.Mock(status_code=206, headers={})
+            resp.iter_content.return_value = [
+                origin_data[int(start):int(end) + 1]]
+            return resp
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        location_patch = mock.patch.object(
+            standby, '_image_chunks_location',
+            side_effect=lambda i: os.path.join(tmpdir, i['id'] + '.chunks'))
+        get_patch = mock.patch('requests.get', side_effect=fake_get)
+        self.addCleanup(location_patch.stop)
+        self.addCleanup(get_patch.stop)
+        self.addCleanup(setattr, standby._ImageChunks, '_current', None)
+        location_patch.start()
+        return get_patch.start()
+
+    def test_peer_image_download(self):
+        self.config(image_download_connections=2)
+        data = b'0123456789'
+        image_info = self._build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(data).hexdigest()
+        image_info['chunk_manifest'] = self._chunk_manifest(data, 4)
+        image_info['peers'] = ['http://peer1:9999', 'http://peer2:9999/']
+        # The second peer serves a corrupted chunk 1, which nobody else has
+        get_mock = self._fake_peers(data, {
+            'http://peer1:9999': {0: b'0123'},
+            'http://peer2:9999': {1: b'4444', 2: b'89'}})
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(10, image_download.size)
+        self.assertEqual(data, b''.join(image_download))
+        self.assertTrue(image_download.verify_image('/dev/foo'))
+        for peer in ('http://peer1:9999', 'http://peer2:9999'):
+            get_mock.assert_any_call(
+                peer + '/v1/images/fake_id/chunks/1',
+                timeout=standby.IMAGE_PEER_TIMEOUT)
+        # Only the chunk no peer had is fetched from the image URL
+        self.assertEqual([mock.call('http://example.org', stream=True,
+                                    headers={'Range': 'bytes=4-7'})],
+                         [c for c in get_mock.call_args_list
+                          if c[0][0] == 'http://example.org'])
+        # Chunks are checked, and served to other agents in turn
+        agent_extension = standby.StandbyExtension()
+        self.assertEqual(b'0123', agent_extension.get_image_chunk('fake_id',
+                                                                  0))
+        self.assertEqual(b'4567', agent_extension.get_image_chunk('fake_id',
+                                                                  1))
+        self.assertEqual(b'89', agent_extension.get_image_chunk('fake_id', 2))
+        self.assertIsNone(agent_extension.get_image_chunk('other_id', 0))
+
+    def test_peer_image_download_bad_origin_chunk(self):
+        data = b'0123456789'
+        image_info = self._build_fake_image_info()
+        image_info['chunk_manifest'] = self._chunk_manifest(data, 4)
+        self._fake_peers(data, {}, origin_data=b'0123xxxx89')
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertRaisesRegexp(errors.ImageDownloadError,
+                                'Chunk 1 of the image', b''.join,
+                                image_download)
+        chunks = standby._ImageChunks.get('fake_id')
+        self.assertEqual(b'0123', chunks.read(0))
+        self.assertIsNone(chunks.read(1))
+
+    def test_image_chunks_replaced(self):
+        data = b'0123456789'
+        image_info = self._build_fake_image_info()
+        image_info['chunk_manifest'] = self._chunk_manifest(data, 4)
+        self._fake_peers(data, {})
+        chunks = standby._ImageChunks.open(image_info)
+        chunks.add(2, b'89')
+        self.assertTrue(os.path.exists(chunks.path))
+
+        image_info['id'] = 'other_id'
+        other_chunks = standby._ImageChunks.open(image_info)
+        self.assertFalse(os.path.exists(chunks.path))
+        self.assertIsNone(standby._ImageChunks.get('fake_id'))
+        self.assertIs(other_chunks, standby._ImageChunks.get('other_id'))
+        self.assertIsNone(other_chunks.read(2))
+
+    def test_image_chunks_evicted(self):
+        data = b'0123456789'
+        image_info = self._build_fake_image_info()
+        image_info['chunk_manifest'] = self._chunk_manifest(data, 4)
+        self._fake_peers(data, {})
+        chunks = standby._ImageChunks.open(image_info)
+        self.assertEqual(512 * 1024 * 1024 // 4, chunks.max_chunks)
+        chunks.max_chunks = 2
+        chunks.add(2, b'89')
+        chunks.add(0, b'0123')
+        self.assertEqual(b'89', chunks.read(2))
+        # Chunk 0 was used least recently and gives up its slot
+        chunks.add(1, b'4567')
+        self.assertIsNone(chunks.read(0))
+        self.assertEqual(b'89', chunks.read(2))
+        self.assertEqual(b'4567', chunks.read(1))
+        self.assertEqual(8, os.path.getsize(chunks.path))
+
+    def _fake_response(self, status_code, chunks, error=None, headers=None):
+        def iter_content(chunk_size):
+            for chunk in chunks:
+                yield chunk
+            if error is not None:
+                raise error
+        resp = mock.Mock(status_code=status_code, headers=headers or {})
+        resp.iter_content.side_effect = iter_content
+        return resp
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_progress(self, get_mock):
+        image_info = self._build_fake_image_info()
+        get_mock.return_value = self._fake_response(
+            200, [b'some', b'content'], headers={'Content-Length': '11'})
+        progress = standby._ImageProgress()
+
+        image_download = standby._ImageDownload(image_info,
+                                                progress=progress)
+        self.assertEqual(11, image_download.size)
+        self.assertEqual([b'some', b'content'], list(image_download))
+        self.assertEqual(11, progress.bytes_downloaded)
+
+    def _prefetch_location(self):
+        path = os.path.join(tempfile.mkdtemp(), 'image.prefetch')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        patcher = mock.patch.object(standby, 'IMAGE_PREFETCH_LOCATION', path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, standby._ImagePrefetch, '_current', None)
+        return path
+
+    def test_prefetch_image_info(self):
+        node = {'instance_info': {'image_source': 'fake_id',
+                                  'image_url': 'http://example.org',
+                                  'image_checksum': 'abc123'}}
+        self.assertIsNone(standby._prefetch_image_info(node))
+        self.config(image_prefetch=True)
+        self.assertEqual(self._build_fake_image_info(),
+                         standby._prefetch_image_info(node))
+        self.assertIsNone(standby._prefetch_image_info({}))
+        self.config(image_prefetch_url='http://example.com')
+        self.assertEqual({'id': 'http://example.com',
+                          'urls': ['http://example.com']},
+                         standby._prefetch_image_info(node))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_prefetch_image_complete(self, get_mock):
+        self.config(image_prefetch_url='http://example.org')
+        path = self._prefetch_location()
+        get_mock.return_value = self._fake_response(
+            200, [b'some', b'content'], headers={'Content-Length': '11'})
+
+        prefetch = self.agent_extension.prefetch_image()
+        prefetch.join()
+        self.assertTrue(prefetch.complete)
+
+        # The image is served from the prefetched data
+        image_download = standby._ImageDownload(
+            self._build_fake_image_info())
+        self.assertEqual(11, image_download.size)
+        self.assertEqual(b'somecontent', b''.join(image_download))
+        get_mock.assert_called_once_with(
+            'http://example.org', stream=True,
+            timeout=standby.IMAGE_PREFETCH_TIMEOUT)
+        self.assertFalse(os.path.exists(path))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_prefetch_image_mirror(self, get_mock):
+        path = self._prefetch_location()
+        get_mock.side_effect = [
+            requests.ConnectionError('refused'),
+            self._fake_response(200, [b'some', b'content'],
+                                headers={'Content-Length': '11'}),
+        ]
+        image_info = self._build_fake_image_info()
+        image_info['urls'] = ['http://example.net', 'http://example.org']
+
+        prefetch = standby._ImagePrefetch.start_for(image_info)
+        prefetch.join()
+        self.assertTrue(prefetch.complete)
+        get_mock.assert_called_with('http://example.org', stream=True,
+                                    timeout=standby.IMAGE_PREFETCH_TIMEOUT)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'somecontent', f.read())
+
+    @mock.patch('requests.get', autospec=True)
+    def test_prefetch_image_max_size(self, get_mock):
+        self.config(image_prefetch_max_size=1)
+        self._prefetch_location()
+        mb = 1024 * 1024
+        get_mock.side_effect = [
+            self._fake_response(200, [b'a' * (mb - 2), b'bbbb', b'c'],
+                                headers={'Content-Length': str(mb + 3)}),
+            self._fake_response(206, [b'bbc'],
+                                headers={'Content-Length': '3'}),
+        ]
+        image_info = self._build_fake_image_info()
+
+        prefetch = standby._ImagePrefetch.start_for(image_info)
+        prefetch.join()
+        self.assertFalse(prefetch.complete)
+        self.assertEqual(mb, prefetch.bytes_downloaded)
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(b'a' * (mb - 2) + b'bbbbc', b''.join(image_download))
+        get_mock.assert_called_with('http://example.org', stream=True,
+                                    headers={'Range': 'bytes=%d-' % mb})
+
+    @mock.patch.object(standby, 'IMAGE_PREFETCH_TIMEOUT', 0.1)
+    @mock.patch('requests.get', autospec=True)
+    def test_prefetch_image_not_stopped(self, get_mock):
+        path = self._prefetch_location()
+        requested = threading.Event()
+        release = threading.Event()
+
+        def stuck(*args, **kwargs):
+            requested.set()
+            release.wait()
+            raise requests.ConnectionError('timed out')
+
+        get_mock.side_effect = stuck
+        image_info = self._build_fake_image_info()
+        prefetch = standby._ImagePrefetch.start_for(image_info)
+        requested.wait()
+        with open(path, 'wb') as f:
+            f.write(b'stale')
+
+        # The command does not wait for the stuck prefetch
+        self.assertIsNone(standby._ImagePrefetch.take(image_info))
+        self.assertTrue(prefetch.is_alive())
+        release.set()
+        prefetch.join()
+        self.assertFalse(os.path.exists(path))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_prefetch_image_resumed(self, get_mock):
+        self.config(image_prefetch=True, image_download_retries=0)
+        path = self._prefetch_location()
+        get_mock.side_effect = [
+            self._fake_response(200, [b'some'],
+                                error=requests.ConnectionError('reset'),
+                                headers={'Content-Length': '11'}),
+            self._fake_response(206, [b'content'],
+                                headers={'Content-Length': '7'}),
+        ]
+
+        prefetch = self.agent_extension.prefetch_image(
+            {'instance_info': {'image_source': 'fake_id',
+                               'image_url': 'http://example.net'}})
+        prefetch.join()
+        self.assertFalse(prefetch.complete)
+        self.assertEqual(4, prefetch.bytes_downloaded)
+
+        image_download = standby._ImageDownload(
+            self._build_fake_image_info())
+        self.assertEqual(11, image_download.size)
+        self.assertEqual(b'somecontent', b''.join(image_download))
+        get_mock.assert_called_with('http://example.org', stream=True,
+                                    headers={'Range': 'bytes=4-'})
+        self.assertFalse(os.path.exists(path))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_prefetch_image_other_image(self, get_mock):
+        self.config(image_prefetch_url='http://example.net')
+        path = self._prefetch_location()
+        get_mock.return_value = self._fake_response(200, [b'other'])
+
+        self.agent_extension.prefetch_image().join()
+        image_info = self._build_fake_image_info()
+        self.assertIsNone(standby._ImagePrefetch.take(image_info))
+        self.assertTrue(os.path.exists(path))
+        standby._ImagePrefetch.drop_unless([image_info])
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(standby._ImagePrefetch._current)
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_resumes_same_url(self, get_mock, sleep_mock):
+        image_info = self._build_fake_image_info()
+        get_mock.side_effect = [
+            self._fake_response(200, [b'some'],
+                                error=requests.ConnectionError('reset')),
+            self._fake_response(206, [b'content'],
+                                headers={'Content-Length': '7'}),
+        ]
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(b'somecontent', b''.join(image_download))
+        get_mock.assert_called_with('http://example.org', stream=True,
+                                    headers={'Range': 'bytes=4-'})
+        sleep_mock.assert_called_once_with(1.0)
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_resumes_short_read(self, get_mock, sleep_mock):
+        image_info = self._build_fake_image_info()
+        get_mock.side_effect = [
+            self._fake_response(200, [b'some'],
+                                headers={'Content-Length': '11'}),
+            self._fake_response(206, [b'content'],
+                                headers={'Content-Length': '7'}),
+        ]
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(b'somecontent', b''.join(image_download))
+        get_mock.assert_called_with('http://example.org', stream=True,
+                                    headers={'Range': 'bytes=4-'})
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_resumes_next_mirror(self, get_mock, sleep_mock):
+        image_info = self._build_fake_image_info()
+        image_info['urls'].append('http://example.com')
+        get_mock.side_effect = [
+            self._fake_response(200, [b'some'],
+                                error=requests.ConnectionError('reset')),
+            self._fake_response(503, []),
+            self._fake_response(206, [b'content'],
+                                headers={'Content-Length': '7'}),
+        ]
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(b'somecontent', b''.join(image_download))
+        get_mock.assert_has_calls([
+            mock.call('http://example.org', stream=True,
+                      headers={'Range': 'bytes=4-'}),
+            mock.call('http://example.com', stream=True,
+                      headers={'Range': 'bytes=4-'})])
+        sleep_mock.assert_has_calls([mock.call(1.0), mock.call(2.0)])
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_resume_gives_up(self, get_mock, sleep_mock):
+        self.config(image_download_retries=2)
+        image_info = self._build_fake_image_info()
+        get_mock.side_effect = [
+            self._fake_response(200, [b'some'],
+                                error=requests.ConnectionError('reset')),
+            self._fake_response(503, []),
+            self._fake_response(503, []),
+        ]
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertRaisesRegexp(errors.ImageDownloadError,
+                                'giving up after 2 attempts',
+                                b''.join, image_download)
+        self.assertEqual(3, get_mock.call_count)
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_resume_encoded(self, get_mock, sleep_mock):
+        image_info = self._build_fake_image_info()
+        get_mock.return_value = self._fake_response(
+            200, [b'some'], error=requests.ConnectionError('reset'),
+            headers={'Content-Encoding': 'gzip'})
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertRaisesRegexp(errors.ImageDownloadError,
+                                'cannot be resumed',
+                                b''.join, image_download)
+        get_mock.assert_called_once_with('http://example.org', stream=True)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_image_download_compressed(self, get_mock):
+        data = b'somecontent' * 1000
+        compressed = zlib.compress(data)
+        image_info = self._build_fake_image_info()
+        image_info['compression'] = 'none'
+        get_mock.return_value = self._fake_response(
+            200, [compressed[:3], compressed[3:]])
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(compressed, b''.join(image_download))
+        self.assertFalse(image_download.verify_image('/dev/foo'))
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress(data) + compressor.flush()
+        del image_info['compression']
+        for checksum in (hashlib.md5(gzipped).hexdigest(),
+                         hashlib.md5(data).hexdigest()):
+            image_info['checksum'] = checksum
+            get_mock.return_value = self._fake_response(
+                200, [gzipped[:3], gzipped[3:]])
+            image_download = standby._ImageDownload(image_info)
+            self.assertEqual(data, b''.join(image_download))
+            self.assertTrue(image_download.verify_image('/dev/foo'))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_image_download_compressed_corrupt(self, get_mock):
+        image_info = self._build_fake_image_info()
+        image_info['compression'] = 'bzip2'
+        get_mock.return_value = self._fake_response(200, [b'not bzip2'])
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertRaisesRegexp(errors.ImageDownloadError,
+                                'Unable to decompress bzip2 image',
+                                b''.join, image_download)
+
+    def test_verify_image_decompressed(self):
+        image_info = self._build_fake_image_info()
+        self.assertTrue(standby._verify_image(
+            image_info, '/foo/bar', {'md5': 'compressed hash'},
+            {'md5': image_info['checksum']}))
+        self.assertFalse(standby._verify_image(
+            image_info, '/foo/bar', {'md5': 'compressed hash'},
+            {'md5': 'wrong hash'}))
+
+    def test_verify_image_success(self):
+        image_info = self._build_fake_image_info()
+        verified = standby._verify_image(image_info, '/foo/bar',
+                                         {'md5': image_info['checksum']})
+        self.assertTrue(verified)
+
+    def test_verify_image_failure(self):
+        image_info = self._build_fake_image_info()
+        verified = standby._verify_image(image_info, '/foo/bar',
+                                         {'md5': 'wrong hash'})
         self.assertFalse(verified)
-        self.assertEqual(md5_mock.call_count, 1)
+
+    def test_verify_image_multiple_checksums(self):
+        image_info = self._build_fake_image_info()
+        image_info['checksums'] = {'sha256': 'ABC456'}
+        self.assertTrue(standby._verify_image(
+            image_info, '/foo/bar',
+            {'md5': image_info['checksum'], 'sha256': 'abc456'}))
+        # All the checksums have to match, on the same image
+        self.assertFalse(standby._verify_image(
+            image_info, '/foo/bar',
+            {'md5': image_info['checksum'], 'sha256': 'wrong hash'}))
+        self.assertFalse(standby._verify_image(
+            image_info, '/foo/bar',
+            {'md5': image_info['checksum'], 'sha256': 'wrong hash'},
+            {'md5': 'wrong hash', 'sha256': 'abc456'}))
+
+    def test_image_checksums(self):
+        image_info = self._build_fake_image_info()
+        self.assertEqual({'md5': 'abc123'},
+                         standby._image_checksums(image_info))
+        image_info['checksums'] = {'sha512': 'DEF'}
+        self.assertEqual({'md5': 'abc123', 'sha512': 'def'},
+                         standby._image_checksums(image_info))
+        del image_info['checksum']
+        self.assertEqual({'sha512': 'def'},
+                         standby._image_checksums(image_info))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_image_download_multiple_checksums(self, get_mock):
+        image_info = self._build_fake_image_info()
+        del image_info['checksum']
+        image_info['checksums'] = {
+            'sha256': hashlib.sha256(b'somecontent').hexdigest(),
+            'sha512': hashlib.sha512(b'somecontent').hexdigest()}
+        get_mock.return_value = self._fake_response(200,
+                                                    [b'some', b'content'])
+
+        image_download = standby._ImageDownload(image_info)
+        self.assertEqual(b'somecontent', b''.join(image_download))
+        self.assertTrue(image_download.verify_image('/dev/foo'))
+        self.assertEqual(['sha256', 'sha512'],
+                         sorted(image_download.hash_throughput()))
+
+    @mock.patch('time.time', autospec=True)
+    def test_image_hasher_throughput(self, time_mock):
+        time_mock.side_effect = [0.0, 0.5, 1.0, 1.5]
+        hasher = standby._ImageHasher('fake_id', 'sha1')
+        hasher.start()
+        hasher.put(b'a' * 1024 * 1024)
+        hasher.put(b'b' * 1024 * 1024)
+        self.assertEqual(2.0, hasher.throughput())
+        self.assertEqual(hashlib.sha1(b'a' * 1024 * 1024 +
+                                      b'b' * 1024 * 1024).hexdigest(),
+                         hasher.hexdigest())
+
+    def test_image_hasher_throughput_unknown(self):
+        self.assertIsNone(standby._ImageHasher('fake_id').throughput())
+
+    def test_image_hasher(self):
+        hasher = standby._ImageHasher('fake_id')
+        hasher.start()
+        hasher.put(b'some')
+        hasher.put(b'content')
+        self.assertEqual(hashlib.md5(b'somecontent').hexdigest(),
+                         hasher.hexdigest())
+        self.assertFalse(hasher.is_alive())
+        self.assertIsNone(hasher.error)
+
+    def test_image_hasher_not_started(self):
+        hasher = standby._ImageHasher('fake_id')
+        self.assertEqual(hashlib.md5().hexdigest(), hasher.hexdigest())
 
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
                 autospec=True)
@@ -284,8 +1751,11 @@ class TestStandbyExtension(test_base.BaseTestCase):
         dispatch_mock.return_value = 'manager'
         async_result = self.agent_extension.cache_image(image_info=image_info)
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              progress=mock.ANY)
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           extents=mock.ANY,
+                                           progress=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(self.agent_extension.cached_image_id,
                          image_info['id'])
@@ -312,8 +1782,11 @@ class TestStandbyExtension(test_base.BaseTestCase):
             image_info=image_info, force=True
         )
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              progress=mock.ANY)
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           extents=mock.ANY,
+                                           progress=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(self.agent_extension.cached_image_id,
                          image_info['id'])
@@ -349,8 +1822,149 @@ class TestStandbyExtension(test_base.BaseTestCase):
                       ).format(image_info['id'], 'manager')
         self.assertEqual(cmd_result, async_result.command_result['result'])
 
+    @mock.patch.object(standby, 'IMAGE_VERIFY_BLOCK_SIZE', 8192)
+    def test_image_extents_blocks(self):
+        data = os.urandom(3 * 8192 + 100)
+        extents = standby._ImageExtents('/dev/fake')
+        extents.start()
+        extents.add(0, data[:5000])
+        extents.add(10000, data[5000:20000])
+        extents.add(50000, data[20000:])
+        extents.close()
+        self.assertIsNone(extents.error)
+        self.assertEqual([[0, 5000], [10000, 15000], [50000, 4676]],
+                         extents.extents)
+        self.assertEqual([hashlib.sha256(data[i:i + 8192]).hexdigest()
+                          for i in range(0, len(data), 8192)],
+                         extents.block_digests)
+        self.assertEqual([[(0, 5000), (10000, 3192)],
+                          [(13192, 8192)],
+                          [(21384, 3616), (50000, 4576)],
+                          [(54576, 100)]],
+                         standby._extent_blocks(extents.extents, 8192))
+
+    def test_read_direct(self):
+        device = self._temp_device()
+        data = os.urandom(20000)
+        with open(device, 'wb') as f:
+            f.write(data)
+        # Direct I/O needs aligned buffers
+        buf = mmap.mmap(-1, 8192)
+        with standby._open_direct(device) as f:
+            read = b''.join(bytes(d) for d in standby._read_direct(
+                f, buf, 5000, 12000))
+            self.assertEqual(data[5000:17000], read)
+            # Past the end of the device
+            read = b''.join(bytes(d) for d in standby._read_direct(
+                f, buf, 19000, 5000))
+            self.assertEqual(data[19000:], read)
+
+    @mock.patch.object(standby, 'IMAGE_VERIFY_BLOCK_SIZE', 8192)
+    def test_verify_extents(self):
+        self.config(image_verify_threads=3)
+        device = self._temp_device()
+        block = standby.IMAGE_ZERO_BLOCK_SIZE
+        extents = standby._ImageExtents(device)
+        writer = standby._ImageWriter(device, extents)
+        writer.start()
+        writer.put(os.urandom(block) + b'\0' * block + os.urandom(100))
+        writer.put(os.urandom(block), 5 * block)
+        writer.close()
+        self.assertIsNone(writer.error)
+        self.assertEqual([], standby._verify_extents(
+            device, extents.extents, extents.block_digests))
+
+        # Zeros left out are not checked
+        with open(device, 'r+b') as f:
+            f.seek(block + 10)
+            f.write(b'x')
+            f.seek(10000)
+            f.write(b'x')
+            f.seek(5 * block + 9000)
+            f.write(b'x')
+        self.assertEqual([1, 9], standby._verify_extents(
+            device, extents.extents, extents.block_digests))
+        # Every block is reported when the digests do not match the extents
+        self.assertEqual(list(range(17)), standby._verify_extents(
+            device, extents.extents, extents.block_digests[:2]))
+
+    @mock.patch.object(standby.qcow2.StreamDecoder, 'decode', autospec=True)
+    def test_staged_image_extents(self, decode_mock):
+        image_info = self._build_fake_image_info()
+        decode_mock.return_value = iter([(0, b'a' * 10), (10, b'b' * 5),
+                                         (100, b'c'), (200, b'')])
+        with mock.patch.object(standby, '_image_location',
+                               return_value=self._temp_device()):
+            extents = standby._staged_image_extents(image_info, '/dev/fake')
+        self.assertEqual([[0, 15], [100, 1]], extents.extents)
+        self.assertEqual(
+            [hashlib.sha256(b'a' * 10 + b'b' * 5 + b'c').hexdigest()],
+            extents.block_digests)
+
+        decode_mock.side_effect = errors.ImageFormatError('fake_id', 'bad')
+        with mock.patch.object(standby, '_image_location',
+                               return_value=self._temp_device()):
+            self.assertIsNone(standby._staged_image_extents(image_info,
+                                                            '/dev/fake'))
+
+    def _fake_stream(self, corrupt=False):
+        def stream(image_info, device, extents=None, progress=None):
+            writer = standby._ImageWriter(device, extents)
+            writer.start()
+            writer.put(b'somecontent')
+            writer.close()
+            if corrupt:
+                with open(device, 'r+b') as f:
+                    f.write(b'S')
+            return {'md5': 512.0}
+        return stream
+
+    @mock.patch.object(standby, '_stream_image_onto_device', autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_cache_image_verify_after_write(self, dispatch_mock,
+                                            stream_mock):
+        image_info = self._build_fake_image_info()
+        image_info['stream_raw_images'] = True
+        image_info['disk_format'] = 'raw'
+        image_info['verify_after_write'] = True
+        dispatch_mock.return_value = self._temp_device()
+        stream_mock.side_effect = self._fake_stream()
+
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        verification = async_result.command_result['verification']
+        self.assertEqual({'verified': True, 'bytes': 11, 'mismatches': []},
+                         dict((k, v) for k, v in verification.items()
+                              if k != 'seconds'))
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+        self.assertTrue(os.path.exists(self.manifest))
+
+    @mock.patch.object(standby, '_stream_image_onto_device', autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_cache_image_verify_after_write_mismatch(self, dispatch_mock,
+                                                     stream_mock):
+        self.config(image_verify_after_write=True)
+        image_info = self._build_fake_image_info()
+        image_info['stream_raw_images'] = True
+        image_info['disk_format'] = 'raw'
+        dispatch_mock.return_value = self._temp_device()
+        stream_mock.side_effect = self._fake_stream(corrupt=True)
+
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        verification = async_result.command_result['verification']
+        self.assertFalse(verification['verified'])
+        self.assertEqual([[0, 11]], verification['mismatches'])
+        # The image is written again by the next command
+        self.assertIsNone(self.agent_extension.cached_image_id)
+        self.assertFalse(os.path.exists(self.manifest))
+
     @mock.patch(('ironic_python_agent.extensions.standby.'
-                 '_write_configdrive_to_partition'),
+                 '_stream_image_onto_device'),
                 autospec=True)
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
                 autospec=True)
@@ -358,16 +1972,270 @@ class TestStandbyExtension(test_base.BaseTestCase):
                 autospec=True)
     @mock.patch('ironic_python_agent.extensions.standby._download_image',
                 autospec=True)
-    @mock.patch('ironic_python_agent.extensions.standby._configdrive_location',
+    def test_cache_image_stream_raw(self, download_mock, write_mock,
+                                    dispatch_mock, stream_mock):
+        image_info = self._build_fake_image_info()
+        image_info['stream_raw_images'] = True
+        image_info['disk_format'] = 'raw'
+        dispatch_mock.return_value = 'manager'
+        stream_mock.return_value = {'md5': 512.0}
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        stream_mock.assert_called_once_with(image_info, 'manager',
+                                            extents=mock.ANY,
+                                            progress=mock.ANY)
+        self.assertFalse(download_mock.called)
+        self.assertFalse(write_mock.called)
+        self.assertEqual({'md5': 512.0},
+                         async_result.command_result['hash_throughput'])
+        self.assertEqual('cache_image: image (fake_id) cached to device '
+                         'manager', async_result.command_result['result'])
+        self.assertEqual(self.agent_extension.cached_image_id,
+                         image_info['id'])
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+
+    @mock.patch(('ironic_python_agent.extensions.standby.'
+                 '_stream_image_onto_device'),
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_image_stream_non_raw(self, download_mock, write_mock,
+                                        dispatch_mock, stream_mock):
+        image_info = self._build_fake_image_info()
+        image_info['stream_raw_images'] = True
+        image_info['disk_format'] = 'vmdk'
+        dispatch_mock.return_value = 'manager'
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        self.assertFalse(stream_mock.called)
+        download_mock.assert_called_once_with(image_info,
+                                              progress=mock.ANY)
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           extents=mock.ANY,
+                                           progress=mock.ANY)
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+
+    @mock.patch(('ironic_python_agent.extensions.standby.'
+                 '_stream_image_onto_device'),
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_image_stream_qcow2_fallback(self, download_mock,
+                                               write_mock, dispatch_mock,
+                                               stream_mock):
+        image_info = self._build_fake_image_info()
+        image_info['stream_raw_images'] = True
+        image_info['disk_format'] = 'qcow2'
+        dispatch_mock.return_value = 'manager'
+        stream_mock.side_effect = errors.ImageFormatError(
+            image_info['id'], 'compressed clusters are not supported')
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        stream_mock.assert_called_once_with(image_info, 'manager',
+                                            extents=mock.ANY,
+                                            progress=mock.ANY)
+        download_mock.assert_called_once_with(image_info,
+                                              progress=mock.ANY)
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           extents=mock.ANY,
+                                           progress=mock.ANY)
+        self.assertEqual(self.agent_extension.cached_image_id,
+                         image_info['id'])
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+
+    @mock.patch(('ironic_python_agent.extensions.standby.'
+                 '_stream_image_onto_device'),
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_cache_image_stream_fails(self, dispatch_mock, stream_mock):
+        image_info = self._build_fake_image_info()
+        image_info['stream_raw_images'] = True
+        image_info['disk_format'] = 'raw'
+        self.agent_extension.cached_image_id = 'old_image'
+        dispatch_mock.return_value = 'manager'
+        stream_mock.side_effect = errors.ImageChecksumError(image_info['id'])
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        self.assertEqual('FAILED', async_result.command_status)
+        self.assertIsNone(self.agent_extension.cached_image_id)
+
+    @mock.patch.object(standby, '_stream_image_onto_device', autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_cache_image_mirror(self, dispatch_mock, stream_mock):
+        image_info = self._build_fake_image_info()
+        image_info['stream_raw_images'] = True
+        image_info['disk_format'] = 'raw'
+        image_info['verify_after_write'] = True
+        image_info['mirror_root_device'] = True
+        devices = [self._temp_device(), self._temp_device()]
+        dispatch_mock.return_value = devices
+
+        def stream(image_info, devices, extents=None, progress=None):
+            mirror = standby._ImageMirror(devices, extents, progress)
+            mirror.start()
+            mirror.put(b'somecontent')
+            mirror.close()
+            return {'md5': 512.0}
+
+        stream_mock.side_effect = stream
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        dispatch_mock.assert_called_once_with('get_os_install_devices')
+        stream_mock.assert_called_once_with(image_info, devices,
+                                            extents=mock.ANY,
+                                            progress=mock.ANY)
+        self.assertEqual(
+            'cache_image: image (fake_id) cached to device {0}'.format(
+                ', '.join(devices)),
+            async_result.command_result['result'])
+        verification = async_result.command_result['verification']
+        self.assertTrue(verification['verified'])
+        self.assertEqual(sorted(devices), sorted(verification['devices']))
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+        # Only images written to a single device are in the manifest
+        self.assertFalse(os.path.exists(self.manifest))
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch.object(standby, '_write_image', autospec=True)
+    @mock.patch.object(standby, '_download_image', autospec=True)
+    def test_cache_image_mirror_staged(self, download_mock, write_mock,
+                                       dispatch_mock):
+        image_info = self._build_fake_image_info()
+        image_info['target_devices'] = ['/dev/sda', '/dev/sdb']
+        download_mock.return_value = {'md5': 512.0}
+        write_mock.side_effect = [None, errors.ImageWriteError(
+            '/dev/sdb', 1, '', '')]
+
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+        self.assertFalse(dispatch_mock.called)
+        download_mock.assert_called_once_with(image_info,
+                                              progress=mock.ANY)
+        write_mock.assert_has_calls(
+            [mock.call(image_info, '/dev/sda', extents=mock.ANY,
+                       progress=mock.ANY),
+             mock.call(image_info, '/dev/sdb', extents=mock.ANY,
+                       progress=mock.ANY)], any_order=True)
+        self.assertEqual('FAILED', async_result.command_status)
+        self.assertIsNone(self.agent_extension.cached_image_id)
+
+    @mock.patch.object(partitions, 'probe_filesystem', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch.object(standby, '_write_and_verify_image', autospec=True)
+    @mock.patch.object(partitions, 'create_partitions', autospec=True)
+    def test_write_partitions(self, create_mock, write_mock, execute_mock,
+                              probe_mock):
+        image_info = self._build_fake_partition_image_info()
+        create_mock.return_value = ['/dev/sda1', '/dev/sda2', '/dev/sda3']
+        write_mock.return_value = ({'md5': 512.0}, None, None)
+        probe_mock.side_effect = lambda path: (None, path[-1])
+        execute_mock.return_value = ('', '')
+
+        results = standby._write_partitions(image_info, '/dev/sda')
+
+        create_mock.assert_called_once_with(
+            '/dev/sda', 'gpt',
+            [{'size': 512 * 1024 * 1024, 'name': 'efi', 'type': 'efi',
+              'bootable': False},
+             {'size': 1024 * 1024 * 1024, 'name': 'swap', 'type': 'swap',
+              'bootable': False},
+             {'size': None, 'name': 'root', 'type': 'linux',
+              'bootable': False}],
+            reserve=standby.CONFIGDRIVE_MAX_SIZE + partitions.ALIGNMENT)
+        write_mock.assert_called_once_with(
+            image_info['partitions'][2]['image'], '/dev/sda3', True,
+            mock.ANY)
+        execute_mock.assert_has_calls(
+            [mock.call('mkfs', '-t', 'vfat', '-n', 'EFI', '/dev/sda1',
+                       check_exit_code=[0]),
+             mock.call('mkswap', '/dev/sda2', check_exit_code=[0])],
+            any_order=True)
+        self.assertEqual(
+            {'efi': {'path': '/dev/sda1', 'type': 'efi', 'uuid': '1'},
+             'swap': {'path': '/dev/sda2', 'type': 'swap', 'uuid': '2'},
+             'root': {'path': '/dev/sda3', 'type': 'linux', 'uuid': '3',
+                      'hash_throughput': {'md5': 512.0}}},
+            results)
+
+    @mock.patch.object(partitions, 'probe_filesystem', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch.object(standby, '_write_and_verify_image', autospec=True)
+    @mock.patch.object(partitions, 'create_partitions', autospec=True)
+    def test_write_partitions_fails(self, create_mock, write_mock,
+                                    execute_mock, probe_mock):
+        image_info = self._build_fake_partition_image_info()
+        create_mock.return_value = ['/dev/sda1', '/dev/sda2', '/dev/sda3']
+        write_mock.return_value = ({'md5': 512.0}, None, None)
+        probe_mock.return_value = (None, None)
+        execute_mock.side_effect = processutils.ProcessExecutionError(
+            exit_code=1)
+
+        # The other partitions are still written
+        self.assertRaises(errors.ImageWriteError, standby._write_partitions,
+                          image_info, '/dev/sda')
+        self.assertEqual(1, write_mock.call_count)
+
+    @mock.patch(('ironic_python_agent.extensions.standby.'
+                 '_write_configdrive_to_partition'),
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch.object(standby, '_write_partitions', autospec=True)
+    def test_prepare_image_partitions(self, write_mock, dispatch_mock,
+                                      configdrive_copy_mock):
+        image_info = self._build_fake_partition_image_info()
+        dispatch_mock.return_value = 'manager'
+        write_mock.return_value = {
+            'efi': {'path': '/dev/sda1', 'type': 'efi', 'uuid': 'efi-uuid'},
+            'root': {'path': '/dev/sda3', 'type': 'linux',
+                     'uuid': 'root-uuid',
+                     'verification': {'verified': True}}}
+
+        for _i in range(2):
+            async_result = self.agent_extension.prepare_image(
+                image_info=image_info, configdrive='configdrive_data')
+            async_result.join()
+            self.assertEqual('SUCCEEDED', async_result.command_status)
+            self.assertEqual('root-uuid',
+                             async_result.command_result['root_uuid'])
+            self.assertEqual(
+                'efi-uuid',
+                async_result.command_result['efi_system_part_uuid'])
+            self.assertEqual(write_mock.return_value,
+                             async_result.command_result['partitions'])
+        # The partitions are cached after the first command
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           progress=mock.ANY)
+        self.assertEqual(2, configdrive_copy_mock.call_count)
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+
+    @mock.patch(('ironic_python_agent.extensions.standby.'
+                 '_write_configdrive_to_partition'),
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
                 autospec=True)
     def test_prepare_image(self,
-                           location_mock,
                            download_mock,
                            write_mock,
                            dispatch_mock,
                            configdrive_copy_mock):
         image_info = self._build_fake_image_info()
-        location_mock.return_value = '/tmp/configdrive'
         download_mock.return_value = None
         write_mock.return_value = None
         dispatch_mock.return_value = 'manager'
@@ -379,11 +2247,19 @@ class TestStandbyExtension(test_base.BaseTestCase):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              progress=mock.ANY)
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           extents=mock.ANY,
+                                           progress=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         configdrive_copy_mock.assert_called_once_with('configdrive_data',
-                                                      'manager')
+                                                      'manager',
+                                                      progress=mock.ANY)
+        # Progress is reported to the command
+        progress = configdrive_copy_mock.call_args[1]['progress']
+        self.assertIs(async_result, progress.command)
+        self.assertIs(progress, download_mock.call_args[1]['progress'])
 
         self.assertEqual('SUCCEEDED', async_result.command_status)
         self.assertTrue('result' in async_result.command_result.keys())
@@ -404,7 +2280,8 @@ class TestStandbyExtension(test_base.BaseTestCase):
         self.assertEqual(download_mock.call_count, 0)
         self.assertEqual(write_mock.call_count, 0)
         configdrive_copy_mock.assert_called_once_with('configdrive_data',
-                                                      'manager')
+                                                      'manager',
+                                                      progress=mock.ANY)
 
         self.assertEqual('SUCCEEDED', async_result.command_status)
         self.assertTrue('result' in async_result.command_result.keys())
@@ -438,8 +2315,11 @@ class TestStandbyExtension(test_base.BaseTestCase):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              progress=mock.ANY)
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           extents=mock.ANY,
+                                           progress=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
 
         self.assertEqual(configdrive_copy_mock.call_count, 0)
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import json
+import threading
 import time
 
 import mock
@@ -160,12 +161,19 @@ class TestBaseAgent(test_base.BaseTestCase):
         self.assertEqual(status.version,
                          pkg_resources.get_distribution('ironic-python-agent')
                          .version)
+        self.assertFalse(status.ready)
 
     @mock.patch('wsgiref.simple_server.make_server', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       'list_network_interfaces')
     @mock.patch.object(hardware.HardwareManager, 'list_hardware_info')
-    def test_run(self, mocked_list_hardware, wsgi_server_cls):
+    def test_run(self, mocked_list_hardware, mocked_list_interfaces,
+                 wsgi_server_cls):
         wsgi_server = wsgi_server_cls.return_value
         wsgi_server.start.side_effect = KeyboardInterrupt()
+        mocked_list_interfaces.return_value = [
+            hardware.NetworkInterface('eth0', '00:0c:29:8c:11:b1')]
+        mocked_list_hardware.return_value = {'interfaces': [], 'cpu': None}
 
         self.agent.heartbeater = mock.Mock()
         self.agent.api_client.lookup_node = mock.Mock()
@@ -186,6 +194,105 @@ class TestBaseAgent(test_base.BaseTestCase):
         wsgi_server.serve_forever.assert_called_once_with()
 
         self.agent.heartbeater.start.assert_called_once_with()
+        self.assertTrue(self.agent.get_status().ready)
+        # The node is looked up with the interfaces, then the full
+        # inventory is sent
+        self.assertEqual([
+            mock.call(hardware_info={
+                'interfaces': mocked_list_interfaces.return_value},
+                timeout=300, starting_interval=1),
+            mock.call(hardware_info=mocked_list_hardware.return_value,
+                      timeout=300, starting_interval=1)],
+            self.agent.api_client.lookup_node.call_args_list)
+        self.assertFalse(wsgi_server.shutdown.called)
+
+    @mock.patch('wsgiref.simple_server.make_server', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       'list_network_interfaces')
+    @mock.patch.object(hardware.HardwareManager, 'list_hardware_info')
+    def test_run_lookup_failure(self, mocked_list_hardware,
+                                mocked_list_interfaces, wsgi_server_cls):
+        wsgi_server = wsgi_server_cls.return_value
+        self.agent.heartbeater = mock.Mock()
+        self.agent.api_client.lookup_node = mock.Mock()
+        self.agent.api_client.lookup_node.side_effect = (
+            errors.LookupNodeError('fake'))
+
+        self.assertRaises(errors.LookupNodeError, self.agent.run)
+        wsgi_server.shutdown.assert_called_once_with()
+        self.assertFalse(self.agent.heartbeater.start.called)
+        self.assertFalse(self.agent.get_status().ready)
+
+    @mock.patch.object(agent, 'STARTUP_STOP_TIMEOUT', 0.1)
+    @mock.patch('wsgiref.simple_server.make_server', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       'list_network_interfaces')
+    @mock.patch.object(hardware.HardwareManager, 'list_hardware_info')
+    def test_run_interrupted_during_lookup(self, mocked_list_hardware,
+                                           mocked_list_interfaces,
+                                           wsgi_server_cls):
+        looking_up = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def lookup_node(**kwargs):
+            looking_up.set()
+            release.wait()
+            return {'node': {'uuid': 'deadbeef-dabb-ad00-b105-f00d00bab10c'},
+                    'heartbeat_timeout': 300}
+
+        def serve_forever():
+            looking_up.wait()
+            raise KeyboardInterrupt()
+
+        wsgi_server_cls.return_value.serve_forever.side_effect = serve_forever
+        self.agent.heartbeater = mock.Mock()
+        self.agent.api_client.lookup_node = mock.Mock(side_effect=lookup_node)
+
+        # The agent stops without waiting for the lookup to finish
+        self.agent.run()
+        self.agent.heartbeater.stop.assert_called_once_with()
+        release.set()
+        for thread in threading.enumerate():
+            if thread.name == 'startup':
+                thread.join()
+        # Heartbeats do not start once the agent stopped
+        self.assertFalse(self.agent.heartbeater.start.called)
+        self.assertFalse(self.agent.get_status().ready)
+
+    def test_execute_command_not_ready(self):
+        self.assertRaises(errors.AgentNotReadyError,
+                          self.agent.execute_command, 'fake.fake_command')
+        self.agent.ready.set()
+        self.assertRaises(errors.RequestedObjectNotFoundError,
+                          self.agent.execute_command, 'unknown.fake_command')
+
+    @mock.patch('wsgiref.simple_server.make_server', autospec=True)
+    @mock.patch.object(hardware.GenericHardwareManager,
+                       'list_network_interfaces')
+    @mock.patch.object(hardware.HardwareManager, 'list_hardware_info')
+    def test_run_prefetches_image(self, mocked_list_hardware,
+                                  mocked_list_interfaces, wsgi_server_cls):
+        self.agent.heartbeater = mock.Mock()
+        self.agent.get_extension = mock.Mock()
+        node = {'uuid': 'deadbeef-dabb-ad00-b105-f00d00bab10c',
+                'instance_info': {'image_url': 'http://example.org'}}
+        self.agent.api_client.lookup_node = mock.Mock()
+        self.agent.api_client.lookup_node.return_value = {
+            'node': node,
+            'heartbeat_timeout': 300
+        }
+        self.agent.run()
+
+        self.agent.get_extension.assert_called_once_with('standby')
+        prefetch_mock = self.agent.get_extension.return_value.prefetch_image
+        prefetch_mock.assert_called_once_with(node)
+
+        # The agent starts even if the prefetch cannot
+        prefetch_mock.side_effect = errors.ImageDownloadError('fake_id', '')
+        self.agent.run()
+        self.assertEqual(2, wsgi_server_cls.return_value.serve_forever
+                         .call_count)
 
     @mock.patch('os.read')
     @mock.patch('select.poll')
@@ -249,6 +356,7 @@ class TestBaseAgent(test_base.BaseTestCase):
             'command_status': 'RUNNING',
             'command_result': None,
             'command_error': None,
+            'command_progress': None,
         }
         self.assertEqualEncoded(result, expected_result)
 
@@ -273,6 +381,7 @@ class TestBaseAgent(test_base.BaseTestCase):
             'command_status': 'RUNNING',
             'command_result': None,
             'command_error': None,
+            'command_progress': None,
         }
         self.assertEqualEncoded(result, expected_result)
 
@@ -341,3 +450,4 @@ class TestAgentStandalone(test_base.BaseTestCase):
 
         self.assertFalse(self.agent.heartbeater.called)
         self.assertFalse(self.agent.api_client.lookup_node.called)
+        self.assertTrue(self.agent.get_status().ready)
@@ -176,6 +176,31 @@ class TestIronicAPI(test_base.BaseTestCase):
         data = response.json
         self.assertEqual(data['started_at'], status.started_at)
         self.assertEqual(data['version'], status.version)
+        self.assertTrue(data['ready'])
+
+    def test_get_agent_status_real_agent(self):
+        # Serve a real agent, so that the API types are checked against
+        # what it returns
+        self.mock_agent = agent.IronicPythonAgent('https://fake_api.example.'
+                                                  'org:8081/',
+                                                  ('203.0.113.1', 9990),
+                                                  ('192.0.2.1', 9999),
+                                                  3,
+                                                  10,
+                                                  'eth0',
+                                                  300,
+                                                  1,
+                                                  'agent_ipmitool',
+                                                  False)
+        self.app = self._make_app()
+
+        response = self.get_json('/status')
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.json['ready'])
+        self.assertEqual(self.mock_agent.version, response.json['version'])
+
+        self.mock_agent.ready.set()
+        self.assertTrue(self.get_json('/status').json['ready'])
 
     def test_execute_agent_command_success_no_wait(self):
         command = {
@@ -310,3 +335,39 @@ class TestIronicAPI(test_base.BaseTestCase):
         self.assertEqual(response.status_code, 200)
         data = response.json
         self.assertEqual(data, serialized_cmd_result)
+
+    def test_get_command_result_progress(self):
+        cmd_result = base.AsyncCommandResult('do_things', {'key': 'value'},
+                                             None)
+        cmd_result.update_progress(phase='writing', bytes_written=1024,
+                                   throughput=12.5, eta=None)
+
+        self.mock_agent.get_command_result.return_value = cmd_result
+
+        response = self.get_json('/commands/abc123')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('RUNNING', response.json['command_status'])
+        self.assertEqual({'phase': 'writing', 'bytes_written': 1024,
+                          'throughput': 12.5, 'eta': None},
+                         response.json['command_progress'])
+
+    def test_get_image_chunk(self):
+        standby = self.mock_agent.get_extension.return_value
+        standby.get_image_chunk.return_value = b'chunk data'
+
+        response = self.app.get(PATH_PREFIX + '/images/fake_id/chunks/3')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/octet-stream', response.content_type)
+        self.assertEqual(b'chunk data', response.body)
+        self.mock_agent.get_extension.assert_called_once_with('standby')
+        standby.get_image_chunk.assert_called_once_with('fake_id', 3)
+
+    def test_get_image_chunk_not_found(self):
+        standby = self.mock_agent.get_extension.return_value
+        standby.get_image_chunk.return_value = None
+
+        for path in ('/images/fake_id/chunks/3', '/images/fake_id/chunks/x',
+                     '/images/fake_id'):
+            response = self.app.get(PATH_PREFIX + path, expect_errors=True)
+            self.assertEqual(404, response.status_code)
+        standby.get_image_chunk.assert_called_once_with('fake_id', 3)
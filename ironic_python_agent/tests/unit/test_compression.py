@@ -0,0 +1,133 @@
+# Copyright 2026 Ironic Python Agent contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bz2
+import zlib
+
+import mock
+from oslotest import base as test_base
+import testtools
+
+from ironic_python_agent import compression
+from ironic_python_agent import errors
+
+DATA = b'some image content' * 1000
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _chunks(data, size=1000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestCompression(test_base.BaseTestCase):
+
+    def _decompress(self, data, **kwargs):
+        fmt, chunks = compression.decompress(_chunks(data), 'fake_id',
+                                             **kwargs)
+        return fmt, b''.join(chunks)
+
+    def test_detect(self):
+        self.assertEqual('gzip', compression.detect(_gzip(DATA)))
+        self.assertEqual('bzip2', compression.detect(bz2.compress(DATA)))
+        self.assertEqual('zstd', compression.detect(b'\x28\xb5\x2f\xfd'))
+        self.assertIsNone(compression.detect(b'QFI\xfb'))
+        self.assertIsNone(compression.detect(b''))
+
+    def test_decompress_gzip(self):
+        self.assertEqual(('gzip', DATA), self._decompress(_gzip(DATA)))
+
+    def test_decompress_bzip2(self):
+        self.assertEqual(('bzip2', DATA),
+                         self._decompress(bz2.compress(DATA)))
+
+    @testtools.skipIf(compression.lzma is None, 'lzma is not available')
+    def test_decompress_xz(self):
+        data = compression.lzma.compress(DATA)
+        self.assertEqual(('xz', DATA), self._decompress(data))
+
+    def test_decompress_concatenated_streams(self):
+        self.assertEqual(('gzip', DATA * 2),
+                         self._decompress(_gzip(DATA) + _gzip(DATA)))
+        self.assertEqual(('bzip2', DATA * 2),
+                         self._decompress(bz2.compress(DATA) * 2))
+
+    def test_decompress_bounded_output(self):
+        zeros = b'\0' * (8 * compression.CHUNK_SIZE)
+        fmt, chunks = compression.decompress([_gzip(zeros)], 'fake_id')
+        chunks = list(chunks)
+        self.assertEqual(zeros, b''.join(chunks))
+        self.assertTrue(all(len(chunk) <= compression.CHUNK_SIZE
+                            for chunk in chunks))
+
+    def test_decompress_not_compressed(self):
+        self.assertEqual((None, DATA), self._decompress(DATA))
+        self.assertEqual((None, b''), self._decompress(b''))
+
+    def test_decompress_none(self):
+        data = _gzip(DATA)
+        self.assertEqual((None, data),
+                         self._decompress(data, compression='none'))
+
+    def test_decompress_explicit_format(self):
+        self.assertEqual(('gzip', DATA),
+                         self._decompress(_gzip(DATA), compression='gzip'))
+
+    def test_decompress_corrupt(self):
+        self.assertRaisesRegexp(errors.ImageDownloadError,
+                                'Unable to decompress gzip image',
+                                self._decompress, b'\x1f\x8bnot gzip')
+
+    def test_decompress_truncated(self):
+        self.assertRaisesRegexp(errors.ImageDownloadError, 'truncated',
+                                self._decompress, _gzip(DATA)[:-10])
+
+    def test_decompress_download_error(self):
+        def chunks():
+            yield _gzip(DATA)[:100]
+            raise IOError('Connection reset')
+
+        fmt, decompressed = compression.decompress(chunks(), 'fake_id')
+        self.assertRaisesRegexp(IOError, 'Connection reset',
+                                b''.join, decompressed)
+
+    @mock.patch.object(compression, 'zstandard', None)
+    def test_decompress_unavailable(self):
+        self.assertFalse(compression.is_available('zstd'))
+        self.assertRaisesRegexp(errors.ImageDownloadError, 'zstd',
+                                self._decompress,
+                                b'\x28\xb5\x2f\xfd' + DATA)
+
+    def test_decompress_zstd(self):
+        class FakeDecompressor(object):
+            """Decompress each chunk to its uppercase, up to an 'end'."""
+
+            eof = False
+            unused_data = b''
+
+            def decompress(self, data):
+                self.eof = data.endswith(b'end')
+                return data.upper()
+
+        zstandard = mock.Mock()
+        zstandard.ZstdDecompressor.return_value.decompressobj.side_effect = (
+            FakeDecompressor)
+        with mock.patch.object(compression, 'zstandard', zstandard):
+            fmt, chunks = compression.decompress(
+                [b'\x28\xb5\x2f\xfd', b'frame', b'end'], 'fake_id')
+            self.assertEqual('zstd', fmt)
+            self.assertEqual(b'\x28\xb5\x2f\xfdFRAMEEND', b''.join(chunks))
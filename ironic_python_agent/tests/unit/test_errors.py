@@ -110,8 +110,13 @@ class TestErrors(test_base.BaseTestCase):
                  (errors.ImageWriteError('device', 'exit_code', 'stdout',
                                          'stderr'),
                   DIFF_CL_DETAILS),
+                 (errors.ImageFormatError('image_id', 'msg'),
+                  DIFF_CL_DETAILS),
                  (errors.ConfigDriveTooLargeError('filename', 'filesize'),
                   DIFF_CL_DETAILS),
+                 (errors.ConfigDriveDownloadError('url', 'msg'),
+                  DIFF_CL_DETAILS),
+                 (errors.ConfigDriveFormatError('msg'), DIFF_CL_DETAILS),
                  (errors.ConfigDriveWriteError('device', 'exit_code', 'stdout',
                                                'stderr'),
                   DIFF_CL_DETAILS),
@@ -14,12 +14,19 @@
 
 import mock
 import os
+import shutil
+import tempfile
+import threading
+
 from oslo_concurrency import processutils
+from oslo_config import fixture as config_fixture
 from oslotest import base as test_base
 import pyudev
 import six
 from stevedore import extension
 
+# The agent options are registered by the cmd module
+from ironic_python_agent.cmd import agent as agent_cmd  # noqa
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
 from ironic_python_agent import utils
@@ -178,9 +185,166 @@ class TestHardwareManagerLoading(test_base.BaseTestCase):
         ])
 
 
+class TestInventoryCache(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestInventoryCache, self).setUp()
+        self.cache = hardware._InventoryCache()
+        patcher = mock.patch.object(self.cache, '_start_monitor',
+                                    return_value=True)
+        self.start_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.compute = mock.Mock(return_value=['sda'])
+
+    def test_get_cached(self):
+        self.assertEqual(['sda'], self.cache.get('disks', self.compute))
+        self.assertEqual(['sda'], self.cache.get('disks', self.compute))
+        self.compute.assert_called_once_with()
+        self.start_mock.assert_called_once_with()
+
+    def test_get_returns_copy(self):
+        self.cache.get('disks', self.compute).append('sdb')
+        self.assertEqual(['sda'], self.cache.get('disks', self.compute))
+
+    def test_get_not_monitoring(self):
+        self.start_mock.return_value = False
+        self.cache.get('disks', self.compute)
+        self.cache.get('disks', self.compute)
+        self.assertEqual(2, self.compute.call_count)
+        self.start_mock.assert_called_once_with()
+
+    def test_handle_event_drops_section(self):
+        cpu = mock.Mock(return_value='cpu')
+        self.cache.get('disks', self.compute)
+        self.cache.get('cpu', cpu)
+        self.cache.handle_event('add', 'block', 'disk')
+        self.cache.get('disks', self.compute)
+        self.cache.get('cpu', cpu)
+        self.assertEqual(2, self.compute.call_count)
+        cpu.assert_called_once_with()
+
+    @mock.patch.object(hardware, '_invalidate_hardware_support')
+    def test_handle_event_hotplug(self, invalidate_mock):
+        self.cache.handle_event('change', 'net')
+        self.assertFalse(invalidate_mock.called)
+        self.cache.handle_event('remove', 'net')
+        invalidate_mock.assert_called_once_with()
+
+    def test_handle_event_ignored(self):
+        self.cache.get('disks', self.compute)
+        self.cache.handle_event('change', 'block', 'partition')
+        self.cache.handle_event('bind', 'block', 'disk')
+        self.cache.handle_event('add', 'usb', 'usb_device')
+        self.cache.get('disks', self.compute)
+        self.compute.assert_called_once_with()
+
+    def test_get_event_while_computing(self):
+        def compute():
+            self.cache.handle_event('remove', 'net')
+            return ['eth0']
+
+        self.assertEqual(['eth0'], self.cache.get('interfaces', compute))
+        self.cache.get('interfaces', self.compute)
+        self.compute.assert_called_once_with()
+
+    def test_watch(self):
+        device = mock.Mock(action='add', subsystem='net', device_type=None)
+        monitor = mock.Mock()
+        monitor.poll.side_effect = [device, None]
+        self.cache.get('interfaces', self.compute)
+        with mock.patch.object(self.cache, 'handle_event') as handle_mock:
+            self.cache._watch(monitor)
+        handle_mock.assert_called_once_with('add', 'net', None)
+        # Nothing is cached once the monitor stops
+        self.cache.get('interfaces', self.compute)
+        self.cache.get('interfaces', self.compute)
+        self.assertEqual(3, self.compute.call_count)
+
+
+class TestListBlockDevicesSysfs(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestListBlockDevicesSysfs, self).setUp()
+        patcher = mock.patch.object(hardware._InventoryCache,
+                                    '_start_monitor', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hardware = hardware.GenericHardwareManager()
+        self.hardware.sys_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.hardware.sys_path)
+
+    def _add_device(self, name, dev, size, rotational='0', **attributes):
+        attributes.update({'dev': dev, 'size': size,
+                           'queue/rotational': rotational})
+        for attribute, value in attributes.items():
+            path = os.path.join(self.hardware.sys_path, 'block', name,
+                                attribute)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(value + '\n')
+
+    def test_list_block_devices(self):
+        self._add_device('sdb', '8:16', '20971520',
+                         **{'device/model': 'Fastable SD131 7 ',
+                            'device/type': '0'})
+        self._add_device('sda', '8:0', '6087604', rotational='1',
+                         **{'device/model': 'TinyUSB Drive',
+                            'device/type': '0'})
+        self._add_device('vda', '252:0', '0')
+        self._add_device('mmcblk0', '179:0', '62333952',
+                         **{'device/type': 'MMC'})
+        self._add_device('sr0', '11:0', '2097151',
+                         **{'device/model': 'DVD-ROM', 'device/type': '5'})
+        self._add_device('ram0', '1:0', '131072')
+        self._add_device('loop0', '7:0', '2048')
+        self._add_device('dm-0', '253:0', '2048')
+        self._add_device('md0', '9:0', '2048')
+        expected_devices = [
+            hardware.BlockDevice(name='/dev/sda',
+                                 model='TinyUSB Drive',
+                                 size=3116853248,
+                                 rotational=True),
+            hardware.BlockDevice(name='/dev/sdb',
+                                 model='Fastable SD131 7',
+                                 size=10737418240,
+                                 rotational=False),
+            hardware.BlockDevice(name='/dev/mmcblk0',
+                                 model='',
+                                 size=31914983424,
+                                 rotational=False),
+            hardware.BlockDevice(name='/dev/vda',
+                                 model='',
+                                 size=0,
+                                 rotational=False),
+        ]
+        devices = self.hardware.list_block_devices()
+        self.assertEqual([d.serialize() for d in expected_devices],
+                         [d.serialize() for d in devices])
+
+    @mock.patch.object(utils, 'execute')
+    def test_list_block_devices_fallback(self, mocked_execute):
+        mocked_execute.return_value = (BLK_DEVICE_TEMPLATE, '')
+        self.hardware.sys_path = os.path.join(self.hardware.sys_path, 'none')
+        devices = self.hardware.list_block_devices()
+        self.assertEqual(4, len(devices))
+        mocked_execute.assert_called_once_with(
+            'lsblk', '-PbdioKNAME,MODEL,SIZE,ROTA,TYPE', check_exit_code=[0])
+
+
 class TestGenericHardwareManager(test_base.BaseTestCase):
     def setUp(self):
         super(TestGenericHardwareManager, self).setUp()
+        self.config = self.useFixture(config_fixture.Config()).config
+        # Without udev events nothing is cached between calls
+        patcher = mock.patch.object(hardware._InventoryCache,
+                                    '_start_monitor', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Block devices are listed with lsblk, see TestListBlockDevicesSysfs
+        patcher = mock.patch.object(hardware.GenericHardwareManager,
+                                    '_list_block_devices_sysfs',
+                                    side_effect=OSError('no sysfs'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.hardware = hardware.GenericHardwareManager()
         self.node = {'uuid': 'dda135fb-732d-4742-8e72-df8f3199d244',
                      'driver_internal_info': {}}
@@ -257,6 +421,23 @@ class TestGenericHardwareManager(test_base.BaseTestCase):
                     mock.call(mock.ANY, '/dev/sdd')]
         mock_pyudev.assert_has_calls(expected)
 
+    @mock.patch.object(pyudev.Device, 'from_device_file')
+    @mock.patch.object(utils, 'parse_root_device_hints')
+    @mock.patch.object(utils, 'execute')
+    def test_get_os_install_devices(self, mocked_execute, mock_root_device,
+                                    mock_pyudev):
+        mock_root_device.return_value = {'model': 'nwd-blp4-1600'}
+        mock_pyudev.side_effect = lambda context, name: {
+            'ID_MODEL': 'NWD-BLP4-1600' if name in ('/dev/sdc', '/dev/sdd')
+            else 'other'}
+        mocked_execute.return_value = (BLK_DEVICE_TEMPLATE, '')
+        self.assertEqual(['/dev/sdc', '/dev/sdd'],
+                         self.hardware.get_os_install_devices())
+
+        mock_root_device.return_value = {'model': 'endo-sym armor'}
+        self.assertRaises(errors.DeviceNotFound,
+                          self.hardware.get_os_install_devices)
+
     def test__get_device_vendor(self):
         fileobj = mock.mock_open(read_data='fake-vendor')
         with mock.patch(OPEN_FUNCTION_NAME, fileobj, create=True) as mock_open:
@@ -364,6 +545,74 @@ class TestGenericHardwareManager(test_base.BaseTestCase):
         self.assertEqual(hardware_info['interfaces'],
                          self.hardware.list_network_interfaces())
 
+    def _mock_hardware_info_sections(self):
+        for method in ('list_network_interfaces', 'get_cpus',
+                       'list_block_devices', 'get_memory'):
+            setattr(self.hardware, method, mock.Mock(return_value=method))
+
+    def test_list_hardware_info_concurrent(self):
+        self._mock_hardware_info_sections()
+        # Each section waits for the other, both must run at once
+        cpus_started = threading.Event()
+        memory_started = threading.Event()
+
+        def get_cpus():
+            cpus_started.set()
+            return memory_started.wait(5) and 'cpus'
+
+        def get_memory():
+            memory_started.set()
+            return cpus_started.wait(5) and 'memory'
+
+        self.hardware.get_cpus.side_effect = get_cpus
+        self.hardware.get_memory.side_effect = get_memory
+        hardware_info = self.hardware.list_hardware_info()
+        self.assertEqual('cpus', hardware_info['cpu'])
+        self.assertEqual('memory', hardware_info['memory'])
+        self.assertEqual(set(['interfaces', 'cpu', 'disks', 'memory']),
+                         set(hardware_info['timings']))
+
+    def test_list_hardware_info_extra_section(self):
+        self._mock_hardware_info_sections()
+        sections = self.hardware.get_hardware_info_sections()
+        sections['gpus'] = mock.Mock(return_value=['gpu0'])
+        self.hardware.get_hardware_info_sections = mock.Mock(
+            return_value=sections)
+        hardware_info = self.hardware.list_hardware_info()
+        self.assertEqual(['gpu0'], hardware_info['gpus'])
+        self.assertEqual('list_block_devices', hardware_info['disks'])
+        self.assertIn('gpus', hardware_info['timings'])
+
+    def test_list_hardware_info_timeout(self):
+        self._mock_hardware_info_sections()
+        self.config(hardware_info_threads=1,
+                    hardware_info_section_timeout=0.1)
+        stuck = threading.Event()
+        self.addCleanup(stuck.set)
+        self.hardware.list_block_devices.side_effect = stuck.wait
+        hardware_info = self.hardware.list_hardware_info()
+        self.assertNotIn('disks', hardware_info)
+        self.assertGreaterEqual(hardware_info['timings']['disks'], 0.1)
+        # The stuck thread is replaced to collect the other sections
+        self.assertEqual('get_cpus', hardware_info['cpu'])
+        self.assertEqual('get_memory', hardware_info['memory'])
+        self.assertEqual('list_network_interfaces',
+                         hardware_info['interfaces'])
+
+    def test_list_hardware_info_no_threads(self):
+        self.assertRaises(ValueError, self.config, hardware_info_threads=0)
+        sections = {'cpu': mock.Mock(return_value='cpus'),
+                    'memory': mock.Mock(return_value='memory')}
+        hardware_info, timings = hardware._collect_sections(sections, 0, 1)
+        self.assertEqual({'cpu': 'cpus', 'memory': 'memory'}, hardware_info)
+
+    def test_list_hardware_info_error(self):
+        self._mock_hardware_info_sections()
+        self.hardware.get_cpus.side_effect = (
+            errors.IncompatibleHardwareMethodError)
+        self.assertRaises(errors.IncompatibleHardwareMethodError,
+                          self.hardware.list_hardware_info)
+
     @mock.patch.object(utils, 'execute')
     def test_list_block_device(self, mocked_execute):
         mocked_execute.return_value = (BLK_DEVICE_TEMPLATE, '')
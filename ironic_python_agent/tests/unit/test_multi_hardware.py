@@ -211,6 +211,83 @@ class TestMultipleHardwareManagerLoading(test_base.BaseTestCase):
                           hardware.dispatch_to_all_managers,
                           'unexpected_fail')
 
+    def test_support_evaluated_once(self):
+        hardware.dispatch_to_managers('both_succeed')
+        hardware.dispatch_to_all_managers('both_succeed')
+
+        for hwm in (self.generic_hwm, self.mainline_hwm):
+            self.assertEqual(
+                1, hwm.obj._call_counts['evaluate_hardware_support'])
+
+    def test_support_evaluated_again_on_hotplug(self):
+        hardware.dispatch_to_managers('both_succeed')
+        hardware._invalidate_hardware_support()
+        hardware.dispatch_to_managers('both_succeed')
+        hardware.dispatch_to_managers('both_succeed')
+
+        for hwm in (self.generic_hwm, self.mainline_hwm):
+            self.assertEqual(
+                2, hwm.obj._call_counts['evaluate_hardware_support'])
+        self.assertEqual(3, self.mainline_hwm.obj._call_counts['both_succeed'])
+        # The extensions are not loaded again
+        self.mocked_extension_mgr.assert_called_once_with(
+            namespace='ironic_python_agent.hardware_managers',
+            invoke_on_load=True)
+
+    def test_support_evaluation_dispatches(self):
+        hardware.dispatch_to_managers('both_succeed')
+        hardware._invalidate_hardware_support()
+
+        def evaluate_hardware_support():
+            # Dispatched to the managers evaluated previously
+            self.assertEqual('generic_only',
+                             hardware.dispatch_to_managers('generic_only'))
+            return hardware.HardwareSupport.MAINLINE
+
+        with mock.patch.object(self.mainline_hwm.obj,
+                               'evaluate_hardware_support',
+                               side_effect=evaluate_hardware_support):
+            self.assertEqual('specific_both',
+                             hardware.dispatch_to_managers('both_succeed'))
+        self.assertEqual(1, self.generic_hwm.obj._call_counts['generic_only'])
+
+    def test_unsupported_methods_not_dispatched(self):
+        # Neither manager overrides the method of HardwareManager
+        self.assertRaises(errors.HardwareManagerMethodNotFound,
+                          hardware.dispatch_to_managers,
+                          'get_cpus')
+        self.assertEqual([], hardware._get_candidates('get_cpus'))
+
+    def test_dispatch_tracer(self):
+        tracer = mock.Mock()
+        hardware.set_dispatch_tracer(tracer)
+        self.addCleanup(hardware.set_dispatch_tracer, None)
+
+        hardware.dispatch_to_managers('mainline_fail')
+
+        self.assertEqual(
+            [mock.call('mainline_fail', self.mainline_hwm.obj, mock.ANY),
+             mock.call('mainline_fail', self.generic_hwm.obj, mock.ANY)],
+            tracer.call_args_list)
+
+    @mock.patch.object(hardware, 'LOG', autospec=True)
+    def test_dispatch_tracer_default(self, log_mock):
+        hardware.dispatch_to_managers('specific_only')
+
+        log_mock.debug.assert_any_call(
+            'Called %(method)s on manager %(manager)s in %(seconds).3f '
+            'seconds', {'method': 'specific_only',
+                        'manager': self.mainline_hwm.obj,
+                        'seconds': mock.ANY})
+
+    def test_dispatch_tracer_fails(self):
+        hardware.set_dispatch_tracer(mock.Mock(side_effect=RuntimeError))
+        self.addCleanup(hardware.set_dispatch_tracer, None)
+
+        self.assertEqual({'FakeGenericHardwareManager': 'generic_both',
+                          'FakeMainlineHardwareManager': 'specific_both'},
+                         hardware.dispatch_to_all_managers('both_succeed'))
+
 
 class TestNoHardwareManagerLoading(test_base.BaseTestCase):
     def setUp(self):
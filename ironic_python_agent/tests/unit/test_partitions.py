@@ -0,0 +1,438 @@
+# Copyright 2026 Ironic Python Agent contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import uuid
+import zlib
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import errors
+from ironic_python_agent import partitions
+
+MB = 1024 * 1024
+SECTOR = 512
+ROOT_UUID = '6a1c0fb3-7b8a-4c6d-9e0f-112233445566'
+PART_UUID = '0c2bd4a6-1f40-4b52-8a1b-aabbccddeeff'
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _mbr(entries):
+    """Build an MBR from (type, start sector, sector count) tuples."""
+    mbr = bytearray(SECTOR)
+    for i, (ptype, start, count) in enumerate(entries):
+        struct.pack_into('<B3sB3sII', mbr, 446 + i * 16, 0, b'\0' * 3,
+                         ptype, b'\0' * 3, start, count)
+    mbr[510:512] = b'\x55\xaa'
+    return bytes(mbr)
+
+
+def _gpt(sectors, entries, entries_count=128):
+    """Build the primary GPT header and entries of a disk.
+
+    :param entries: (first sector, last sector, unique GUID, name) tuples.
+    """
+    table = bytearray(entries_count * 128)
+    for i, (first, last, unique, name) in enumerate(entries):
+        struct.pack_into('<16s16sQQQ72s', table, i * 128,
+                         uuid.UUID(partitions.GPT_LINUX).bytes_le,
+                         uuid.UUID(unique).bytes_le, first, last, 0,
+                         name.encode('utf-16-le'))
+    table = bytes(table)
+    table_sectors = len(table) // SECTOR
+    fields = [b'EFI PART', 0x10000, 92, 0, 0, 1, sectors - 1,
+              2 + table_sectors, sectors - 2 - table_sectors,
+              uuid.uuid4().bytes_le, 2, entries_count, 128, _crc32(table)]
+    fields[3] = _crc32(struct.pack('<8sIIIIQQQQ16sQIII', *fields))
+    header = struct.pack('<8sIIIIQQQQ16sQIII', *fields).ljust(SECTOR, b'\0')
+    return header + table
+
+
+def _ext4_superblock(label, fs_uuid):
+    sb = bytearray(1024)
+    sb[56:58] = b'\x53\xef'
+    sb[104:120] = uuid.UUID(fs_uuid).bytes
+    sb[120:136] = label.encode('ascii').ljust(16, b'\0')
+    return b'\0' * 1024 + bytes(sb)
+
+
+def _iso9660(label):
+    descriptor = bytearray(2048)
+    descriptor[0:6] = b'\x01CD001'
+    descriptor[40:72] = label.encode('ascii').ljust(32, b' ')
+    return b'\0' * 32768 + bytes(descriptor)
+
+
+def _vfat(label, serial):
+    boot = bytearray(SECTOR)
+    boot[39:43] = struct.pack('<I', serial)
+    boot[43:54] = label.encode('ascii').ljust(11, b' ')
+    boot[54:62] = b'FAT16   '
+    boot[510:512] = b'\x55\xaa'
+    return bytes(boot)
+
+
+class TestPartitions(test_base.BaseTestCase):
+
+    def setUp(self):
+        super(TestPartitions, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.disk = os.path.join(tmpdir, 'disk.img')
+
+    def _write(self, size, *parts):
+        """Create a disk image of size bytes with data at given offsets."""
+        with open(self.disk, 'wb') as f:
+            f.truncate(size)
+            for offset, data in parts:
+                f.seek(offset)
+                f.write(data)
+
+    def _table(self):
+        with open(self.disk, 'rb') as f:
+            return partitions.PartitionTable(f)
+
+    def _mbr_disk(self):
+        # Primary partition, then an extended partition holding two logical
+        # partitions
+        ebr1 = _mbr([(0x83, 1, 2047), (0x05, 2048, 4096)])
+        ebr2 = _mbr([(0x83, 1, 2047)])
+        self._write(16 * MB,
+                    (0, _mbr([(0x83, 2048, 4096), (0x05, 6144, 8192)])),
+                    (6144 * SECTOR, ebr1),
+                    (8192 * SECTOR, ebr2),
+                    (2048 * SECTOR, _ext4_superblock('root', ROOT_UUID)),
+                    (8193 * SECTOR, _vfat('EFI', 0x45ab2312)))
+
+    def _gpt_disk(self, size=16 * MB):
+        sectors = size // SECTOR
+        self._write(size,
+                    (0, _mbr([(0xee, 1, sectors - 1)])),
+                    (SECTOR, _gpt(sectors,
+                                  [(2048, 6143, PART_UUID, 'root')])),
+                    (2048 * SECTOR, _ext4_superblock('root', ROOT_UUID)))
+
+    def test_read_mbr(self):
+        self._mbr_disk()
+        table = self._table()
+        self.assertEqual('dos', table.label)
+        self.assertEqual(
+            [partitions.Partition(1, 1 * MB, 2 * MB, 0x83, None, None),
+             partitions.Partition(2, 3 * MB, 4 * MB, 0x05, None, None),
+             partitions.Partition(5, 3 * MB + SECTOR, MB - SECTOR, 0x83,
+                                  None, None),
+             partitions.Partition(6, 4 * MB + SECTOR, MB - SECTOR, 0x83,
+                                  None, None)],
+            table.partitions)
+
+    def test_read_gpt(self):
+        self._gpt_disk()
+        table = self._table()
+        self.assertEqual('gpt', table.label)
+        self.assertEqual(
+            [partitions.Partition(1, 1 * MB, 2 * MB, partitions.GPT_LINUX,
+                                  PART_UUID, 'root')],
+            table.partitions)
+
+    def test_read_invalid_gpt(self):
+        self._gpt_disk()
+        with open(self.disk, 'r+b') as f:
+            f.seek(SECTOR + 50)
+            f.write(b'garbage')
+        self.assertRaisesRegexp(errors.BlockDeviceError, 'Invalid GPT',
+                                self._table)
+
+    def test_read_no_partition_table(self):
+        self._write(MB)
+        self.assertRaisesRegexp(errors.BlockDeviceError, 'No partition',
+                                self._table)
+        # A filesystem on the whole disk
+        self._write(MB, (0, b'\xeb\x3c\x90' + b'\xff' * 500 + _vfat(
+            'data', 1)[503:]))
+        self.assertRaisesRegexp(errors.BlockDeviceError, 'No partition',
+                                self._table)
+
+    def test_find_partition(self):
+        self._mbr_disk()
+        self.assertEqual(self.disk + '1',
+                         partitions.find_partition(self.disk,
+                                                   uuid=ROOT_UUID.upper()))
+        self.assertEqual(self.disk + '6',
+                         partitions.find_partition(self.disk,
+                                                   uuid='45AB-2312'))
+        self.assertEqual(self.disk + '6',
+                         partitions.find_partition(self.disk, label='EFI'))
+        self.assertIsNone(partitions.find_partition(self.disk,
+                                                    label='config-2'))
+        self.assertIsNone(partitions.find_partition(self.disk,
+                                                    uuid=PART_UUID))
+
+    def test_find_partition_gpt(self):
+        self._gpt_disk()
+        self.assertEqual(self.disk + '1',
+                         partitions.find_partition(self.disk,
+                                                   uuid=PART_UUID))
+        self.assertEqual(self.disk + '1',
+                         partitions.find_partition(self.disk,
+                                                   uuid=ROOT_UUID))
+
+    def test_find_partition_iso9660(self):
+        self._write(16 * MB, (0, _mbr([(0x83, 2048, 2048)])),
+                    (2048 * SECTOR, _iso9660('config-2')))
+        self.assertEqual(self.disk + '1',
+                         partitions.find_partition(self.disk,
+                                                   label='config-2'))
+
+    def test_find_partition_not_readable(self):
+        self.assertRaisesRegexp(errors.BlockDeviceError, 'Unable to read',
+                                partitions.find_partition, self.disk,
+                                label='config-2')
+
+    def test_add_partition_mbr(self):
+        self._mbr_disk()
+        self.assertEqual(self.disk + '3',
+                         partitions.add_partition(self.disk, 4 * MB))
+
+        partition = [p for p in self._table().partitions if p.number == 3][0]
+        self.assertEqual(
+            partitions.Partition(3, 12 * MB, 4 * MB, partitions.MBR_LINUX,
+                                 None, None),
+            partition)
+
+    def test_add_partition_mbr_unaligned_size(self):
+        self._write(16 * MB, (0, _mbr([])))
+        partitions.add_partition(self.disk, 4 * MB + 1)
+        self.assertEqual(
+            [partitions.Partition(1, 11 * MB, 5 * MB, partitions.MBR_LINUX,
+                                  None, None)],
+            self._table().partitions)
+
+    def test_add_partition_mbr_no_free_entry(self):
+        self._write(16 * MB, (0, _mbr([(0x83, 2048, 2048)] * 4)))
+        self.assertRaisesRegexp(errors.BlockDeviceError, 'No free entry',
+                                partitions.add_partition, self.disk, MB)
+
+    def test_add_partition_no_space(self):
+        self._mbr_disk()
+        self.assertRaisesRegexp(errors.BlockDeviceError,
+                                'Not enough free space',
+                                partitions.add_partition, self.disk, 12 * MB)
+
+    def test_add_partition_gpt(self):
+        # A disk image written to a larger disk
+        self._gpt_disk(size=8 * MB)
+        with open(self.disk, 'r+b') as f:
+            f.truncate(16 * MB)
+
+        path = partitions.add_partition(self.disk, 4 * MB, name='config-2')
+        self.assertEqual(self.disk + '2', path)
+
+        sectors = 16 * MB // SECTOR
+        with open(self.disk, 'rb') as f:
+            table = partitions.PartitionTable(f)
+            partition = table.partitions[1]
+            self.assertEqual((2, 11 * MB, 5 * MB - 33 * SECTOR,
+                              partitions.GPT_LINUX, 'config-2'),
+                             partition[:4] + partition[5:])
+            self.assertEqual(sectors - 1, table._gpt[6])
+            self.assertEqual(sectors - 34, table._gpt[8])
+            # The backup table is at the end of the disk
+            backup, entries = table._gpt_header(sectors - 1)
+            self.assertEqual([sectors - 1, 1, sectors - 33],
+                             [backup[5], backup[6], backup[10]])
+            self.assertEqual(table._gpt_entries, entries)
+            # and the protective MBR covers the disk
+            f.seek(0)
+            self.assertEqual(sectors - 1,
+                             struct.unpack_from('<I', f.read(SECTOR),
+                                                446 + 12)[0])
+
+    def test_create_partitions_gpt(self):
+        # The previous table is replaced, backup included
+        self._gpt_disk(size=32 * MB)
+        paths = partitions.create_partitions(
+            self.disk, 'gpt',
+            [{'size': MB, 'name': 'bios', 'type': 'bios_grub'},
+             {'size': 4 * MB, 'name': 'efi', 'type': 'efi'},
+             {'size': None, 'name': 'root'}],
+            reserve=8 * MB)
+        self.assertEqual([self.disk + '1', self.disk + '2', self.disk + '3'],
+                         paths)
+
+        sectors = 32 * MB // SECTOR
+        with open(self.disk, 'rb') as f:
+            table = partitions.PartitionTable(f)
+            self.assertEqual('gpt', table.label)
+            self.assertEqual(
+                [(1, MB, MB, '21686148-6449-6e6f-744e-656564454649', 'bios'),
+                 (2, 2 * MB, 4 * MB, 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b',
+                  'efi'),
+                 (3, 6 * MB, (sectors - 34 - 8 * MB // SECTOR + 1) * SECTOR
+                  - 6 * MB, partitions.GPT_LINUX, 'root')],
+                [p[:4] + p[5:] for p in table.partitions])
+            backup, entries = table._gpt_header(sectors - 1)
+            self.assertEqual(table._gpt_entries, entries)
+            # Nothing is left of the previous root filesystem
+            self.assertEqual((None, None),
+                             partitions._probe_filesystem(f, 2048 * SECTOR))
+        # The reserved space holds a partition added later
+        partitions.add_partition(self.disk, 4 * MB)
+        self.assertEqual(4, len(self._table().partitions))
+
+    def test_create_partitions_mbr(self):
+        self._gpt_disk()
+        partitions.create_partitions(
+            self.disk, 'dos',
+            [{'size': 4 * MB, 'name': 'efi', 'type': 'efi'},
+             {'size': None, 'name': 'root', 'bootable': True}])
+
+        self.assertEqual(
+            [partitions.Partition(1, MB, 4 * MB, 0xef, None, None),
+             partitions.Partition(2, 5 * MB, 11 * MB, partitions.MBR_LINUX,
+                                  None, None)],
+            self._table().partitions)
+        with open(self.disk, 'rb') as f:
+            mbr = f.read(SECTOR)
+            # No trace of the GPT backup either
+            f.seek(-SECTOR, os.SEEK_END)
+            self.assertEqual(b'\0' * SECTOR, f.read(SECTOR))
+        self.assertEqual([0, 0x80], [ord(mbr[446:447]), ord(mbr[462:463])])
+
+    def test_create_partitions_no_space(self):
+        self._write(16 * MB)
+        self.assertRaisesRegexp(errors.BlockDeviceError,
+                                'Not enough free space',
+                                partitions.create_partitions, self.disk,
+                                'gpt', [{'size': 8 * MB},
+                                        {'size': 8 * MB}])
+        self.assertRaisesRegexp(errors.BlockDeviceError,
+                                'Not enough free space',
+                                partitions.create_partitions, self.disk,
+                                'dos', [{'size': None}], reserve=16 * MB)
+
+    def test_create_partitions_invalid_type(self):
+        self._write(16 * MB)
+        self.assertRaisesRegexp(errors.BlockDeviceError, 'need a GPT',
+                                partitions.create_partitions, self.disk,
+                                'dos', [{'size': MB, 'type': 'bios_grub'}])
+        self.assertRaisesRegexp(errors.BlockDeviceError,
+                                'Unknown partition type',
+                                partitions.create_partitions, self.disk,
+                                'gpt', [{'size': MB, 'type': 'ntfs'}])
+
+    @mock.patch.object(partitions, '_tell_kernel', autospec=True)
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('os.fstat', autospec=True)
+    def test_reread_table(self, fstat_mock, ioctl_mock, tell_mock):
+        fstat_mock.return_value.st_mode = stat.S_IFBLK
+        f = mock.Mock()
+        created = [partitions.Partition(1, MB, MB, 0x83, None, None),
+                   partitions.Partition(2, 2 * MB, MB, 0x83, None, None)]
+
+        partitions._reread_table(f, '/dev/sda', created)
+        ioctl_mock.assert_called_once_with(f.fileno.return_value,
+                                           partitions.BLKRRPART)
+        self.assertFalse(tell_mock.called)
+
+        # Partitions in use are added one by one
+        ioctl_mock.side_effect = IOError(errno.EBUSY, 'Device busy')
+        partitions._reread_table(f, '/dev/sda', created)
+        tell_mock.assert_has_calls([mock.call(f, '/dev/sda', p)
+                                    for p in created])
+
+    def test_probe_filesystem(self):
+        self._write(MB, (0, _vfat('EFI', 0x45ab2312)))
+        self.assertEqual(('EFI', '45AB-2312'),
+                         partitions.probe_filesystem(self.disk))
+        self.assertRaises(errors.BlockDeviceError,
+                          partitions.probe_filesystem, self.disk + 'x')
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('os.fstat', autospec=True)
+    def test_tell_kernel(self, fstat_mock, ioctl_mock):
+        fstat_mock.return_value.st_mode = stat.S_IFBLK
+        partition = partitions.Partition(3, 12 * MB, 4 * MB, 0x83, None,
+                                         None)
+        f = mock.Mock()
+        added = []
+
+        def blkpg(fd, request, arg):
+            blkpg_partition = partitions._BlkpgPartition.from_address(
+                arg.data)
+            added.append((arg.op, blkpg_partition.start,
+                          blkpg_partition.length, blkpg_partition.pno))
+
+        ioctl_mock.side_effect = blkpg
+        partitions._tell_kernel(f, '/dev/sda', partition)
+        ioctl_mock.assert_called_once_with(f.fileno.return_value,
+                                           partitions.BLKPG, mock.ANY)
+        self.assertEqual(
+            [(partitions.BLKPG_ADD_PARTITION, 12 * MB, 4 * MB, 3)], added)
+
+    @mock.patch.object(partitions, '_known_to_kernel', autospec=True)
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('os.fstat', autospec=True)
+    def test_tell_kernel_already_known(self, fstat_mock, ioctl_mock,
+                                       known_mock):
+        fstat_mock.return_value.st_mode = stat.S_IFBLK
+        ioctl_mock.side_effect = IOError(errno.EBUSY, 'Device busy')
+        known_mock.return_value = True
+        partition = partitions.Partition(1, MB, MB, 0x83, None, None)
+
+        partitions._tell_kernel(mock.Mock(), '/dev/sda', partition)
+        self.assertEqual(1, ioctl_mock.call_count)
+        known_mock.assert_called_once_with('/dev/sda', partition)
+
+    @mock.patch.object(partitions, '_known_to_kernel', autospec=True)
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('os.fstat', autospec=True)
+    def test_tell_kernel_reread(self, fstat_mock, ioctl_mock, known_mock):
+        fstat_mock.return_value.st_mode = stat.S_IFBLK
+        ioctl_mock.side_effect = [IOError(errno.EBUSY, 'Device busy'), None]
+        known_mock.return_value = False
+        f = mock.Mock()
+        partition = partitions.Partition(1, MB, MB, 0x83, None, None)
+
+        partitions._tell_kernel(f, '/dev/sda', partition)
+        ioctl_mock.assert_called_with(f.fileno.return_value,
+                                      partitions.BLKRRPART)
+
+        ioctl_mock.side_effect = IOError(errno.EBUSY, 'Device busy')
+        self.assertRaisesRegexp(errors.BlockDeviceError, 'Unable to tell',
+                                partitions._tell_kernel, f, '/dev/sda',
+                                partition)
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_tell_kernel_regular_file(self, ioctl_mock):
+        self._write(MB)
+        with open(self.disk, 'rb') as f:
+            partitions._tell_kernel(
+                f, self.disk,
+                partitions.Partition(1, 0, MB, 0x83, None, None))
+        self.assertFalse(ioctl_mock.called)
+
+    def test_partition_path(self):
+        self.assertEqual('/dev/sda1', partitions.partition_path('/dev/sda',
+                                                                1))
+        self.assertEqual('/dev/nvme0n1p2',
+                         partitions.partition_path('/dev/nvme0n1', 2))
@@ -0,0 +1,199 @@
+# Copyright 2026 Ironic Python Agent contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+import mock
+from oslotest import base as test_base
+
+from ironic_python_agent import errors
+from ironic_python_agent import qcow2
+
+CLUSTER_BITS = 9
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+# Clusters mapped by an L2 table
+L2_CLUSTERS = CLUSTER_SIZE // 8
+COPIED = 1 << 63
+
+
+def _build_image(clusters, size, version=3, data_first=False, zero=(),
+                 compressed=(), **header):
+    """Build a qcow2 image laid out the way qemu-img does.
+
+    :param clusters: dictionary of the data of guest clusters by index.
+    :param data_first: whether data clusters come before the L2 table
+                       mapping them instead of after it.
+    :param zero: indexes of guest clusters flagged as reading as zeros.
+    :param compressed: indexes of guest clusters flagged as compressed.
+    :param header: header fields to override.
+    """
+    l1_size = -(-size // (L2_CLUSTERS * CLUSTER_SIZE))
+    # Header, refcount table, refcount block and L1 table come first
+    body = []
+    next_offset = 4 * CLUSTER_SIZE
+    l1 = [0] * l1_size
+    for l1_index in range(l1_size):
+        used = set(clusters) | set(zero) | set(compressed)
+        indexes = [i for i in sorted(used) if i // L2_CLUSTERS == l1_index]
+        if not indexes:
+            continue
+        data_indexes = [i for i in indexes if i in clusters]
+        if data_first:
+            data_offset = next_offset
+            l2_offset = next_offset + len(data_indexes) * CLUSTER_SIZE
+        else:
+            l2_offset = next_offset
+            data_offset = next_offset + CLUSTER_SIZE
+        next_offset += (len(data_indexes) + 1) * CLUSTER_SIZE
+        l1[l1_index] = l2_offset | COPIED
+
+        l2 = [0] * L2_CLUSTERS
+        data = []
+        for i in indexes:
+            if i in compressed:
+                l2[i % L2_CLUSTERS] = (1 << 62) | data_offset
+            elif i in zero:
+                l2[i % L2_CLUSTERS] = 1
+            if i not in clusters:
+                continue
+            l2[i % L2_CLUSTERS] = data_offset | COPIED
+            data.append(clusters[i].ljust(CLUSTER_SIZE, b'\0'))
+            data_offset += CLUSTER_SIZE
+        l2 = struct.pack('>{0}Q'.format(L2_CLUSTERS), *l2)
+        body.extend(data + [l2] if data_first else [l2] + data)
+
+    fields = dict(magic=qcow2.MAGIC, version=version, backing_file_offset=0,
+                  backing_file_size=0, cluster_bits=CLUSTER_BITS, size=size,
+                  crypt_method=0, l1_size=l1_size,
+                  l1_table_offset=3 * CLUSTER_SIZE,
+                  refcount_table_offset=CLUSTER_SIZE,
+                  refcount_table_clusters=1, nb_snapshots=0,
+                  snapshots_offset=0, incompatible_features=0)
+    fields.update(header)
+    image = struct.pack(
+        '>4sIQIIQIIQQIIQ', fields['magic'], fields['version'],
+        fields['backing_file_offset'], fields['backing_file_size'],
+        fields['cluster_bits'], fields['size'], fields['crypt_method'],
+        fields['l1_size'], fields['l1_table_offset'],
+        fields['refcount_table_offset'], fields['refcount_table_clusters'],
+        fields['nb_snapshots'], fields['snapshots_offset'])
+    if version == 3:
+        image += struct.pack('>QQQII', fields['incompatible_features'], 0, 0,
+                             4, 104)
+    reftable = struct.pack('>Q', 2 * CLUSTER_SIZE)
+    l1 = struct.pack('>{0}Q'.format(l1_size), *l1)
+    return b''.join([image.ljust(CLUSTER_SIZE, b'\0'),
+                     reftable.ljust(CLUSTER_SIZE, b'\0'),
+                     b'\0' * CLUSTER_SIZE,
+                     l1.ljust(CLUSTER_SIZE, b'\0')] + body)
+
+
+class TestStreamDecoder(test_base.BaseTestCase):
+
+    def setUp(self):
+        super(TestStreamDecoder, self).setUp()
+        # Two L2 tables, a hole, a zero cluster and a last cluster going
+        # past the end of the disk
+        self.size = (L2_CLUSTERS + 3) * CLUSTER_SIZE - 100
+        self.clusters = {0: b'a' * CLUSTER_SIZE,
+                         2: b'b' * 10,
+                         L2_CLUSTERS: b'c' * CLUSTER_SIZE,
+                         L2_CLUSTERS + 2: b'd' * CLUSTER_SIZE}
+        self.zero = (1,)
+
+    def _expected(self):
+        raw = bytearray(self.size)
+        for i, data in self.clusters.items():
+            data = data.ljust(CLUSTER_SIZE, b'\0')
+            data = data[:self.size - i * CLUSTER_SIZE]
+            raw[i * CLUSTER_SIZE:i * CLUSTER_SIZE + len(data)] = data
+        return bytes(raw)
+
+    def _decode(self, image, chunk_size=1000):
+        chunks = [image[i:i + chunk_size]
+                  for i in range(0, len(image), chunk_size)]
+        writes = list(qcow2.StreamDecoder('fake_id').decode(chunks))
+        self.assertEqual((self.size, b''), writes[-1])
+        raw = bytearray(self.size)
+        for offset, data in writes:
+            raw[offset:offset + len(data)] = data
+        return bytes(raw), writes
+
+    def test_decode(self):
+        image = _build_image(self.clusters, self.size, zero=self.zero)
+        for chunk_size in (100, CLUSTER_SIZE, 1000, len(image)):
+            raw, writes = self._decode(image, chunk_size)
+            self.assertEqual(self._expected(), raw)
+            self.assertEqual([0, 2 * CLUSTER_SIZE,
+                              L2_CLUSTERS * CLUSTER_SIZE,
+                              (L2_CLUSTERS + 2) * CLUSTER_SIZE, self.size],
+                             [offset for offset, data in writes])
+
+    def test_decode_version_2(self):
+        image = _build_image(self.clusters, self.size, version=2)
+        self.assertEqual(self._expected(), self._decode(image)[0])
+
+    def test_decode_data_before_tables(self):
+        image = _build_image(self.clusters, self.size, data_first=True)
+        self.assertEqual(self._expected(), self._decode(image)[0])
+
+    def test_decode_unaligned_end(self):
+        image = _build_image(self.clusters, self.size)[:-200]
+        self.assertEqual(self._expected()[:-100] + b'\0' * 100,
+                         self._decode(image)[0])
+
+    def test_decode_empty(self):
+        self.size = 0
+        image = _build_image({}, 0)
+        self.assertEqual([(0, b'')], self._decode(image)[1])
+
+    @mock.patch.object(qcow2, 'MAX_PENDING_BYTES', CLUSTER_SIZE)
+    def test_decode_too_many_pending_clusters(self):
+        image = _build_image(self.clusters, self.size, data_first=True)
+        self.assertRaisesRegexp(errors.ImageFormatError, 'precede',
+                                self._decode, image)
+
+    def test_decode_truncated(self):
+        image = _build_image(self.clusters, self.size)
+        self.assertRaisesRegexp(errors.ImageFormatError,
+                                '1 clusters are missing',
+                                self._decode, image[:-CLUSTER_SIZE])
+        self.assertRaisesRegexp(errors.ImageFormatError,
+                                'L1 table is missing',
+                                self._decode, image[:3 * CLUSTER_SIZE])
+        self.assertRaisesRegexp(errors.ImageFormatError, 'too short',
+                                self._decode, image[:50])
+
+    def test_decode_compressed(self):
+        image = _build_image(self.clusters, self.size, compressed=(3,))
+        self.assertRaisesRegexp(errors.ImageFormatError, 'compressed',
+                                self._decode, image)
+
+    def test_decode_unsupported_header(self):
+        for header, msg in [({'magic': b'QFI\0'}, 'not a qcow2 image'),
+                            ({'version': 4}, 'version 4'),
+                            ({'backing_file_offset': 1024}, 'backing file'),
+                            ({'crypt_method': 1}, 'encrypted'),
+                            ({'nb_snapshots': 1}, 'snapshots'),
+                            ({'cluster_bits': 30}, 'cluster size'),
+                            ({'incompatible_features': 2}, '0x2'),
+                            ({'l1_table_offset': 100}, 'aligned')]:
+            image = _build_image(self.clusters, self.size, **header)
+            self.assertRaisesRegexp(errors.ImageFormatError, msg,
+                                    self._decode, image)
+
+    def test_decode_dirty(self):
+        image = _build_image(self.clusters, self.size,
+                             incompatible_features=1)
+        self.assertEqual(self._expected(), self._decode(image)[0])
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+# Copyright 2026 Ironic Python Agent contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the listing of block devices by the generic hardware manager.
+
+Block devices are listed by reading sysfs, or else with lsblk. Both are run
+against a synthetic sysfs tree of --devices entries, mostly disks along with
+CD-ROMs, loop, device mapper and RAM devices, and their results are checked
+to be the same.
+
+lsblk cannot read another tree than /sys, so the lsblk listing is given the
+report lsblk would print for the synthetic tree, printed by a child process.
+Forking, executing and parsing are measured like with lsblk itself, but not
+the time lsblk spends reading sysfs, so the lsblk figures are a lower bound.
+With --real, both are also run against /sys and the real lsblk.
+
+Example::
+
+    tools/benchmark_block_devices.py --devices 1000 --repeat 20 --real
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from ironic_python_agent import hardware
+from ironic_python_agent import utils
+
+
+def _device_name(prefix, index):
+    """Name devices like the kernel, e.g. sda, sdz, sdaa."""
+    letters = ''
+    index += 1
+    while index:
+        index, letter = divmod(index - 1, 26)
+        letters = chr(ord('a') + letter) + letters
+    return prefix + letters
+
+
+def _synthetic_devices(count):
+    """Return the attributes of count synthetic block devices.
+
+    :returns: a list of (name, attributes) tuples, in device number order.
+    """
+    devices = []
+    for index in range(count):
+        if index % 50 == 49:
+            name, dev = 'loop%d' % index, '7:%d' % index
+            attributes = {}
+        elif index % 50 == 48:
+            name, dev = 'dm-%d' % index, '253:%d' % index
+            attributes = {}
+        elif index % 50 == 47:
+            name, dev = 'sr%d' % index, '11:%d' % index
+            attributes = {'device/model': 'DVD-ROM', 'device/type': '5'}
+        elif index % 100 == 46:
+            name, dev = 'ram%d' % index, '1:%d' % index
+            attributes = {}
+        else:
+            name = _device_name('sd', index)
+            dev = '%d:%d' % (8 + index * 16 // 256, index * 16 % 256)
+            attributes = {'device/model': 'Disk Model %d ' % (index % 7),
+                          'device/type': '0'}
+        attributes.update({'dev': dev,
+                           'size': str((index + 1) * 2 * 1024 * 1024),
+                           'queue/rotational': str(index % 2)})
+        devices.append((name, attributes))
+    devices.sort(key=lambda device: tuple(
+        int(n) for n in device[1]['dev'].split(':')))
+    return devices
+
+
+def build_sysfs(directory, devices):
+    """Write a sysfs tree of block devices under directory."""
+    for name, attributes in devices:
+        for attribute, value in attributes.items():
+            path = os.path.join(directory, 'block', name, attribute)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(value + '\n')
+
+
+def build_lsblk_report(path, devices):
+    """Write the report of lsblk -PbdioKNAME,MODEL,SIZE,ROTA,TYPE."""
+    with open(path, 'w') as f:
+        for name, attributes in devices:
+            if attributes['dev'].startswith('1:'):
+                continue
+            if name.startswith(('loop', 'dm-')):
+                dev_type = 'loop' if name.startswith('loop') else 'dm'
+            elif attributes.get('device/type', '0') != '0':
+                dev_type = 'rom'
+            else:
+                dev_type = 'disk'
+            f.write('KNAME="%s" MODEL="%s" SIZE="%d" ROTA="%s" TYPE="%s"\n'
+                    % (name, attributes.get('device/model', '').strip(),
+                       int(attributes['size']) * 512,
+                       attributes['queue/rotational'], dev_type))
+
+
+def _replay(report):
+    def execute(*cmd, **kwargs):
+        return subprocess.check_output(['cat', report]).decode(), ''
+    return execute
+
+
+def _time(function, repeat):
+    timings = []
+    for run in range(repeat):
+        start = time.time()
+        result = function()
+        timings.append(time.time() - start)
+    timings.sort()
+    return result, {'min_ms': timings[0] * 1000,
+                    'median_ms': timings[len(timings) // 2] * 1000}
+
+
+def compare(manager, repeat, execute=None):
+    """Time both listings of block devices and check they are the same."""
+    sysfs_devices, sysfs = _time(manager._list_block_devices_sysfs, repeat)
+    original_execute = utils.execute
+    if execute is not None:
+        utils.execute = execute
+    try:
+        lsblk_devices, lsblk = _time(manager._list_block_devices_lsblk,
+                                     repeat)
+    finally:
+        utils.execute = original_execute
+    return {'devices': len(sysfs_devices),
+            'same': ([d.serialize() for d in sysfs_devices] ==
+                     [d.serialize() for d in lsblk_devices]),
+            'sysfs': sysfs, 'lsblk': lsblk,
+            'speedup': lsblk['median_ms'] / max(sysfs['median_ms'], 1e-6)}
+
+
+def _print_result(name, result):
+    print('{0}: {1} disks, {2}'.format(
+        name, result['devices'],
+        'same devices' if result['same'] else 'DIFFERENT devices'))
+    for backend in ('sysfs', 'lsblk'):
+        print('  {0:<6} min {1:>9.2f} ms  median {2:>9.2f} ms'.format(
+            backend, result[backend]['min_ms'], result[backend]['median_ms']))
+    print('  speedup {0:.1f}x'.format(result['speedup']))
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the listing of block devices.')
+    parser.add_argument('--devices', type=int, default=1000,
+                        help='Number of devices in the synthetic sysfs '
+                             'tree.')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of runs of each listing.')
+    parser.add_argument('--real', action='store_true',
+                        help='Also compare both listings of the block '
+                             'devices of this machine.')
+    parser.add_argument('--workdir',
+                        help='Directory for the sysfs tree, a temporary '
+                             'one removed afterwards by default.')
+    parser.add_argument('--json', help='File to write the results to.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ipa-benchmark-')
+    manager = hardware.GenericHardwareManager()
+
+    try:
+        devices = _synthetic_devices(args.devices)
+        sysfs = os.path.join(workdir, 'sys')
+        build_sysfs(sysfs, devices)
+        report = os.path.join(workdir, 'lsblk')
+        build_lsblk_report(report, devices)
+
+        manager.sys_path = sysfs
+        results = {'synthetic': compare(manager, args.repeat,
+                                        _replay(report))}
+        _print_result('synthetic', results['synthetic'])
+        if args.real:
+            manager.sys_path = '/sys'
+            results['real'] = compare(manager, args.repeat)
+            _print_result('real', results['real'])
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if all(r['same'] for r in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+
+# Copyright 2026 Ironic Python Agent contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of image deploys by the standby extension.
+
+Synthetic images are served by a local HTTP server and deployed with
+StandbyExtension.prepare_image onto a regular file or a block device, like
+a loop device set up with ``losetup -P``. For each image format and deploy
+mode, the wall time, throughput, peak RSS and CPU time of each phase of the
+deploy are reported, along with the CPU time of the threads of each stage.
+
+Images are raw disks of --size MB of data, a --sparseness fraction of which
+is zeros, followed by free space for the configdrive partition. Formats are
+raw or qcow2, optionally compressed, like raw.gz, raw.xz or qcow2.zst.
+qcow2 images are made with qemu-img. Deploy modes are 'staged', downloading
+the image to /tmp before writing it, qemu-img writing qcow2 images, and
+'stream', writing it to the device while downloading it.
+
+Stages run in the following threads:
+
+* command: download, decompression, qcow2 decoding and configdrive
+* hash: checksums of the downloaded image
+* write: writes to the device
+* extents: digests of the written data, for the image cache
+* other: ranged downloads and reading back the image
+* qemu-img: child processes
+
+Configdrives end up in the partition of a block device. With a regular
+file as target, they end up in a file named like the partition next to it.
+
+Example::
+
+    tools/benchmark_deploy.py --size 1024 --formats raw,raw.gz,qcow2 \\
+        --modes staged,stream --target /dev/loop0
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from oslo_config import cfg
+
+from ironic_python_agent import compression
+from ironic_python_agent.extensions import standby
+from ironic_python_agent import hardware
+
+CONF = cfg.CONF
+
+MB = 1024 * 1024
+# Free space left at the end of images for the configdrive partition
+CONFIGDRIVE_SPACE = standby.CONFIGDRIVE_MAX_SIZE + MB
+
+_COMPRESSORS = {
+    'gz': lambda: zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    'xz': lambda: compression.lzma.LZMACompressor(preset=0),
+    'zst': lambda: compression.zstandard.ZstdCompressor().compressobj(),
+}
+_COMPRESSION_NAMES = {'gz': 'gzip', 'xz': 'xz', 'zst': 'zstd'}
+
+_THREAD_STAGES = {
+    '_ImageHasher': 'hash',
+    '_ImageWriter': 'write',
+    '_ImageExtents': 'extents',
+}
+STAGES = ('command', 'hash', 'write', 'extents', 'other', 'qemu-img')
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the files of a directory, with support for byte ranges."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send_head(self):
+        path = os.path.join(self.server.directory,
+                            os.path.basename(self.path))
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return None, 0, 0
+        size = os.fstat(f.fileno()).st_size
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$',
+                         self.headers.get('Range') or '')
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {0}-{1}/{2}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f, start, end - start + 1
+
+    def do_HEAD(self):
+        f = self._send_head()[0]
+        if f is not None:
+            f.close()
+
+    def do_GET(self):
+        f, start, length = self._send_head()
+        if f is None:
+            return
+        with f:
+            f.seek(start)
+            while length:
+                data = f.read(min(length, MB))
+                if not data:
+                    break
+                self.wfile.write(data)
+                length -= len(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ImageServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server of the images, run in a child process.
+
+    Its CPU time is thus not mixed up with the one of the deploy.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _RequestHandler)
+        self.directory = directory
+        self._process = None
+
+    def start(self):
+        # The process inherits the listening socket
+        context = getattr(multiprocessing, 'get_context',
+                          lambda method: multiprocessing)('fork')
+        self._process = context.Process(target=self.serve_forever)
+        self._process.daemon = True
+        self._process.start()
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+        self.server_close()
+
+    def url(self, name):
+        return 'http://127.0.0.1:{0}/{1}'.format(self.server_address[1],
+                                                 name)
+
+
+class _BenchmarkHardwareManager(hardware.HardwareManager):
+    def __init__(self, target):
+        self.target = target
+
+    def evaluate_hardware_support(self):
+        return hardware.HardwareSupport.SERVICE_PROVIDER
+
+    def get_os_install_device(self):
+        return self.target
+
+
+def _build_raw_image(path, size, sparseness, seed):
+    """Write a raw disk image with a partition of size bytes.
+
+    :returns: the MD5 checksum of the image.
+    """
+    rng = random.Random(seed)
+    md5 = hashlib.md5()
+    mbr = bytearray(512)
+    struct.pack_into('<B3sB3sII', mbr, 446, 0, b'\xfe\xff\xff', 0x83,
+                     b'\xfe\xff\xff', MB // 512, size // 512)
+    mbr[510:512] = b'\x55\xaa'
+    first = bytes(mbr).ljust(MB, b'\0')
+    zeros = b'\0' * MB
+    with open(path, 'wb') as f:
+        f.write(first)
+        md5.update(first)
+        for _ in range(size // MB):
+            if rng.random() < sparseness:
+                f.seek(MB, os.SEEK_CUR)
+                md5.update(zeros)
+            else:
+                data = os.urandom(MB)
+                f.write(data)
+                md5.update(data)
+        for _ in range(CONFIGDRIVE_SPACE // MB):
+            md5.update(zeros)
+        f.truncate(MB + size // MB * MB + CONFIGDRIVE_SPACE)
+    return md5.hexdigest()
+
+
+def _md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MB), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _compress(source, path, extension):
+    compressor = _COMPRESSORS[extension]()
+    md5 = hashlib.md5()
+    with open(source, 'rb') as src, open(path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(MB), b''):
+            data = compressor.compress(chunk)
+            dst.write(data)
+            md5.update(data)
+        data = compressor.flush()
+        dst.write(data)
+        md5.update(data)
+    return md5.hexdigest()
+
+
+def build_images(directory, formats, size, sparseness, seed=0):
+    """Create the images to serve.
+
+    :returns: a dictionary of (file name, checksum, disk format) tuples by
+              format. Formats which cannot be created are left out.
+    """
+    raw = os.path.join(directory, 'raw')
+    images = {'raw': ('raw', _build_raw_image(raw, size, sparseness, seed),
+                      'raw')}
+    if any(fmt.split('.')[0] == 'qcow2' for fmt in formats):
+        try:
+            subprocess.check_call(['qemu-img', 'convert', '-f', 'raw', '-O',
+                                   'qcow2', raw,
+                                   os.path.join(directory, 'qcow2')])
+            images['qcow2'] = ('qcow2',
+                               _md5(os.path.join(directory, 'qcow2')),
+                               'qcow2')
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Skipping qcow2 images, qemu-img failed: {0}'.format(e))
+    for fmt in formats:
+        base, _dot, extension = fmt.partition('.')
+        if fmt in images or base not in images:
+            continue
+        if not compression.is_available(
+                _COMPRESSION_NAMES.get(extension)):
+            print('Skipping {0} images, {1} compression is not '
+                  'available'.format(fmt, extension))
+            continue
+        checksum = _compress(os.path.join(directory, base),
+                             os.path.join(directory, fmt), extension)
+        images[fmt] = (fmt, checksum, base)
+    return images
+
+
+def build_configdrive(size):
+    """Build a base64 encoded, gzipped configdrive of size bytes."""
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = compressor.compress(os.urandom(size)) + compressor.flush()
+    return base64.b64encode(data).decode('ascii')
+
+
+def _rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _thread_cpu(tid):
+    """CPU seconds used by a thread of this process, None if it is gone."""
+    try:
+        with open('/proc/self/task/{0}/stat'.format(tid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+
+
+def _process_cpu():
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+
+class _Sampler(object):
+    """Follow the phases of a deploy and the resources it uses.
+
+    Phases are recorded as the command starts them, see start_phase(), and
+    the RSS and the CPU time of threads are sampled periodically.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self._progress = None
+        self._lock = threading.Lock()
+        # Last CPU time seen by thread ID, with the stage of the thread
+        self._threads = {}
+
+    @staticmethod
+    def _phase_bytes(progress, phase):
+        if phase in standby._ImageProgress._WRITE_PHASES:
+            return progress.bytes_written
+        return progress.bytes_downloaded
+
+    def _end_phase(self, now):
+        if not self.phases:
+            return
+        phase = self.phases[-1]
+        cpu, children = _process_cpu()
+        phase.update(
+            seconds=now - phase['start'],
+            bytes=self._phase_bytes(self._progress,
+                                    phase['phase']) - phase['bytes'],
+            cpu=cpu - phase['cpu'] + children - phase['children'])
+
+    def start_phase(self, progress, phase):
+        """Record the start of a phase, called by the command thread."""
+        now = time.time()
+        with self._lock:
+            self._progress = progress
+            self._end_phase(now)
+            cpu, children = _process_cpu()
+            self.phases.append({'phase': phase, 'start': now,
+                                'bytes': self._phase_bytes(progress, phase),
+                                'cpu': cpu, 'children': children,
+                                'rss': _rss()})
+
+    def sample(self, command):
+        with self._lock:
+            if self.phases:
+                self.phases[-1]['rss'] = max(self.phases[-1]['rss'], _rss())
+        for thread in threading.enumerate():
+            tid = getattr(thread, 'native_id', None)
+            if tid is None or thread is threading.current_thread():
+                continue
+            if thread is command.execution_thread:
+                stage = 'command'
+            else:
+                stage = _THREAD_STAGES.get(type(thread).__name__, 'other')
+            cpu = _thread_cpu(tid)
+            if cpu is not None:
+                self._threads[tid] = (stage, cpu)
+
+    def finish(self):
+        """End the last phase.
+
+        :returns: the CPU seconds used by each stage.
+        """
+        with self._lock:
+            self._end_phase(time.time())
+        stages = dict((stage, 0.0) for stage in STAGES)
+        for stage, cpu in self._threads.values():
+            stages[stage] += cpu
+        if self.phases:
+            stages['qemu-img'] = (_process_cpu()[1]
+                                  - self.phases[0]['children'])
+        return stages
+
+
+def run_deploy(server, image, mode, target, configdrive, run, interval):
+    """Deploy an image with prepare_image and measure it.
+
+    :returns: a dictionary of the measurements.
+    """
+    name, checksum, disk_format = image
+    image_info = {'id': 'benchmark-{0}-{1}-{2}'.format(name, mode, run),
+                  'urls': [server.url(name)],
+                  'checksum': checksum,
+                  'disk_format': disk_format,
+                  'container_format': 'bare',
+                  'stream_raw_images': mode == 'stream'}
+    if os.path.isfile(target):
+        os.remove(target)
+
+    sampler = _Sampler()
+    start_phase = standby._ImageProgress.start_phase
+
+    def record_phase(progress, phase, total_bytes=None):
+        sampler.start_phase(progress, phase)
+        start_phase(progress, phase, total_bytes)
+
+    standby._ImageProgress.start_phase = record_phase
+    try:
+        extension = standby.StandbyExtension()
+        starttime = time.time()
+        command = extension.prepare_image(image_info=image_info,
+                                          configdrive=configdrive)
+        while not command.is_done():
+            sampler.sample(command)
+            time.sleep(interval)
+        command.join()
+        seconds = time.time() - starttime
+    finally:
+        standby._ImageProgress.start_phase = start_phase
+    stages = sampler.finish()
+
+    staged = standby._image_location(image_info)
+    if os.path.exists(staged):
+        os.remove(staged)
+    image_size = os.path.getsize(os.path.join(server.directory, 'raw'))
+    return {'format': name, 'mode': mode, 'run': run,
+            'status': command.command_status,
+            'error': command.command_error and str(command.command_error),
+            'seconds': seconds,
+            'throughput': image_size / float(MB) / seconds,
+            'phases': sampler.phases,
+            'stage_cpu': stages}
+
+
+def _print_result(result):
+    print('{format} {mode} #{run}: {status} in {seconds:.2f}s, '
+          '{throughput:.1f} MB/s'.format(**result))
+    if result['error']:
+        print('  {0}'.format(result['error']))
+    print('  {0:<14}{1:>9}{2:>10}{3:>9}{4:>10}{5:>8}'.format(
+        'phase', 'seconds', 'MB', 'MB/s', 'peak RSS', 'CPU s'))
+    for phase in result['phases']:
+        seconds = phase.get('seconds', 0)
+        mbytes = phase.get('bytes', 0) / float(MB)
+        print('  {0:<14}{1:>9.2f}{2:>10.1f}{3:>9.1f}{4:>10.1f}{5:>8.2f}'
+              .format(phase['phase'], seconds, mbytes,
+                      mbytes / seconds if seconds else 0,
+                      phase['rss'] / float(MB), phase.get('cpu', 0)))
+    print('  thread CPU s: {0}'.format(', '.join(
+        '{0} {1:.2f}'.format(stage, result['stage_cpu'][stage])
+        for stage in STAGES)))
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark image deploys by the standby extension.')
+    parser.add_argument('--size', type=int, default=256,
+                        help='MB of data in the images.')
+    parser.add_argument('--sparseness', type=float, default=0.5,
+                        help='Fraction of the data made of zeros.')
+    parser.add_argument('--formats', default='raw,raw.gz,qcow2',
+                        help='Comma separated image formats.')
+    parser.add_argument('--modes', default='staged,stream',
+                        help='Comma separated deploy modes, staged or '
+                             'stream.')
+    parser.add_argument('--target',
+                        help='Block device or file to deploy onto, a file '
+                             'in the work directory by default.')
+    parser.add_argument('--configdrive-size', type=int, default=1,
+                        help='MB of configdrive, 0 for none.')
+    parser.add_argument('--configdrive-url', action='store_true',
+                        help='Serve the configdrive rather than passing it '
+                             'inline.')
+    parser.add_argument('--connections', type=int,
+                        help='Value of image_download_connections.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Read back the image after writing it.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of runs of each format and mode.')
+    parser.add_argument('--interval', type=float, default=0.05,
+                        help='Seconds between samples.')
+    parser.add_argument('--workdir',
+                        help='Directory for the images, a temporary one '
+                             'removed afterwards by default.')
+    parser.add_argument('--json', help='File to write the results to.')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+    formats = args.formats.split(',')
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ipa-benchmark-')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    target = args.target or os.path.join(workdir, 'disk')
+
+    CONF.set_override('image_cache_manifest', '')
+    CONF.set_override('image_verify_after_write', args.verify)
+    if args.connections is not None:
+        CONF.set_override('image_download_connections', args.connections)
+    hardware._global_managers = [_BenchmarkHardwareManager(target)]
+
+    server = None
+    try:
+        images = build_images(workdir, formats, args.size * MB,
+                              args.sparseness)
+        configdrive = None
+        if args.configdrive_size:
+            configdrive = build_configdrive(args.configdrive_size * MB)
+            if args.configdrive_url:
+                with open(os.path.join(workdir, 'configdrive'), 'w') as f:
+                    f.write(configdrive)
+
+        server = _ImageServer(workdir)
+        server.start()
+        if args.configdrive_url and configdrive:
+            configdrive = server.url('configdrive')
+
+        results = []
+        for fmt in formats:
+            if fmt not in images:
+                continue
+            for mode in args.modes.split(','):
+                for run in range(args.repeat):
+                    result = run_deploy(server, images[fmt], mode, target,
+                                        configdrive, run, args.interval)
+                    _print_result(result)
+                    results.append(result)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if server is not None:
+            server.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if all(r['status'] == 'SUCCEEDED' for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())